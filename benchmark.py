@@ -0,0 +1,175 @@
+"""
+Throughput and latency benchmarks for the acquisition path, run against the
+spisim simulated bus so they work without a Pi. Each benchmark reports
+wall-clock cost per call, and the SPI transactions, bytes, and modeled bus
+time per call. Results are written as JSON and can be compared against a
+stored baseline:
+
+    python benchmark.py --out bench.json
+    python benchmark.py --baseline bench.json
+
+A benchmark regresses if its time per call grows by more than the tolerance,
+or if its transactions or bytes per call grow by more than a small slack
+(the end-to-end loop mix of BME680 and LSM9DS1 reads varies a little run to run). Exit status is 1 if
+anything regressed.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+
+import spisim
+
+
+def measure(name:str,func,bus:spisim.SimBus,n:int)->dict:
+    """
+    Call func() n times and record the cost.
+
+    :return: Dictionary of results for this benchmark
+    """
+    bus.reset_stats()
+    t0=time.perf_counter_ns()
+    for _ in range(n):
+        func()
+    dt=time.perf_counter_ns()-t0
+    return {'name':name,
+            'n':n,
+            'us_per_call':dt/n/1000,
+            'calls_per_s':n/(dt/1e9),
+            'xfers_per_call':bus.n_xfer/n,
+            'bytes_per_call':bus.n_bytes/n,
+            'bus_us_per_call':bus.xfer_time/n*1e6}
+
+
+def end_to_end(bus:spisim.SimBus,cs,bme,ag,duration:float)->dict:
+    """
+    Run the combined two-sensor loop of read_sensors.main(), without the
+    printing, for the given time: the BME680 is only visited once its
+    measurement is due (ready_at, then poll()), and the IMU is polled with
+    query(burst=True) in the meantime. A call is one sample from either sensor.
+    """
+    bus.reset_stats()
+    n_bme=0
+    n_ag=0
+    t0=time.perf_counter_ns()
+    t1=t0+int(duration*1e9)
+    cs.set_addr(0)
+    while time.perf_counter_ns()<t1:
+        if time.monotonic()>=bme.ready_at:
+            cs.set_addr(2)
+            if bme.poll():
+                bme.query()
+                n_bme+=1
+            cs.set_addr(0)
+        if ag.query(burst=True) is not None:
+            n_ag+=1
+    dt=(time.perf_counter_ns()-t0)/1e9
+    n=n_bme+n_ag
+    return {'name':'end_to_end',
+            'n':n,
+            'us_per_call':dt/n*1e6,
+            'calls_per_s':n/dt,
+            'xfers_per_call':bus.n_xfer/n,
+            'bytes_per_call':bus.n_bytes/n,
+            'bus_us_per_call':bus.xfer_time/n*1e6,
+            'bme680_samples_per_s':n_bme/dt,
+            'lsm9ds1_samples_per_s':n_ag/dt}
+
+
+def run(n:int=10_000,duration:float=2.0,speed_hz:int=3_900_000)->dict:
+    """
+    Run all benchmarks.
+
+    :param n: Number of calls for each per-call benchmark
+    :param duration: Time in seconds to run the end-to-end loop
+    :param speed_hz: SPI clock rate
+    :return: Dictionary with run information and a list of results
+    """
+    bus=spisim.install()
+    from spidev import SpiDev
+    from bits import extract_int16_le, extract_uint16_le
+    from chip_select import ChipSelect
+    from bme680 import BME680
+    from lsm9ds1 import LSM9DS1_AG
+    cs=ChipSelect()
+    cs.begin()
+    spi=SpiDev()
+    spi.open(0,0)
+    spi.max_speed_hz=speed_hz
+    spi.mode=0b00
+    cs.set_addr(2)
+    bme=BME680(spi)
+    with contextlib.redirect_stdout(io.StringIO()):
+        bme.begin()
+    cs.set_addr(0)
+    ag=LSM9DS1_AG(spi)
+    ag.begin(odr_g=952.0)
+    buf=bytes((0x34,0x92))
+    results=[measure('read_reg',lambda:ag.read_reg(ag.WHO_AM_I),bus,n),
+             measure('extract_int16_le',lambda:extract_int16_le(buf),bus,n),
+             measure('extract_uint16_le',lambda:extract_uint16_le(buf),bus,n),
+             measure('lsm9ds1_query',ag.query,bus,n),
+             measure('lsm9ds1_query_burst',lambda:ag.query(burst=True),bus,n),
+             measure('chip_select_set_addr',lambda:cs.set_addr(0),bus,n)]
+    cs.set_addr(2)
+    results+=[measure('bme680_query_cal',lambda:bme.query(rekick=False),bus,n),
+              measure('bme680_query_raw',lambda:bme.query(rekick=False,cal=False),bus,n)]
+    results.append(end_to_end(bus,cs,bme,ag,duration))
+    return {'python':platform.python_version(),
+            'machine':platform.machine(),
+            'speed_hz':speed_hz,
+            'results':results}
+
+
+def compare(current:dict,baseline:dict,tolerance:float=0.2,count_tolerance:float=0.05)->list:
+    """
+    :param tolerance: Allowed fractional growth in time per call
+    :param count_tolerance: Allowed fractional growth in transactions and bytes per call
+    :return: List of strings describing each regression, empty if none
+    """
+    old={result['name']:result for result in baseline['results']}
+    regressions=[]
+    for result in current['results']:
+        name=result['name']
+        if name not in old:
+            continue
+        if result['us_per_call']>old[name]['us_per_call']*(1+tolerance):
+            regressions.append(f"{name}: {result['us_per_call']:.2f}us per call, baseline {old[name]['us_per_call']:.2f}us")
+        for key in ('xfers_per_call','bytes_per_call'):
+            if result[key]>old[name][key]*(1+count_tolerance):
+                regressions.append(f"{name}: {result[key]:.2f} {key}, baseline {old[name][key]:.2f}")
+    return regressions
+
+
+def main(argv=None)->int:
+    parser=argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--out',help='Write results to this JSON file')
+    parser.add_argument('--baseline',help='Compare results against this JSON file')
+    parser.add_argument('--tolerance',type=float,default=0.2,help='Allowed fractional slowdown against baseline')
+    parser.add_argument('-n',type=int,default=10_000,help='Calls per benchmark')
+    parser.add_argument('--duration',type=float,default=2.0,help='Seconds to run the end-to-end loop')
+    parser.add_argument('--speed',type=int,default=3_900_000,help='SPI clock rate in Hz')
+    args=parser.parse_args(argv)
+    current=run(n=args.n,duration=args.duration,speed_hz=args.speed)
+    for result in current['results']:
+        print(f"{result['name']:24s} {result['us_per_call']:9.2f}us/call {result['calls_per_s']:10.0f}/s "
+              f"{result['xfers_per_call']:5.2f} xfers {result['bytes_per_call']:6.2f} bytes {result['bus_us_per_call']:8.2f}us bus")
+    if args.out is not None:
+        with open(args.out,'w') as outf:
+            json.dump(current,outf,indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as inf:
+            baseline=json.load(inf)
+        regressions=compare(current,baseline,args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if len(regressions)>0:
+            return 1
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -1,23 +1,197 @@
+import asyncio
+import json
 import time
+import zlib
+from typing import NamedTuple
 
 from spidev import SpiDev
 
+from regblock import RegBlock, Field, BitField
 from spi_sensor import SPI_sensor
 
 
+class BME680Cal(NamedTuple):
+    """
+    Calibration coefficients of one BME680, as read from the chip by BME680.begin().
+    Use this to carry calibration along with logged raw data, for instance
+    to feed the array functions in bme680_batch. The gas heater fields default
+    to 0 so that calibrations saved before they were added still load.
+    """
+    par_t1:int
+    par_t2:int
+    par_t3:int
+    par_p1:int
+    par_p2:int
+    par_p3:int
+    par_p4:int
+    par_p5:int
+    par_p6:int
+    par_p7:int
+    par_p8:int
+    par_p9:int
+    par_p10:int
+    par_h1:int
+    par_h2:int
+    par_h3:int
+    par_h4:int
+    par_h5:int
+    par_h6:int
+    par_h7:int
+    par_g1:int=0
+    par_g2:int=0
+    par_g3:int=0
+    res_heat_val:int=0
+    res_heat_range:int=0
+    range_sw_err:int=0
+
+
+class GasResult(NamedTuple):
+    """
+    Gas measurement from the last BME680.query()
+    """
+    profile:int       # Index of the heater profile the measurement used
+    gas_adc:int       # Raw 10-bit gas resistance ADC count
+    gas_range:int     # ADC range
+    gas_valid:bool    # A gas conversion was made
+    heat_stab:bool    # The heater reached its target temperature
+    resistance:float  # Gas resistance in ohms, or None if not calibrated
+
+
+class BME680Coef(NamedTuple):
+    """
+    Calibration coefficients folded into the constants the compensation formulas
+    actually use, so that each compensation is a short chain of multiply-adds.
+    Each constant is the same subexpression as in the Bosch float code, so the
+    results are unchanged. Names describe the expression, IE t1_1024 is par_t1/1024.
+    """
+    t1_1024:float
+    t1_8192:float
+    t2:float
+    t3_16:float
+    dT_a:float
+    dT_b:float
+    p1:float
+    p2:float
+    p3:float
+    p4_65536:float
+    p5:float
+    p6_131072:float
+    p7_128:float
+    p8_32768:float
+    p9:float
+    p10_131072:float
+    dP_a:float
+    dP_b:float
+    h1_16:float
+    h2_262144:float
+    h3_2:float
+    h4_16384:float
+    h5_1048576:float
+    h6_16384:float
+    h7_2097152:float
+    @classmethod
+    def from_cal(cls,cal:BME680Cal)->"BME680Coef":
+        return cls(t1_1024    = float(cal.par_t1) / 1024.0,
+                   t1_8192    = float(cal.par_t1) / 8192.0,
+                   t2         = float(cal.par_t2),
+                   t3_16      = float(cal.par_t3) * 16.0,
+                   # dT/drT=(t2/16384+2*t3_16*(rT/131072-t1_8192)/131072)/5120
+                   dT_a       = float(cal.par_t2) / 16384.0 / 5120.0,
+                   dT_b       = float(cal.par_t3) * 16.0 * 2.0 / 131072.0 / 5120.0,
+                   p1         = float(cal.par_p1),
+                   p2         = float(cal.par_p2),
+                   p3         = float(cal.par_p3),
+                   p4_65536   = float(cal.par_p4) * 65536.0,
+                   p5         = float(cal.par_p5),
+                   p6_131072  = float(cal.par_p6) / 131072.0,
+                   p7_128     = float(cal.par_p7) * 128.0,
+                   p8_32768   = float(cal.par_p8) / 32768.0,
+                   p9         = float(cal.par_p9),
+                   p10_131072 = cal.par_p10 / 131072.0,
+                   # Derivatives of the P*P*p9/2**31 and (P/256)**3*p10/131072 terms, less a factor of P and P**2
+                   dP_a       = 2.0 * float(cal.par_p9) / 2147483648.0,
+                   dP_b       = 3.0 * (cal.par_p10 / 131072.0) / 16777216.0,
+                   h1_16      = float(cal.par_h1) * 16.0,
+                   h2_262144  = float(cal.par_h2) / 262144.0,
+                   h3_2       = float(cal.par_h3) / 2.0,
+                   h4_16384   = float(cal.par_h4) / 16384.0,
+                   h5_1048576 = float(cal.par_h5) / 1048576.0,
+                   h6_16384   = float(cal.par_h6) / 16384.0,
+                   h7_2097152 = float(cal.par_h7) / 2097152.0)
+
+
 class BME680(SPI_sensor):
     chip_id = 0xD0;
     reset = 0xE0;
     ctrl_hum = 0x72;
     ctrl_meas = 0x74;
     config = 0x75;
+    ctrl_gas_0 = 0x70;
     ctrl_gas_1 = 0x71;
     meas_status_0 = 0x1d;
+    res_heat_0 = 0x5a;
+    gas_wait_0 = 0x64;
+    # Number of heater set-points, res_heat_0..9 and gas_wait_0..9
+    n_heater_profiles=10
+    # Range-dependent gas ADC corrections, from the Bosch API calc_gas_resistance_low()
+    gas_k1_range=(0.0, 0.0, 0.0, 0.0, 0.0, -1.0, 0.0, -0.8, 0.0, 0.0, -0.2, -0.5, 0.0, -1.0, 0.0, 0.0)
+    gas_k2_range=(0.0, 0.0, 0.0, 0.0, 0.1, 0.7, 0.0, -0.8, -0.1, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    whoami_value=0x61
+    scratch_reg=gas_wait_0 # Only used for gas measurements. begin() resets the chip anyway.
+    max_spi_hz=10_000_000
+    # Conversion cycles for each osrs_* setting
+    os_to_meas_cycles=(0,1,2,4,8,16,16,16)
     pres_msb = 0x1f;
+    # Prebuilt transactions selecting each register page
+    page_bufs=(bytes((0x73 & 0x7f,0<<4)),bytes((0x73 & 0x7f,1<<4)))
+    # pres_msb..hum_lsb: 20-bit P and T, 16-bit h, all big-endian
+    data_block=RegBlock('data',0x1f,8,(BitField('rP',((0,0,8),(1,0,8),(2,4,4))),
+                                       BitField('rT',((3,0,8),(4,0,8),(5,4,4))),
+                                       Field   ('rh',6,'H')),endian='>')
+    # Same, continuing through gas_r_msb and gas_r_lsb, for when gas is enabled
+    data_gas_block=RegBlock('data_gas',0x1f,0x2b-0x1f+1,(BitField('rP',((0,0,8),(1,0,8),(2,4,4))),
+                                                         BitField('rT',((3,0,8),(4,0,8),(5,4,4))),
+                                                         Field   ('rh',6,'H'),
+                                                         BitField('gas_adc'  ,((11,0,8),(12,6,2))),
+                                                         BitField('gas_range',((12,0,4),)),
+                                                         BitField('gas_valid',((12,5,1),)),
+                                                         BitField('heat_stab',((12,4,1),))),endian='>')
+    # Calibration coefficients are in three regions, 0x8A-0xA0 and 0xE1-0xEE on page 0,
+    # and the heater calibration at 0x00-0x04 on page 1
+    cal_blocks=(RegBlock('cal_tp',0x8a,0xa0-0x8a+1,(Field('par_t2' , 0,'h'),
+                                                     Field('par_t3' , 2,'b'),
+                                                     Field('par_p1' , 4,'H'),
+                                                     Field('par_p2' , 6,'h'),
+                                                     Field('par_p3' , 8,'b'),
+                                                     Field('par_p4' ,10,'h'),
+                                                     Field('par_p5' ,12,'h'),
+                                                     Field('par_p7' ,14,'b'),
+                                                     Field('par_p6' ,15,'b'),
+                                                     Field('par_p8' ,18,'h'),
+                                                     Field('par_p9' ,20,'h'),
+                                                     Field('par_p10',22,'B'))),
+                RegBlock('cal_ht',0xe1,0xee-0xe1+1,(BitField('par_h1',((2,0,8),(1,0,4))),
+                                                     BitField('par_h2',((0,0,8),(1,4,4))),
+                                                     Field('par_h3', 3,'b'),
+                                                     Field('par_h4', 4,'b'),
+                                                     Field('par_h5', 5,'b'),
+                                                     Field('par_h6', 6,'B'),
+                                                     Field('par_h7', 7,'b'),
+                                                     Field('par_t1', 8,'H'),
+                                                     Field('par_g2',10,'h'),
+                                                     Field('par_g1',12,'b'),
+                                                     Field('par_g3',13,'b'))),
+                RegBlock('cal_heat',0x00,0x04-0x00+1,(Field('res_heat_val',0,'b'),
+                                                       BitField('res_heat_range',((2,4,2),)),
+                                                       BitField('range_sw_err',((4,4,4),),signed=True))))
 
     def __init__(self,spi:SpiDev):
         super().__init__(spi)
-        self.page=0
+        # Register page the chip is on, or None if unknown. A previous run may have left
+        # it on either page, so the first access always selects one.
+        self.page=None
+        self.heater_profiles=()
+        self.gas=None
     def set_page(self,new_page:int,force:bool=False):
         """
         Explicitly set SPI register page
@@ -26,15 +200,66 @@ class BME680(SPI_sensor):
         # Register page is bit 4 in register 0x73/0xF3 (IE same slot in both pages).
         # It seems backwards, but page 0 is registers 0x80-0xFF, and page 1 is 0x00-0x7F
         if force or self.page!=new_page:
-            self.spi.xfer(bytes([0x73 & 0x7f]) + bytes((new_page<<4,)))
+            if self.inst is None:
+                self.xfer(self.page_bufs[new_page])
+            else:
+                t0=time.perf_counter_ns()
+                self.xfer(self.page_bufs[new_page])
+                self.inst.record_page(self.inst_name,time.perf_counter_ns()-t0)
             self.page=new_page
-    def read_reg(self,reg_addr:int,count:int=1)->bytes:
+    def resync(self)->None:
+        super().resync()
+        # A garbled transaction may have hit the page select, so select it afresh next time
+        self.page=None
+    def read_block(self,reg_addr:int,count:int)->memoryview:
         self.set_page(1 if reg_addr<0x80 else 0)
-        return super().read_reg(reg_addr,count)
+        return super().read_block(reg_addr,count)
     def write_reg(self,reg_addr:int,values:[bytes,int])->None:
         self.set_page(1 if reg_addr<0x80 else 0)
         super().write_reg(reg_addr,values)
-    def begin(self,osrs_t:int=5, osrs_p:int=5, osrs_h:int=5, osrs_g:int=0):
+    def write_pairs(self,pairs)->None:
+        """
+        Write several registers in one transaction. The BME680 takes the bytes after the
+        first data byte of a write as address/data pairs, so the registers needn't be
+        contiguous, but they must all be on the same page.
+
+        :param pairs: Sequence of (register, value)
+        """
+        page=1 if pairs[0][0]<0x80 else 0
+        buf=bytearray()
+        for reg_addr,value in pairs:
+            if (1 if reg_addr<0x80 else 0)!=page:
+                raise ValueError(f"Register 0x{reg_addr:02x} is on a different page from 0x{pairs[0][0]:02x}")
+            buf.append(reg_addr & 0x7f)
+            buf.append(value)
+        self.set_page(page)
+        self.xfer(buf)
+        for reg_addr,value in pairs:
+            self.shadow[reg_addr]=value
+            self.dirty.discard(reg_addr)
+    def written(self,reg_addr:int,values)->None:
+        # Multi-byte writes are address/data pairs after the first data byte, not auto-increment
+        page_base=reg_addr & 0x80
+        self.shadow[reg_addr]=values[0]
+        self.dirty.discard(reg_addr)
+        for i in range(1,len(values)-1,2):
+            self.shadow[page_base | values[i]]=values[i+1]
+            self.dirty.discard(page_base | values[i])
+    def write_shadow(self,regs)->int:
+        """
+        Write registers from the shadow, as address/data pairs in one transaction per page,
+        so they needn't be contiguous
+        """
+        result=0
+        for page in (1,0):
+            pairs=[(reg_addr,self.shadow[reg_addr]) for reg_addr in regs if (1 if reg_addr<0x80 else 0)==page]
+            if pairs:
+                self.write_pairs(pairs)
+                result+=1
+        return result
+    def begin(self,osrs_t:int=5, osrs_p:int=5, osrs_h:int=5, osrs_g:int=0,
+              cal_cache:str=None,verify:bool=False,verbose:bool=False,
+              heater_profiles=((320,150),),amb_temp:float=25.0):
         """
 
         :param osrs_t: T oversample -- set to 0 to disable T readout,
@@ -42,190 +267,454 @@ class BME680(SPI_sensor):
         :param osrs_p: P oversample -- set to 0 to disable P readout,
                                        or set oversampling to 2**(osrs_p-1). Default is highest oversampling.
         :param osrs_h:
-        :param osrs_g:
+        :param osrs_g: Non-zero to measure gas resistance, using heater_profiles
+        :param cal_cache: Name of a file to cache the calibration blocks in. Only the first
+                          block is read from the chip, and the rest come from the file if it
+                          holds a valid calibration starting with that block. Otherwise the
+                          chip is read and the calibration is added to the file. The chip ID
+                          is the same for every BME680, so the calibration itself tells
+                          sensors apart, and one file can serve several sensors.
+        :param verify: Read back the configuration registers from the chip after writing them,
+                       and raise IOError if they don't match
+        :param verbose: Print the configuration registers and calibration coefficients. The
+                        registers come from the shadow, unless verify is set.
+        :param heater_profiles: Sequence of up to 10 (target temperature in degC, duration in ms)
+                                heater set-points. Successive measurements cycle through them.
+        :param amb_temp: Ambient temperature in degC, for the heater set-points
         """
         # Make sure we are on a known register page
         self.osrs_t=osrs_t
         self.osrs_p=osrs_p
         self.osrs_h=osrs_h
         self.osrs_g=osrs_g
-        if self.osrs_g>0:
-            raise NotImplementedError("Gas sensor not implemented")
         self.set_page(0,force=True) #Change to page 0
 
         # Reset, and allow 10ms to wake up. Reset will also put us on page 0.
         self.write_reg(0xE0,0xb6)
         time.sleep(0.01)
+        # Everything is back to its power-on value, so forget the shadow
+        self.shadow.clear()
+        self.dirty.clear()
 
         # Set oversampling for T, P, H. T and P in same register, H in a different register
-        self.write_reg(self.ctrl_hum,  (     0 & 0x01) << 6 | ##Disable spi 3wire interrupt
-                                       (osrs_h & 0x07) << 0)  ##Set humidity oversample
-        print(f"readback of ctrl_hum 0x{self.ctrl_hum:02x}: 0b{self.read_reg(self.ctrl_hum):08b}")
+        self.set_reg(self.ctrl_hum,  (     0 & 0x01) << 6 | ##Disable spi 3wire interrupt
+                                     (osrs_h & 0x07) << 0)  ##Set humidity oversample
 
-        self.write_reg(self.ctrl_meas, (osrs_t & 0x07)<<5 |  # Temperature oversample
-                                       (osrs_p & 0x07)<<2 |  # Pressure oversample
-                                       (0      & 0x03)<<0 )  # Sleep mode for now
-        print(f"readback of ctrl_meas 0x{self.ctrl_meas:02x}: 0b{self.read_reg(self.ctrl_meas):08b}")
+        self.set_reg(self.ctrl_meas, (osrs_t & 0x07)<<5 |  # Temperature oversample
+                                     (osrs_p & 0x07)<<2 |  # Pressure oversample
+                                     (0      & 0x03)<<0)   # Sleep mode for now
 
         # Disable IIR for temperature
-        self.write_reg(self.config,    (0      & 0x07)<<2 |  # Disable IIR by setting coefficient to 0
-                                       (0      & 0x01)<<0 )  # Disable SPI 3wire interface
-        print(f"readback of config 0x{self.config:02x}: 0b{self.read_reg(self.config):08b}")
+        self.set_reg(self.config,    (0      & 0x07)<<2 |  # Disable IIR by setting coefficient to 0
+                                     (0      & 0x01)<<0)   # Disable SPI 3wire interface
+
+        # Gas measurement is set up below, once the heater calibration is read
+        self.set_reg(self.ctrl_gas_1,(0      & 0x01)<<4)   # Disable run_gas measurement
 
-        # Disable gas measurement
-        self.write_reg(self.ctrl_gas_1,(0      & 0x01)<<4 )     # Disable run_gas measurement
-        print(f"readback of ctrl_gas_1 0x{self.ctrl_gas_1:02x}: 0b{self.read_reg(self.ctrl_gas_1):08b}")
+        # All on page 1, so one transaction
+        self.flush()
+        if verify or verbose:
+            self.show_config(verify,verbose)
 
         # Read cal coefficients
-        self.par_t1=self.read_uint16(0xe9)
-        self.par_t2=self.read_int16(0x8a)
-        self.par_t3=self.read_int8(0x8c)
-        print(f"par_t1: {self.par_t1}")
-        print(f"par_t2: {self.par_t2}")
-        print(f"par_t3: {self.par_t3}")
-
-        self.par_p1 = self.read_uint16(0x8e)
-        self.par_p2 = self.read_int16(0x90)
-        self.par_p3 = self.read_int8(0x92)
-        self.par_p4 = self.read_int16(0x94)
-        self.par_p5 = self.read_int16(0x96)
-        self.par_p6 = self.read_int8(0x99)
-        self.par_p7 = self.read_int8(0x98)
-        self.par_p8 = self.read_int16(0x9c)
-        self.par_p9 = self.read_int16(0x9e)
-        self.par_p10 = self.read_reg(0xa0)
-        print(f"par_p1: {self.par_p1}")
-        print(f"par_p2: {self.par_p2}")
-        print(f"par_p3: {self.par_p3}")
-        print(f"par_p4: {self.par_p4}")
-        print(f"par_p5: {self.par_p5}")
-        print(f"par_p6: {self.par_p6}")
-        print(f"par_p7: {self.par_p7}")
-        print(f"par_p8: {self.par_p8}")
-        print(f"par_p9: {self.par_p9}")
-        print(f"par_p10: {self.par_p10}")
-        buf=self.read_reg(0xe1, 3);
-        print(f"buf: {buf[0]:02x}{buf[1]:02x}{buf[2]:02x}");
-        self.par_h1 = ((buf[1] & 0x0F) >> 0) | (buf[2] << 4);
-        self.par_h2 = ((buf[1] & 0xF0) >> 4) | (buf[0] << 4);
-        self.par_h3 = self.read_int8(0xe4);
-        self.par_h4 = self.read_int8(0xe5);
-        self.par_h5 = self.read_int8(0xe6);
-        self.par_h6 = self.read_reg(0xe7);
-        self.par_h7 = self.read_int8(0xe8);
-        print(f"par_h1: {self.par_h1}")
-        print(f"par_h2: {self.par_h2}")
-        print(f"par_h3: {self.par_h3}")
-        print(f"par_h4: {self.par_h4}")
-        print(f"par_h5: {self.par_h5}")
-        print(f"par_h6: {self.par_h6}")
-        print(f"par_h7: {self.par_h7}")
+        blob=None
+        if cal_cache is not None:
+            first=self.cal_blocks[0]
+            fingerprint=bytes(self.read_block(first.start,first.length))
+            blob=self.load_cal(cal_cache,fingerprint)
+        if blob is None:
+            blob=self.read_cal_blob()
+            if cal_cache is not None:
+                self.save_cal(cal_cache,blob)
+        self.parse_cal_blob(blob)
+        if verbose:
+            for block in self.cal_blocks:
+                for name in block.names:
+                    print(f"{name}: {getattr(self,name)}")
+
+        self.coef=BME680Coef.from_cal(self.cal())
+        self.meas_dur=self.meas_duration()
+        if osrs_g>0:
+            self.set_heater_profiles(heater_profiles,amb_temp,verify)
+        else:
+            self.heater_profiles=()
+        # Index of the heater profile for the next kickoff(), and of the measurement in progress
+        self.next_profile=0
+        self.profile=None
+        self.heat_dur=0.0
+        self.data=self.data_gas_block if self.heater_profiles else self.data_block
 
         # Do a priming read -- this will eventually set the data-ready bit.
         self.kickoff()
+    def show_config(self,verify:bool=False,verbose:bool=False):
+        """
+        Check and/or print the configuration registers
+
+        :param verify: Read them back from the chip in one burst, and raise IOError if
+                       they don't match the shadow
+        :param verbose: Print them, as read back if verify is set, otherwise from the shadow
+        """
+        start=self.ctrl_gas_1
+        readback=self.verify_shadow(start,self.config-start+1) if verify else None
+        if verbose:
+            for reg_addr,name in ((self.ctrl_gas_1,"ctrl_gas_1"),(self.ctrl_hum,"ctrl_hum"),
+                                  (self.ctrl_meas,"ctrl_meas"),(self.config,"config")):
+                value=self.read_shadow(reg_addr) if readback is None else readback[reg_addr-start]
+                print(f"readback of {name} 0x{reg_addr:02x}: 0b{value:08b}")
+    def set_oversampling(self,osrs_t:int=None,osrs_p:int=None,osrs_h:int=None):
+        """
+        Change oversampling without a full begin(). Humidity goes through the shadow in one
+        write, temperature and pressure are written by the next kickoff() anyway. Takes
+        effect from the next measurement started.
+
+        :param osrs_t: New T oversample, or None to leave it alone. Same meaning as in begin().
+        :param osrs_p: New P oversample, or None to leave it alone
+        :param osrs_h: New H oversample, or None to leave it alone
+        """
+        if osrs_t is not None:
+            self.osrs_t=osrs_t
+        if osrs_p is not None:
+            self.osrs_p=osrs_p
+        if osrs_h is not None:
+            self.osrs_h=osrs_h
+            self.set_field(self.ctrl_hum,0,3,osrs_h)
+            self.flush()
+        self.meas_dur=self.meas_duration()
+    def read_cal_blob(self)->bytes:
+        """
+        :return: Raw calibration blocks, read from the chip one burst per block and concatenated
+        """
+        return b''.join(bytes(self.read_block(block.start,block.length)) for block in self.cal_blocks)
+    def parse_cal_blob(self,blob:bytes):
+        """
+        Set the par_* attributes from raw calibration blocks as returned by read_cal_blob()
+        """
+        offset=0
+        for block in self.cal_blocks:
+            for name,value in zip(block.names,block.decode(blob,offset)):
+                setattr(self,name,value)
+            offset+=block.length
+        self.cal_blob=bytes(blob)
+    @staticmethod
+    def read_cal_cache(filename:str)->dict:
+        """
+        :return: Dictionary of cache entries by key, empty if the file is missing or unreadable
+        """
+        try:
+            with open(filename) as inf:
+                entries=json.load(inf)['sensors']
+        except (OSError,ValueError,KeyError,TypeError):
+            return {}
+        return entries if isinstance(entries,dict) else {}
+    def load_cal(self,filename:str,fingerprint:bytes)->bytes:
+        """
+        :param filename: Calibration cache file written by save_cal()
+        :param fingerprint: First calibration block, as read from the sensor
+        :return: Raw calibration blocks, or None if the file has no entry starting with this
+                 fingerprint, or the entry is for a different layout or fails its checksum
+        """
+        entry=self.read_cal_cache(filename).get(f"{zlib.crc32(fingerprint):08x}")
+        try:
+            blob=bytes.fromhex(entry['blob'])
+        except (ValueError,KeyError,TypeError):
+            return None
+        if len(blob)!=sum(block.length for block in self.cal_blocks):
+            return None
+        if entry.get('crc32')!=zlib.crc32(blob):
+            return None
+        if blob[:len(fingerprint)]!=fingerprint:
+            return None
+        return blob
+    def save_cal(self,filename:str,blob:bytes):
+        """
+        Add raw calibration blocks to a cache file, keyed by the CRC-32 of the first block and
+        protected by a CRC-32 of the whole. Entries for other sensors are kept.
+        """
+        entries=self.read_cal_cache(filename)
+        entries[f"{zlib.crc32(blob[:self.cal_blocks[0].length]):08x}"]={'crc32':zlib.crc32(blob),'blob':blob.hex()}
+        with open(filename,'w') as outf:
+            json.dump({'sensors':entries},outf)
+    def set_heater_profiles(self,profiles,amb_temp:float=25.0,verify:bool=False):
+        """
+        Compute the heater set-points once and write them to res_heat_x and gas_wait_x,
+        in one transaction. Call again if the ambient temperature changes a lot.
+
+        :param profiles: Sequence of up to 10 (target temperature in degC, duration in ms)
+        :param amb_temp: Ambient temperature in degC
+        :param verify: Read back the set-points, and raise IOError if they don't match
+        """
+        if not 0<len(profiles)<=self.n_heater_profiles:
+            raise ValueError(f"Need 1 to {self.n_heater_profiles} heater profiles, got {len(profiles)}")
+        res_heat=[self.calc_res_heat(temp,amb_temp) for temp,_ in profiles]
+        gas_wait=[self.calc_gas_wait(dur) for _,dur in profiles]
+        self.write_pairs([(self.res_heat_0+i,value) for i,value in enumerate(res_heat)]+
+                         [(self.gas_wait_0+i,value) for i,value in enumerate(gas_wait)])
+        if verify:
+            readback=bytes(self.read_block(self.res_heat_0,self.gas_wait_0-self.res_heat_0+len(profiles)))
+            n_gap=self.gas_wait_0-self.res_heat_0
+            if list(readback[:len(profiles)])!=res_heat or list(readback[n_gap:])!=gas_wait:
+                raise IOError(f"readback of heater set-points was {readback.hex()}")
+        self.heater_profiles=tuple(profiles)
+        # Actual heating time of each profile, after gas_wait quantization, in seconds
+        self.heat_durs=tuple(self.gas_wait_ms(code)/1000 for code in gas_wait)
+    def calc_res_heat(self,temp:float,amb_temp:float=25.0)->int:
+        """
+        Heater resistance set-point, from the Bosch API calc_res_heat()
+
+        :param temp: Target heater temperature in degC, at most 400
+        :param amb_temp: Ambient temperature in degC
+        :return: res_heat_x register value
+        """
+        temp=min(temp,400)
+        var1 = ((float(self.par_g1) / (16.0)) + 49.0)
+        var2 = ((((float(self.par_g2) / (32768.0)) * (0.0005)) + 0.00235))
+        var3 = (float(self.par_g3) / (1024.0))
+        var4 = (var1 * (1.0 + (var2 * float(temp))))
+        var5 = (var4 + (var3 * float(amb_temp)))
+        return int(3.4 * ((var5 * (4 / (4 + float(self.res_heat_range))) *
+                           (1 / (1 + (float(self.res_heat_val) * 0.002)))) - 25)) & 0xff
+    @staticmethod
+    def calc_gas_wait(dur:int)->int:
+        """
+        Heater duration register value, from the Bosch API calc_gas_wait(): 6 bits of
+        milliseconds and a 2 bit multiplier of 1, 4, 16 or 64
+
+        :param dur: Duration in ms, at most 4032
+        :return: gas_wait_x register value
+        """
+        if dur>=0xfc0:
+            return 0xff
+        factor=0
+        while dur>0x3f:
+            dur=dur//4
+            factor+=1
+        return dur+factor*64
+    @staticmethod
+    def gas_wait_ms(code:int)->int:
+        """
+        :return: Duration in ms of a gas_wait_x register value
+        """
+        return (code & 0x3f)*(1 << (2*(code >> 6)))
+    def calibrate_gas(self,gas_adc:int,gas_range:int)->float:
+        """
+        Gas resistance, from the Bosch API calc_gas_resistance_low() (BME680, not BME688)
+
+        :param gas_adc: Raw gas ADC count
+        :param gas_range: ADC range
+        :return: Resistance in ohms
+        """
+        var1 = (1340.0 + (5.0 * self.range_sw_err))
+        var2 = (var1) * (1.0 + self.gas_k1_range[gas_range] / 100.0)
+        var3 = 1.0 + (self.gas_k2_range[gas_range] / 100.0)
+        return 1.0 / (var3 * (0.000000125) * float(1 << gas_range) * ((((float(gas_adc)) - 512.0) / var2) + 1.0))
     def whoami(self)->int:
         return self.read_reg(self.chip_id)
+    def cal(self)->BME680Cal:
+        """
+        :return: Calibration coefficients read by begin()
+        """
+        return BME680Cal(*[getattr(self,field) for field in BME680Cal._fields])
+    def meas_duration(self)->float:
+        """
+        Expected duration of a forced-mode TPH measurement with the current oversampling,
+        from the Bosch API bme68x_get_meas_dur(): 1963us per conversion cycle, plus TPH
+        switching, gas measurement, and 1ms wake-up. Gas heating time is extra, see heat_durs.
+
+        :return: Duration in seconds
+        """
+        meas_cycles=(self.os_to_meas_cycles[self.osrs_t]+
+                     self.os_to_meas_cycles[self.osrs_p]+
+                     self.os_to_meas_cycles[self.osrs_h])
+        meas_dur=meas_cycles*1963 # us
+        meas_dur+=477*4           # TPH switching duration
+        meas_dur+=477*5           # Gas measurement duration
+        meas_dur+=1000            # Wake up duration of 1ms
+        return meas_dur/1e6
     def kickoff(self):
-        self.write_reg(self.ctrl_meas,(self.osrs_t & 0x07)<<5 |  # Write back existing oversample
-                                      (self.osrs_p & 0x07)<<2 |
-                                      (1           & 0x03)<<0)   # Force a measurement to start
+        """
+        Start a forced-mode measurement. With gas enabled, each call uses the next heater
+        profile in turn, selected in the same transaction that starts the measurement.
+        """
+        ctrl_meas=((self.osrs_t & 0x07)<<5 |  # Write back existing oversample
+                   (self.osrs_p & 0x07)<<2 |
+                   (1           & 0x03)<<0)   # Force a measurement to start
+        if self.heater_profiles:
+            self.profile=self.next_profile
+            self.next_profile=(self.profile+1)%len(self.heater_profiles)
+            self.heat_dur=self.heat_durs[self.profile]
+            self.write_pairs(((self.ctrl_gas_1,(1            & 0x01)<<4 |  # run_gas
+                                               (self.profile & 0x0f)<<0),  # nb_conv, heater set-point
+                              (self.ctrl_meas,ctrl_meas)))
+        else:
+            self.write_reg(self.ctrl_meas,ctrl_meas)
+        # time.monotonic() at which the measurement is expected to be done. The heater
+        # runs after the TPH conversions.
+        self.ready_at=time.monotonic()+self.meas_dur+self.heat_dur
+    def poll(self)->bool:
+        """
+        Check if the measurement started by kickoff() is done, without blocking. Before
+        ready_at this doesn't touch the bus at all, after it this reads new_data_0.
+
+        :return: True if the result is ready to read with query()
+        """
+        if time.monotonic()<self.ready_at:
+            return False
+        return bool((self.read_reg(self.meas_status_0) >> 7) & 0x01)
     def wait_ready(self,delay=0.01)->int:
         """
+        Block until the measurement is done. Sleeps until ready_at, then checks new_data_0.
 
-        :param delay: Delay in seconds between checking for ready
+        :param delay: Delay in seconds between checks if the measurement isn't done at ready_at
         :return: Number of times around the loop
         """
-        time.sleep(delay)
-        ready=self.read_reg(self.meas_status_0)
+        time.sleep(max(0.0,self.ready_at-time.monotonic()))
         result=0
-        while not bool((ready >> 7) & 0x01):
+        while not self.poll():
             time.sleep(delay)
             result+=1
-            ready = self.read_reg(self.meas_status_0)
         return result
-    def calibrate_T(self,rT:int):
+    async def wait_ready_async(self,delay=0.001)->int:
+        """
+        Awaitable version of wait_ready(), which lets other tasks use the bus while the
+        measurement runs.
+
+        :param delay: Delay in seconds between checks if the measurement isn't done at ready_at
+        :return: Number of times around the loop
+        """
+        await asyncio.sleep(max(0.0,self.ready_at-time.monotonic()))
+        result=0
+        while not self.poll():
+            await asyncio.sleep(delay)
+            result+=1
+        return result
+    def calibrate_T(self,rT:int,res:bool=False):
         """
 
-        :param rT:
-        :return:
+        :param rT: Raw temperature
+        :param res: If true, also return the resolution dT/drT
+        :return: Tuple of (T, t_fine), or (T, t_fine, dT) if res is set
         """
-        var1 = (((float(rT) / 16384.0) - (float(self.par_t1) / 1024.0)) * (float(self.par_t2)))
+        c=self.coef
+        rT=float(rT)
+        var1 = (((rT / 16384.0) - c.t1_1024) * c.t2)
 
         # calculate var2 data
-        var2 = ((((float(rT) / 131072.0) - (float(self.par_t1) / 8192.0)) *
-                 ((float(rT) / 131072.0) - (float(self.par_t1) / 8192.0))) * (float(self.par_t3) * 16.0))
+        x = ((rT / 131072.0) - c.t1_8192)
+        var2 = ((x * x) * c.t3_16)
 
         # t_fine value, used as temperature for other measurements
         t_fine = (var1 + var2)
 
         # compensated temperature data
         T = ((t_fine) / 5120.0)
+        if res:
+            return T,t_fine,c.dT_a+x*c.dT_b
         return T,t_fine
-    def calibrate_P(self,rP:int,t_fine:float):
+    def calibrate_P(self,rP:int,t_fine:float,res:bool=False):
+        """
+
+        :param rP: Raw pressure
+        :param t_fine: Fine temperature from calibrate_T()
+        :param res: If true, also return the resolution dP/drP
+        :return: P, or tuple of (P, dP) if res is set
+        """
         # Pressure calibration from same file, float calc_pressure()
+        c=self.coef
         var1 = ((float(t_fine) / 2.0) - 64000.0)
-        var2 = var1 * var1 * ((float(self.par_p6)) / (131072.0))
-        var2 = var2 + (var1 * (float(self.par_p5)) * 2.0)
-        var2 = (var2 / 4.0) + ((float(self.par_p4)) * 65536.0)
-        var1 = ((((float(self.par_p3) * var1 * var1) / 16384.0) + (float(self.par_p2) * var1)) / 524288.0)
-        var1 = ((1.0 + (var1 / 32768.0)) * (float(self.par_p1)))
+        var2 = var1 * var1 * c.p6_131072
+        var2 = var2 + (var1 * c.p5 * 2.0)
+        var2 = (var2 / 4.0) + c.p4_65536
+        var1 = ((((c.p3 * var1 * var1) / 16384.0) + (c.p2 * var1)) / 524288.0)
+        var1 = ((1.0 + (var1 / 32768.0)) * c.p1)
         P = (1048576.0 - (float(rP)))
 
         # Avoid exception caused by division by zero */
         if int(var1) != 0:
             P = (((P - (var2 / 4096.0)) * 6250.0) / var1)
-            var1 = ((float(self.par_p9)) * P * P) / 2147483648.0;
-            var2 = P * ((float(self.par_p8)) / 32768.0);
-            var3 = ((P / 256.0) * (P / 256.0) * (P / 256.0) * (self.par_p10 / 131072.0));
-            P = (P + (var1 + var2 + var3 + (float(self.par_p7) * 128.0)) / 16.0);
+            # Derivative of the second stage with respect to the first, times
+            # the derivative of the first stage with respect to rP
+            dP = (1.0 + (P * c.dP_a + c.p8_32768 + P * P * c.dP_b) / 16.0) * (-6250.0 / var1) if res else None
+            var1 = (c.p9 * P * P) / 2147483648.0;
+            var2 = P * c.p8_32768;
+            var3 = ((P / 256.0) * (P / 256.0) * (P / 256.0) * c.p10_131072);
+            P = (P + (var1 + var2 + var3 + c.p7_128) / 16.0);
         else:
             P = 0
+            dP = 0.0
+        if res:
+            return P,dP
         return P
-    def calibrate_h(self,rh:int,T:float):
-        var1 = (float(float(rh)) -
-                ((float(self.par_h1) * 16.0) + ((float(self.par_h3) / 2.0) * T)))
-        var2 = var1 * (((float(self.par_h2) / 262144.0) *
-                        (1.0 + ((float(self.par_h4) / 16384.0) * T) +
-                         ((float(self.par_h5) / 1048576.0) * T * T))))
-        var3 = float(self.par_h6) / 16384.0
-        var4 = float(self.par_h7) / 2097152.0
-        h = var2 + ((var3 + (var4 * T)) * var2 * var2)
+    def calibrate_h(self,rh:int,T:float,res:bool=False):
+        """
+
+        :param rh: Raw humidity
+        :param T: Temperature in degC from calibrate_T()
+        :param res: If true, also return the resolution dh/drh
+        :return: h, or tuple of (h, dh) if res is set
+        """
+        c=self.coef
+        var1 = (float(rh) - (c.h1_16 + (c.h3_2 * T)))
+        k = (c.h2_262144 * (1.0 + (c.h4_16384 * T) + ((c.h5_1048576 * T) * T)))
+        var2 = var1 * k
+        var34 = c.h6_16384 + (c.h7_2097152 * T)
+        h = var2 + (var34 * var2 * var2)
+        dh = k * (1.0 + 2.0 * var34 * var2)
         if (h > 100.0):
             h = 100.0
+            dh = 0.0
         elif (h < 0.0):
             h = 0.0
+            dh = 0.0
+        if res:
+            return h,dh
         return h
 
-    def query(self,rekick:bool=True,cal:bool=True):
+    def query(self,rekick:bool=True,cal:bool=True,res:bool=True):
         """
         :param rekick: Kick off a new measurement as soon as this one is done
-        :return: Raw t, p, and h
+        :param cal: Calibrate the raw values into physical units
+        :param res: Calculate the resolution of each calibrated value. If false, resolutions are None
+        :return: Raw t, p, and h. With gas enabled, the gas measurement is read in the same
+                 burst and left in self.gas as a GasResult.
         """
-        pres_msb,pres_lsb,pres_xlsb,temp_msb,temp_lsb,temp_xlsb,hum_msb,hum_lsb=self.read_reg(self.pres_msb,8)
+        if self.inst is not None:
+            t0=time.perf_counter_ns()
+        if self.heater_profiles:
+            rP,rT,rh,gas_adc,gas_range,gas_valid,heat_stab=self.data.read(self)
+            self.gas=GasResult(self.profile,gas_adc,gas_range,bool(gas_valid),bool(heat_stab),
+                               self.calibrate_gas(gas_adc,gas_range) if cal else None)
+        else:
+            rP,rT,rh=self.data.read(self)
+        # The TPH conversion ran for meas_dur, before heat_dur of gas heating up to ready_at,
+        # so date it from there rather than reading the clock
+        self.sample_time=self.ready_at-self.heat_dur-0.5*self.meas_dur
 
         if rekick:
             self.kickoff()
-        rP=(pres_msb<<12 | pres_lsb<<4 | pres_xlsb>>4)
-        rT=(temp_msb<<12|temp_lsb<<4|temp_xlsb>>4)
-        rh=(hum_msb<<8|hum_lsb)
         if not cal:
-            return rP,None,1,rT,None,1,rh,None,1
+            result=rP,None,1,rT,None,1,rh,None,1
         else:
             # Code from https://github.com/BoschSensortec/BME68x-Sensor-API/blob/master/bme68x.c::float calc_temperature()
             # which is just a transcription of the datasheet, copied here to avoid transcription errors.
             # BME680 and BME688 use the same registers and formulas, but the calibration coefficients are documented
             # only in the BME688 datasheet, pp23-
             # calculate var1 data
-            T,t_fine=self.calibrate_T(rT)
-            dT=self.calibrate_T(rT+1)[0]-T
-
-            P=self.calibrate_P(rP,t_fine)
-            dP=self.calibrate_P(rP+1,t_fine)-P
-
-            # Humidity, ibid, floaf calc_humidity()
-            h=self.calibrate_h(rh,T)
-            dh=self.calibrate_h(rh+1,T)-h
-            return rP,P,dP,rT,T,dT,rh,h,dh
+            # Resolutions are the derivative of each formula with respect to its raw count,
+            # IE the change in calibrated value for a 1DN change in raw value.
+            if not res:
+                T,t_fine=self.calibrate_T(rT)
+                P=self.calibrate_P(rP,t_fine)
+                # Humidity, ibid, floaf calc_humidity()
+                h=self.calibrate_h(rh,T)
+                result=rP,P,None,rT,T,None,rh,h,None
+            else:
+                T,t_fine,dT=self.calibrate_T(rT,res=True)
+                P,dP=self.calibrate_P(rP,t_fine,res=True)
+                h,dh=self.calibrate_h(rh,T,res=True)
+                result=rP,P,dP,rT,T,dT,rh,h,dh
+        if self.inst is not None:
+            self.inst.record_query(self.inst_name,t0)
+        return result
 
 def main():
     """
@@ -238,7 +727,7 @@ def main():
     spi.mode = 0b00
 
     bme = BME680(spi)
-    bme.begin()
+    bme.begin(verify=True,verbose=True)
     print(f'Chip ID (should be 0x61): 0x{bme.whoami():02x}')
     while True:
         print(bme.wait_ready())
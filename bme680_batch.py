@@ -0,0 +1,90 @@
+"""
+Array versions of the BME680 compensation formulas, for reprocessing logs of
+raw counts. These are transcriptions of BME680.calibrate_T(), calibrate_P()
+and calibrate_h(), with each operation done in the same order so that the
+float64 results match the scalar methods bit-for-bit. The scalar methods
+remain the reference -- if one changes, change the other to match.
+
+All functions take a BME680Cal record and broadcast over NumPy arrays of raw counts.
+"""
+import numpy as np
+
+from bme680 import BME680Cal
+
+
+def calibrate_T(cal:BME680Cal,rT:np.ndarray)->[np.ndarray,np.ndarray]:
+    """
+    :param cal: Calibration coefficients
+    :param rT: Raw temperature counts
+    :return: Tuple of (temperature in degC, t_fine)
+    """
+    rT=np.asarray(rT,dtype=np.float64)
+    var1 = (((rT / 16384.0) - (float(cal.par_t1) / 1024.0)) * (float(cal.par_t2)))
+    var2 = ((((rT / 131072.0) - (float(cal.par_t1) / 8192.0)) *
+             ((rT / 131072.0) - (float(cal.par_t1) / 8192.0))) * (float(cal.par_t3) * 16.0))
+    t_fine = (var1 + var2)
+    T = ((t_fine) / 5120.0)
+    return T,t_fine
+
+
+def calibrate_P(cal:BME680Cal,rP:np.ndarray,t_fine:np.ndarray)->np.ndarray:
+    """
+    :param cal: Calibration coefficients
+    :param rP: Raw pressure counts
+    :param t_fine: Fine temperature from calibrate_T()
+    :return: Pressure in Pa. Samples where the scalar code would divide by zero are 0.
+    """
+    rP=np.asarray(rP,dtype=np.float64)
+    t_fine=np.asarray(t_fine,dtype=np.float64)
+    var1 = ((t_fine / 2.0) - 64000.0)
+    var2 = var1 * var1 * ((float(cal.par_p6)) / (131072.0))
+    var2 = var2 + (var1 * (float(cal.par_p5)) * 2.0)
+    var2 = (var2 / 4.0) + ((float(cal.par_p4)) * 65536.0)
+    var1 = ((((float(cal.par_p3) * var1 * var1) / 16384.0) + (float(cal.par_p2) * var1)) / 524288.0)
+    var1 = ((1.0 + (var1 / 32768.0)) * (float(cal.par_p1)))
+    P = (1048576.0 - rP)
+
+    # Same guard as the scalar int(var1)!=0, as a mask. Masked-out samples
+    # divide by 1 instead of 0, then get overwritten.
+    ok = np.trunc(var1) != 0
+    var1 = np.where(ok,var1,1.0)
+    P = (((P - (var2 / 4096.0)) * 6250.0) / var1)
+    var1 = ((float(cal.par_p9)) * P * P) / 2147483648.0
+    var2 = P * ((float(cal.par_p8)) / 32768.0)
+    var3 = ((P / 256.0) * (P / 256.0) * (P / 256.0) * (cal.par_p10 / 131072.0))
+    P = (P + (var1 + var2 + var3 + (float(cal.par_p7) * 128.0)) / 16.0)
+    return np.where(ok,P,0.0)
+
+
+def calibrate_h(cal:BME680Cal,rh:np.ndarray,T:np.ndarray)->np.ndarray:
+    """
+    :param cal: Calibration coefficients
+    :param rh: Raw humidity counts
+    :param T: Temperature in degC from calibrate_T()
+    :return: Relative humidity in %, clamped to 0-100
+    """
+    rh=np.asarray(rh,dtype=np.float64)
+    T=np.asarray(T,dtype=np.float64)
+    var1 = (rh -
+            ((float(cal.par_h1) * 16.0) + ((float(cal.par_h3) / 2.0) * T)))
+    var2 = var1 * (((float(cal.par_h2) / 262144.0) *
+                    (1.0 + ((float(cal.par_h4) / 16384.0) * T) +
+                     ((float(cal.par_h5) / 1048576.0) * T * T))))
+    var3 = float(cal.par_h6) / 16384.0
+    var4 = float(cal.par_h7) / 2097152.0
+    h = var2 + ((var3 + (var4 * T)) * var2 * var2)
+    h = np.where(h > 100.0, 100.0, h)
+    h = np.where(h < 0.0, 0.0, h)
+    return h
+
+
+def calibrate(cal:BME680Cal,rP:np.ndarray,rT:np.ndarray,rh:np.ndarray)->[np.ndarray,np.ndarray,np.ndarray]:
+    """
+    Compensate a batch of raw samples, as BME680.query(cal=True) does for one.
+
+    :return: Tuple of (P in Pa, T in degC, h in %)
+    """
+    T,t_fine=calibrate_T(cal,rT)
+    P=calibrate_P(cal,rP,t_fine)
+    h=calibrate_h(cal,rh,T)
+    return P,T,h
@@ -19,11 +19,15 @@ The flow is then as follows:
 * Use the normal SpiDev driver to handle CE0
 """
 
+import time
+
 import RPi.GPIO as GPIO
 
 class ChipSelect:
     def __init__(self,pin0:int=15,pin1:int=13,pin2:int=11):
         self.pins=(pin0,pin1,pin2)
+        # instrument.Instrument recording address switches, or None
+        self.inst=None
     def begin(self):
         GPIO.setmode(GPIO.BOARD)
         GPIO.setup(self.pins,GPIO.OUT,initial=GPIO.HIGH)
@@ -34,7 +38,12 @@ class ChipSelect:
                      GPIO.HIGH if ((addr >> 1) & 0x01)==0x01 else GPIO.LOW,
                      GPIO.HIGH if ((addr >> 2) & 0x01)==0x01 else GPIO.LOW,
                      )
+        if self.inst is None:
+            GPIO.output(self.pins,out)
+            return
+        t0=time.perf_counter_ns()
         GPIO.output(self.pins,out)
+        self.inst.record_addr(addr,time.perf_counter_ns()-t0)
 
 def main():
     import time
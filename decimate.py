@@ -0,0 +1,345 @@
+"""
+Streaming decimation and running statistics, so that only reduced-rate
+products need to be stored.
+
+Every stage here works on blocks of samples, (N,channels) arrays such as a
+LSM9DS1_AG.read_fifo() drain or a batch of buffered query() results, and
+carries its state from one block to the next, so splitting a stream into
+blocks differently gives the same output. Block processing is vectorized,
+so the per-sample cost is small once blocks are a few dozen samples long.
+
+* FIRDecimator: windowed-sinc anti-alias filter, evaluated only at the
+  output samples, which is what a polyphase decimator does
+* CICDecimator: multiplierless cascaded integrator-comb, for integer data
+  and large factors
+* RunningStats: mean, variance, min and max per channel since the last reset
+* WindowStats: the same over each non-overlapping window of factor samples
+* DecimatedLog: buffers raw samples, decimates them, and writes the
+  results to a SampleLogWriter in the ordinary record layouts
+
+A timestamp column fed through the same linear filter comes out as the
+time of the centre of the filter, IE already corrected for its delay.
+DecimatedLog uses this to timestamp its output.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from sample_log import DEV_BME680, DEV_LSM9DS1, SampleLogWriter, record_blocks
+
+
+def lowpass_taps(factor:int,n_taps:int=None,cutoff:float=0.8)->np.ndarray:
+    """
+    Design an anti-alias filter for decimation
+
+    :param factor: Decimation factor
+    :param n_taps: Filter length, default 8*factor+1
+    :param cutoff: Cutoff as a fraction of the output Nyquist frequency
+    :return: Hamming-windowed sinc lowpass taps, normalized to unity gain at DC
+    """
+    if n_taps is None:
+        n_taps=8*factor+1
+    n=np.arange(n_taps)-(n_taps-1)/2
+    fc=cutoff*0.5/factor # cycles per input sample
+    taps=2*fc*np.sinc(2*fc*n)*np.hamming(n_taps)
+    return taps/taps.sum()
+
+
+class FIRDecimator:
+    def __init__(self,factor:int,n_channels:int,taps:np.ndarray=None):
+        """
+
+        :param factor: Decimation factor
+        :param n_channels: Number of columns in each block
+        :param taps: FIR taps, default lowpass_taps(factor)
+        """
+        self.factor=factor
+        self.n_channels=n_channels
+        self.taps=lowpass_taps(factor) if taps is None else np.asarray(taps,dtype=np.float64)
+        self.taps_rev=np.ascontiguousarray(self.taps[::-1])
+        # Output delay, in input samples
+        self.delay=(len(self.taps)-1)/2
+        # The history starts out as copies of the first sample, which keeps the startup
+        # transient small, but outputs aren't exact until the window is all real input
+        self.n_settle=-(-(len(self.taps)-1)//factor)
+        self.history=None
+        # Index, in history+next block, of the newest input sample under the next output
+        self.next=len(self.taps)-1
+    def process(self,block)->np.ndarray:
+        """
+        :param block: Input samples, anything NumPy can reshape to (N,n_channels)
+        :return: (K,n_channels) float64 output samples, K about N/factor
+        """
+        x=np.asarray(block,dtype=np.float64).reshape(-1,self.n_channels)
+        if len(x)==0:
+            return np.zeros((0,self.n_channels))
+        n_hist=len(self.taps)-1
+        if self.history is None:
+            self.history=np.repeat(x[:1],n_hist,axis=0)
+        x=np.concatenate((self.history,x))
+        pos=np.arange(self.next,len(x),self.factor)
+        # windows[i] is x[i:i+n_taps], as (channels,n_taps)
+        windows=sliding_window_view(x,len(self.taps),axis=0)
+        result=windows[pos-n_hist]@self.taps_rev
+        self.next=(pos[-1]+self.factor if len(pos)>0 else self.next)-(len(x)-n_hist)
+        self.history=x[len(x)-n_hist:]
+        return result
+
+
+class CICDecimator:
+    def __init__(self,factor:int,n_channels:int,order:int=3):
+        """
+        Integer data only. Integrators wrap in int64, which the combs undo, so they never overflow.
+
+        :param factor: Decimation factor
+        :param n_channels: Number of columns in each block
+        :param order: Number of integrator and comb stages
+        """
+        self.factor=factor
+        self.n_channels=n_channels
+        self.order=order
+        self.gain=factor**order
+        # Output delay, in input samples
+        self.delay=order*(factor-1)/2
+        # The combs start from zero, so the first order outputs are a transient
+        self.n_settle=order
+        self.integ=np.zeros((order,n_channels),dtype=np.int64)
+        self.comb=np.zeros((order,n_channels),dtype=np.int64)
+        # Input samples since the last output
+        self.count=0
+    def process(self,block)->np.ndarray:
+        """
+        :param block: Integer input samples, anything NumPy can reshape to (N,n_channels)
+        :return: (K,n_channels) float64 output samples, scaled to unity gain at DC
+        """
+        x=np.asarray(block,dtype=np.int64).reshape(-1,self.n_channels)
+        n=len(x)
+        with np.errstate(over='ignore'):
+            for i in range(self.order):
+                x=np.cumsum(x,axis=0)+self.integ[i]
+                if n>0:
+                    self.integ[i]=x[-1]
+            y=x[self.factor-1-self.count::self.factor]
+            self.count=(self.count+n)%self.factor
+            for i in range(self.order):
+                if len(y)==0:
+                    break
+                last=y[-1].copy()
+                y=np.diff(y,axis=0,prepend=self.comb[i][None,:])
+                self.comb[i]=last
+        return y/self.gain
+
+
+class RunningStats:
+    def __init__(self,n_channels:int):
+        """
+        Mean, variance, min and max of each channel, merged a block at a time
+
+        :param n_channels: Number of columns in each block
+        """
+        self.n_channels=n_channels
+        self.reset()
+    def reset(self):
+        self.n=0
+        self.mean=np.zeros(self.n_channels)
+        self.m2=np.zeros(self.n_channels) # Sum of squared differences from the mean
+        self.min=np.full(self.n_channels,np.inf)
+        self.max=np.full(self.n_channels,-np.inf)
+    def update(self,block):
+        """
+        :param block: Samples, anything NumPy can reshape to (N,n_channels)
+        """
+        x=np.asarray(block,dtype=np.float64).reshape(-1,self.n_channels)
+        n=len(x)
+        if n==0:
+            return
+        mean=x.mean(axis=0)
+        m2=((x-mean)**2).sum(axis=0)
+        # Chan et al. parallel combination of the block with what came before
+        total=self.n+n
+        delta=mean-self.mean
+        self.mean=self.mean+delta*(n/total)
+        self.m2=self.m2+m2+delta*delta*(self.n*n/total)
+        self.n=total
+        self.min=np.minimum(self.min,x.min(axis=0))
+        self.max=np.maximum(self.max,x.max(axis=0))
+    def var(self,ddof:int=1)->np.ndarray:
+        """
+        :param ddof: Delta degrees of freedom, as numpy.var(). Default is the sample variance.
+        """
+        return self.m2/(self.n-ddof) if self.n>ddof else np.full(self.n_channels,np.nan)
+    def summary(self,names=None)->dict:
+        """
+        :param names: Channel names, default channel numbers
+        :return: Dictionary by channel of n, mean, var, min, max
+        """
+        if names is None:
+            names=range(self.n_channels)
+        var=self.var()
+        return {name:{'n':self.n,'mean':float(self.mean[i]),'var':float(var[i]),
+                      'min':float(self.min[i]),'max':float(self.max[i])}
+                for i,name in enumerate(names)}
+
+
+class WindowStats:
+    def __init__(self,factor:int,n_channels:int):
+        """
+        Mean, variance, min and max of each channel over consecutive windows of factor samples
+
+        :param factor: Window length
+        :param n_channels: Number of columns in each block
+        """
+        self.factor=factor
+        self.n_channels=n_channels
+        self.partial=np.zeros((0,n_channels))
+    def process(self,block)->tuple:
+        """
+        :param block: Samples, anything NumPy can reshape to (N,n_channels)
+        :return: Tuple of (mean, var, min, max), each (K,n_channels) for the K windows
+                 completed by this block. var is the population variance.
+        """
+        x=np.concatenate((self.partial,np.asarray(block,dtype=np.float64).reshape(-1,self.n_channels)))
+        k=len(x)//self.factor
+        self.partial=x[k*self.factor:]
+        windows=x[:k*self.factor].reshape(k,self.factor,self.n_channels)
+        return windows.mean(axis=1),windows.var(axis=1),windows.min(axis=1),windows.max(axis=1)
+
+
+class DecimationStage:
+    def __init__(self,factor:int,names,filter:str='fir',**kwargs):
+        """
+        Anti-alias filter and decimate a set of named channels, and keep running statistics of the input
+
+        :param factor: Decimation factor
+        :param names: Channel names, in column order
+        :param filter: 'fir' for FIRDecimator or 'cic' for CICDecimator
+        :param kwargs: Passed to the decimator
+        """
+        self.names=tuple(names)
+        decimator={'fir':FIRDecimator,'cic':CICDecimator}[filter]
+        self.decimator=decimator(factor,len(self.names),**kwargs)
+        self.stats=RunningStats(len(self.names))
+    def process(self,block)->np.ndarray:
+        """
+        :param block: Input samples, (N,len(names))
+        :return: Decimated samples, (K,len(names))
+        """
+        self.stats.update(block)
+        return self.decimator.process(block)
+
+
+# Channels of each device, in record_blocks order without status_g
+imu_channels=('T','gx','gy','gz','ax','ay','az')
+bme680_channels=('rP','rT','rh')
+
+
+def imu_stage(factor:int,filter:str='fir',**kwargs)->DecimationStage:
+    """
+    :return: Stage for LSM9DS1 samples, in the column order of query() without status_g.
+             For read_fifo() blocks, which have no temperature, use DecimationStage(factor,imu_cal.columns).
+    """
+    return DecimationStage(factor,imu_channels,filter,**kwargs)
+
+
+def bme680_stage(factor:int,filter:str='fir',**kwargs)->DecimationStage:
+    """
+    :return: Stage for BME680 raw counts. Compensation is smooth enough that
+             compensating the decimated counts matches decimating the compensated values.
+    """
+    return DecimationStage(factor,bme680_channels,filter,**kwargs)
+
+
+class DecimatedLog:
+    def __init__(self,writer:SampleLogWriter,factors:dict,filter:str='fir',block_len:int=256):
+        """
+        Decimate samples on their way into a log. Records keep the usual layouts, at the
+        reduced rate, with status_g written as 0. Put factors in the log metadata as
+        'decimation' so readers know the rate. Running statistics of the full-rate input
+        are available from stats(), and close() adds them to the log metadata as 'stats'.
+
+        :param writer: Log to write to
+        :param factors: Decimation factor by device name, 'lsm9ds1' and/or 'bme680'.
+                        Devices not listed are written at full rate.
+        :param filter: 'fir' or 'cic'
+        :param block_len: Number of samples to buffer per device before decimating them together
+        """
+        self.writer=writer
+        self.block_len=block_len
+        self.stages={}
+        self.names={}
+        self.bufs={}
+        self.n_buf={}
+        self.n_out={}
+        # Timestamps go through the filter as an extra channel, relative to the first one
+        # so that CIC integrators don't overflow
+        self.t0_ns=None
+        for device,name,channels in ((DEV_LSM9DS1,'lsm9ds1',imu_channels),(DEV_BME680,'bme680',bme680_channels)):
+            if factors.get(name,1)>1:
+                self.stages[device]=DecimationStage(factors[name],channels+('t_ns',),filter)
+                self.names[device]=name
+                self.bufs[device]=np.zeros((block_len,len(channels)+1),dtype=np.int64)
+                self.n_buf[device]=0
+                self.n_out[device]=0
+    def add(self,device:int,t_ns:int,*values):
+        """
+        :param device: Device tag, DEV_*
+        :param t_ns: Timestamp, time.monotonic_ns()
+        :param values: Payload fields in record_blocks order
+        """
+        if device not in self.stages:
+            self.writer.write(device,t_ns,*values)
+            return
+        if device==DEV_LSM9DS1:
+            values=values[1:] # Drop status_g
+        if self.t0_ns is None:
+            self.t0_ns=t_ns
+        row=self.bufs[device][self.n_buf[device]]
+        row[:-1]=values
+        row[-1]=t_ns-self.t0_ns
+        self.n_buf[device]+=1
+        if self.n_buf[device]==self.block_len:
+            self.flush_device(device)
+    def write_bme680(self,t_ns:int,rP:int,rT:int,rh:int):
+        self.add(DEV_BME680,t_ns,rP,rT,rh)
+    def write_lsm9ds1(self,t_ns:int,sample:tuple):
+        self.add(DEV_LSM9DS1,t_ns,*sample)
+    def flush_device(self,device:int):
+        y=self.stages[device].process(self.bufs[device][:self.n_buf[device]])
+        self.n_buf[device]=0
+        settle=max(0,self.stages[device].decimator.n_settle-self.n_out[device])
+        self.n_out[device]+=len(y)
+        y=np.rint(y[settle:])
+        if len(y)==0:
+            return
+        block=record_blocks[device]
+        records=np.zeros(len(y),dtype=block.dtype())
+        records['t_ns']=y[:,-1]+self.t0_ns
+        records['device']=device
+        for i,name in enumerate(self.stages[device].names[:-1]):
+            # Filter overshoot can go past the field's range
+            limits=np.iinfo(records.dtype[name])
+            records[name]=np.clip(y[:,i],limits.min,limits.max)
+        self.writer.write_records(records.tobytes())
+    def flush(self):
+        """
+        Decimate whatever is buffered. Output continues seamlessly with later samples.
+        """
+        for device in self.stages:
+            if self.n_buf[device]>0:
+                self.flush_device(device)
+        self.writer.flush()
+    def stats(self)->dict:
+        """
+        :return: Dictionary by device name of RunningStats.summary() of the raw input
+                 channels, for devices with any samples so far
+        """
+        return {self.names[device]:stage.stats.summary(stage.names[:-1])
+                for device,stage in self.stages.items() if stage.stats.n>0}
+    def close(self):
+        self.flush()
+        stats=self.stats()
+        if stats:
+            try:
+                self.writer.update_meta(dict(self.writer.meta,stats=stats))
+            except ValueError:
+                pass # Too big for the header. The log itself is still good.
+        self.writer.close()
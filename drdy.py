@@ -0,0 +1,84 @@
+"""
+Interrupt-driven acquisition. Wire the LSM9DS1 INT1_A/G pin to a Pi GPIO,
+route data-ready or FIFO-threshold to it with LSM9DS1_AG.enable_int1(), and
+a DataReadyTrigger turns each active edge into a timestamp in a queue. The
+acquisition loop blocks on the queue, so the CPU sleeps between samples and
+reads start as soon as the sensor has data.
+
+Data-ready is a level, active until the data is read, so an edge can only be
+missed if a read is skipped. If no edge arrives within the timeout, acquire()
+reads anyway, which clears the level and restarts the edges.
+"""
+import queue
+import time
+from typing import Callable
+
+import RPi.GPIO as GPIO
+
+
+class DataReadyTrigger:
+    def __init__(self,pin:int,active_low:bool=False,maxsize:int=1024):
+        """
+
+        :param pin: GPIO pin (BOARD numbering, as ChipSelect) connected to the interrupt line
+        :param active_low: Interrupt line is active low, matching begin(int_active_low=True)
+        :param maxsize: Maximum number of edges to hold. Edges beyond this are counted in n_dropped.
+        """
+        self.pin=pin
+        self.active_low=active_low
+        self.queue=queue.Queue(maxsize)
+        self.n_events=0
+        self.n_dropped=0
+    def begin(self):
+        GPIO.setmode(GPIO.BOARD)
+        GPIO.setup(self.pin,GPIO.IN,pull_up_down=GPIO.PUD_UP if self.active_low else GPIO.PUD_DOWN)
+        GPIO.add_event_detect(self.pin,GPIO.FALLING if self.active_low else GPIO.RISING,callback=self.callback)
+    def end(self):
+        GPIO.remove_event_detect(self.pin)
+    def callback(self,channel:int):
+        """
+        Called by RPi.GPIO on its own thread on each active edge
+        """
+        self.n_events+=1
+        try:
+            self.queue.put_nowait(time.monotonic_ns())
+        except queue.Full:
+            self.n_dropped+=1
+    def wait(self,timeout:float=None)->int:
+        """
+        :param timeout: Maximum time to wait in seconds, or None to wait forever
+        :return: time.monotonic_ns() of the edge, or None on timeout
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+def acquire(ag,trigger:DataReadyTrigger,sink:Callable,fifo:bool=False,timeout:float=None,count:int=None):
+    """
+    Read the LSM9DS1 each time it signals.
+
+    :param ag: LSM9DS1_AG, after begin() and enable_int1(). If fifo is set, also after begin_fifo().
+    :param trigger: DataReadyTrigger, after begin()
+    :param sink: Function called as sink(t_ns,data) with the edge time, and either the
+                 query(burst=True) tuple or the read_fifo() block. t_ns is None if the read
+                 was triggered by the timeout.
+    :param fifo: Drain the FIFO on each edge (for FIFO threshold interrupts) instead of reading one sample
+    :param timeout: Time to wait for an edge before reading anyway. Default is four sample
+                    periods, or four FIFO fill times, at the gyro rate or, with the gyro
+                    powered down, the accelerometer rate. Required if both are powered down.
+    :param count: Stop after this many reads, or None to run forever
+    """
+    if timeout is None:
+        odr=ag.odr_g or ag.odr_a
+        if not odr:
+            raise ValueError("LSM9DS1 is powered down, so acquire() needs an explicit timeout")
+        timeout=4.0*(ag.FIFO_DEPTH if fifo else 1)/odr
+    n=0
+    while count is None or n<count:
+        t_ns=trigger.wait(timeout)
+        data=ag.read_fifo() if fifo else ag.query(burst=True)
+        n+=1
+        if data is not None and len(data)>0:
+            sink(t_ns,data)
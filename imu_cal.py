@@ -0,0 +1,139 @@
+"""
+Calibration of LSM9DS1 gyro and accelerometer samples into SI units, a
+block at a time. A block is an (N,6) array of raw DN in the column order
+gx, gy, gz, ax, ay, az -- the order of a LSM9DS1_AG.read_fifo() drain, which
+can be passed as-is, and of columns 2:8 of query() tuples.
+
+The model for each sensor is
+
+    si = M @ (s * raw) - bias
+
+where s is the nominal sensitivity for the full scale in use, M is a 3x3
+scale/misalignment matrix (identity if not given) and bias is a 3-vector
+in SI units. Both sensors are folded into one 6x6 block-diagonal matrix and
+one offset, so converting a block is a single matrix multiply.
+"""
+from typing import NamedTuple
+
+import numpy as np
+
+columns=('gx','gy','gz','ax','ay','az')
+
+
+class BiasEstimate(NamedTuple):
+    gyro_bias:np.ndarray # rad/s
+    acc_bias:np.ndarray # m/s**2
+    std:np.ndarray # Standard deviation of each column in SI units, to check the batch was stationary
+    n:int
+
+
+class IMUCal:
+    def __init__(self,gyro_scale:float,acc_scale:float,
+                 gyro_bias=None,acc_bias=None,gyro_matrix=None,acc_matrix=None):
+        """
+
+        :param gyro_scale: Nominal gyro sensitivity in rad/s per DN
+        :param acc_scale: Nominal accelerometer sensitivity in m/s**2 per DN
+        :param gyro_bias: Gyro bias in rad/s, 3 values. Default is zero.
+        :param acc_bias: Accelerometer offset in m/s**2, 3 values. Default is zero.
+        :param gyro_matrix: 3x3 gyro scale/misalignment matrix. Default is identity.
+        :param acc_matrix: 3x3 accelerometer scale/misalignment matrix. Default is identity.
+        """
+        self.gyro_scale=gyro_scale
+        self.acc_scale=acc_scale
+        self.gyro_bias=np.zeros(3) if gyro_bias is None else np.asarray(gyro_bias,dtype=np.float64)
+        self.acc_bias=np.zeros(3) if acc_bias is None else np.asarray(acc_bias,dtype=np.float64)
+        self.gyro_matrix=np.eye(3) if gyro_matrix is None else np.asarray(gyro_matrix,dtype=np.float64)
+        self.acc_matrix=np.eye(3) if acc_matrix is None else np.asarray(acc_matrix,dtype=np.float64)
+        # si = raw @ matrix.T - offset, with everything folded together
+        self.matrix=np.zeros((6,6))
+        self.matrix[:3,:3]=self.gyro_matrix*gyro_scale
+        self.matrix[3:,3:]=self.acc_matrix*acc_scale
+        self.matrix_t=np.ascontiguousarray(self.matrix.T)
+        self.offset=np.concatenate((self.gyro_bias,self.acc_bias))
+    @classmethod
+    def from_sensor(cls,ag,**kwargs)->"IMUCal":
+        """
+        :param ag: LSM9DS1_AG after begin()
+        :param kwargs: Biases and matrices, as in the constructor
+        """
+        return cls(ag.gyro_scale,ag.acc_scale,**kwargs)
+    @classmethod
+    def from_meta(cls,meta:dict,**kwargs)->"IMUCal":
+        """
+        :param meta: The 'lsm9ds1' entry of sample_log.sensor_meta()
+        :param kwargs: Biases and matrices, as in the constructor
+        """
+        from lsm9ds1 import LSM9DS1_AG
+        fs_g=LSM9DS1_AG.fs_gs.index(meta['fs_g'])
+        fs_a=LSM9DS1_AG.fs_as.index(meta['fs_a'])
+        return cls(LSM9DS1_AG.gyro_sens[fs_g]*np.pi/180,LSM9DS1_AG.acc_sens[fs_a]*LSM9DS1_AG.g,**kwargs)
+    def with_bias(self,est:BiasEstimate)->"IMUCal":
+        """
+        :param est: Result of estimate_bias()
+        :return: Copy of this calibration with the estimated biases added to its own
+        """
+        return IMUCal(self.gyro_scale,self.acc_scale,
+                      self.gyro_bias+est.gyro_bias,self.acc_bias+est.acc_bias,
+                      self.gyro_matrix,self.acc_matrix)
+    def apply(self,raw)->np.ndarray:
+        """
+        :param raw: Raw DN, anything NumPy can reshape to (N,6) in column order gx..az,
+                    for instance the array('h') from LSM9DS1_AG.read_fifo()
+        :return: (N,6) float64 array of gx, gy, gz in rad/s and ax, ay, az in m/s**2
+        """
+        raw=np.asarray(raw).reshape(-1,6)
+        return raw@self.matrix_t-self.offset
+    def to_dict(self)->dict:
+        """
+        :return: Parameters as a JSON-friendly dict, which the constructor takes back as keywords
+        """
+        return {'gyro_scale':self.gyro_scale,'acc_scale':self.acc_scale,
+                'gyro_bias':self.gyro_bias.tolist(),'acc_bias':self.acc_bias.tolist(),
+                'gyro_matrix':self.gyro_matrix.tolist(),'acc_matrix':self.acc_matrix.tolist()}
+
+
+def raw_block(records)->np.ndarray:
+    """
+    :param records: Structured array with fields gx..az, for instance from
+                    sample_log.SampleLogReader.lsm9ds1()
+    :return: (N,6) int16 array for IMUCal.apply()
+    """
+    return np.stack([records[column] for column in columns],axis=1)
+
+
+def estimate_bias(raw,cal:IMUCal,gravity_axis:int=None,g:float=9.80665)->BiasEstimate:
+    """
+    Estimate gyro bias and accelerometer offset from a batch of samples taken
+    with the sensor stationary, in one pass over the batch.
+
+    The gyro should read zero, so its bias is just its mean. The accelerometer
+    should read g along one axis and zero along the others; its offset is the
+    difference from that. Any tilt away from the gravity axis shows up as offset,
+    so level the sensor first.
+
+    :param raw: Raw DN, (N,6) as for IMUCal.apply()
+    :param cal: Calibration to estimate on top of, usually IMUCal.from_sensor()
+                with no biases. Add the result with cal.with_bias().
+    :param gravity_axis: Accelerometer axis pointing up or down, 0-2 for x-z. The sign
+                         is taken from the data. Default is the axis with the largest mean.
+    :param g: Local acceleration of gravity in m/s**2
+    :return: BiasEstimate
+    """
+    raw=np.asarray(raw).reshape(-1,6)
+    n=len(raw)
+    # Sum and sum of squares together, in float64 so int16 doesn't overflow
+    x=raw.astype(np.float64)
+    total=x.sum(axis=0)
+    total_sq=np.einsum('ij,ij->j',x,x)
+    mean_raw=total/n
+    var_raw=np.maximum(total_sq/n-mean_raw*mean_raw,0.0)
+    mean=cal.apply(mean_raw)[0]
+    # Spread in SI units, scaled by the diagonal of the calibration matrix only
+    std=np.sqrt(var_raw*np.diag(cal.matrix)**2)
+    acc_mean=mean[3:]
+    if gravity_axis is None:
+        gravity_axis=int(np.argmax(np.abs(acc_mean)))
+    expected=np.zeros(3)
+    expected[gravity_axis]=np.copysign(g,acc_mean[gravity_axis])
+    return BiasEstimate(gyro_bias=mean[:3],acc_bias=acc_mean-expected,std=std,n=n)
@@ -0,0 +1,229 @@
+"""
+Opt-in instrumentation of bus traffic. Drivers carry an inst attribute,
+None by default, and only do the bookkeeping when it is set, so the cost
+when disabled is one attribute test per transaction. Attach an Instrument
+to the sensors and chip select to find out where the time goes:
+
+* Every SPI transaction, by device, register and direction: count, bytes
+  and latency
+* BME680 register page switches: count and latency
+* Decoder address switches: count and latency
+* query(): how long each takes (transfers plus compensation), and the
+  interval between successive samples, whose spread is the jitter
+
+Latencies are time.perf_counter_ns() differences, kept in histograms with
+power-of-two buckets. snapshot() exports everything as a JSON-friendly dict,
+and SnapshotWriter appends one to a file periodically.
+"""
+import json
+import math
+import threading
+import time
+
+
+class Histogram:
+    def __init__(self):
+        """
+        Histogram of nanosecond durations. Bucket i counts durations
+        with bit_length() i, IE from 2**(i-1) up to but not including 2**i ns.
+        """
+        self.buckets=[0]*64
+        self.n=0
+        self.total=0
+        self.total_sq=0
+        self.min=None
+        self.max=None
+    def add(self,dt_ns:int):
+        self.buckets[dt_ns.bit_length()]+=1
+        self.n+=1
+        self.total+=dt_ns
+        self.total_sq+=dt_ns*dt_ns
+        if self.min is None or dt_ns<self.min:
+            self.min=dt_ns
+        if self.max is None or dt_ns>self.max:
+            self.max=dt_ns
+    def percentile(self,p:float)->int:
+        """
+        :param p: Percentile, 0-100
+        :return: Upper bound in ns of the bucket holding that percentile, or None if empty
+        """
+        if self.n==0:
+            return None
+        rank=p/100*self.n
+        seen=0
+        for i,count in enumerate(self.buckets):
+            seen+=count
+            if seen>=rank and count>0:
+                return min(1<<i,self.max)
+        return self.max
+    def summary(self)->dict:
+        if self.n==0:
+            return {'n':0}
+        mean=self.total/self.n
+        return {'n':self.n,
+                'mean_ns':mean,
+                'std_ns':math.sqrt(max(self.total_sq/self.n-mean*mean,0.0)),
+                'min_ns':self.min,
+                'max_ns':self.max,
+                'p50_ns':self.percentile(50),
+                'p99_ns':self.percentile(99),
+                'buckets':{1<<i:count for i,count in enumerate(self.buckets) if count>0}}
+
+
+class Counter:
+    def __init__(self):
+        """
+        Count, bytes and latency of one kind of transaction
+        """
+        self.n=0
+        self.n_bytes=0
+        self.latency=Histogram()
+    def add(self,n_bytes:int,dt_ns:int):
+        self.n+=1
+        self.n_bytes+=n_bytes
+        self.latency.add(dt_ns)
+    def summary(self)->dict:
+        return {'n':self.n,'bytes':self.n_bytes,'latency':self.latency.summary()}
+
+
+class Instrument:
+    def __init__(self):
+        self.lock=threading.Lock()
+        # device name -> perf_counter_ns() at the start of the last query() that returned a sample.
+        # Kept across resets, so the first interval of a period isn't lost.
+        self.last_sample={}
+        self.clear()
+    def clear(self):
+        """
+        Start a new period. Call with the lock held.
+        """
+        self.t0_ns=time.perf_counter_ns()
+        # device name -> (register, 'read'/'write') -> Counter
+        self.xfers={}
+        # device name -> Counter
+        self.pages={}
+        # decoder address -> Counter
+        self.addrs={}
+        # device name -> Histogram of query() durations
+        self.query_time={}
+        # device name -> Histogram of intervals between query() calls that returned a sample
+        self.query_interval={}
+    def reset(self):
+        with self.lock:
+            self.clear()
+    def attach(self,*targets,name:str=None)->"Instrument":
+        """
+        Start instrumenting sensors and chip selects
+
+        :param targets: SPI_sensor or ChipSelect objects
+        :param name: Device name to report sensors under, instead of their inst_name,
+                     which defaults to the class name. Only useful when attaching a single sensor.
+        """
+        for target in targets:
+            if name is not None:
+                target.inst_name=name
+            target.inst=self
+        return self
+    @staticmethod
+    def detach(*targets):
+        for target in targets:
+            target.inst=None
+    def record_xfer(self,device:str,buf,dt_ns:int):
+        """
+        :param device: Device name
+        :param buf: Bytes sent, starting with the command/address byte
+        :param dt_ns: Transaction time
+        """
+        key=(buf[0] & 0x7f,'read' if buf[0] & 0x80 else 'write')
+        with self.lock:
+            regs=self.xfers.setdefault(device,{})
+            if key not in regs:
+                regs[key]=Counter()
+            regs[key].add(len(buf),dt_ns)
+    def record_page(self,device:str,dt_ns:int):
+        with self.lock:
+            if device not in self.pages:
+                self.pages[device]=Counter()
+            self.pages[device].add(1,dt_ns)
+    def record_addr(self,addr:int,dt_ns:int):
+        with self.lock:
+            if addr not in self.addrs:
+                self.addrs[addr]=Counter()
+            self.addrs[addr].add(0,dt_ns)
+    def record_query(self,device:str,t0_ns:int,got_sample:bool=True):
+        """
+        :param device: Device name
+        :param t0_ns: perf_counter_ns() at the start of the query
+        :param got_sample: False if the query found no new data
+        """
+        dt_ns=time.perf_counter_ns()-t0_ns
+        with self.lock:
+            if device not in self.query_time:
+                self.query_time[device]=Histogram()
+                self.query_interval[device]=Histogram()
+            self.query_time[device].add(dt_ns)
+            if got_sample:
+                last=self.last_sample.get(device)
+                if last is not None:
+                    self.query_interval[device].add(t0_ns-last)
+                self.last_sample[device]=t0_ns
+    def snapshot(self,reset:bool=False)->dict:
+        """
+        :param reset: Clear everything after taking the snapshot, so that
+                      successive snapshots cover successive periods
+        :return: Everything recorded since the last reset, as a dict that json.dumps() accepts
+        """
+        with self.lock:
+            now=time.perf_counter_ns()
+            result={'t_ns':now,
+                    'period_ns':now-self.t0_ns,
+                    'xfers':{device:{f'0x{reg:02x} {direction}':counter.summary()
+                                     for (reg,direction),counter in sorted(regs.items())}
+                             for device,regs in self.xfers.items()},
+                    'pages':{device:counter.summary() for device,counter in self.pages.items()},
+                    'addrs':{addr:counter.summary() for addr,counter in sorted(self.addrs.items())},
+                    'queries':{device:{'time':self.query_time[device].summary(),
+                                       'interval':self.query_interval[device].summary()}
+                               for device in self.query_time}}
+            if reset:
+                self.clear()
+        return result
+
+
+class SnapshotWriter:
+    def __init__(self,inst:Instrument,filename:str,period:float=10.0,reset:bool=True):
+        """
+        Append a snapshot to a file, one JSON object per line, every period
+        seconds from a background thread
+
+        :param inst: Instrument to snapshot
+        :param filename: File to append to
+        :param period: Time between snapshots in seconds
+        :param reset: Reset the instrument after each snapshot, so each covers one period
+        """
+        self.inst=inst
+        self.filename=filename
+        self.period=period
+        self.reset=reset
+        self.stopped=threading.Event()
+        self.thread=None
+    def write(self):
+        with open(self.filename,'a') as ouf:
+            print(json.dumps(self.inst.snapshot(reset=self.reset)),file=ouf)
+    def run(self):
+        while not self.stopped.wait(self.period):
+            self.write()
+    def start(self)->"SnapshotWriter":
+        self.stopped.clear()
+        self.thread=threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+        return self
+    def stop(self):
+        """
+        Stop the thread, and write a final snapshot of the partial period
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread=None
+        self.write()
@@ -2,14 +2,21 @@
 LSM9DS1 sensor. Since this has two independent SPI interfaces with two
 ~CS lines, treat it as two different sensors.
 """
+import math
+import sys
+import time
+from array import array
 from typing import Sequence
 
 from bits import extract_int16_le, extract_uint16_le, extract_uint16_be
+from regblock import RegBlock, Field
 from spi_sensor import SPI_sensor
 from spidev import SpiDev
 
 
 class LSM9DS1_AG(SPI_sensor):
+    REFERENCE_G  =0x0B
+    INT1_CTRL    =0x0C
     WHO_AM_I     =0x0F
     CTRL_REG1_G  =0x10
     CTRL_REG2_G  =0x11
@@ -26,7 +33,9 @@ class LSM9DS1_AG(SPI_sensor):
     CTRL_REG4    =0x1E
     CTRL_REG5_XL =0x1F
     CTRL_REG6_XL =0x20
+    CTRL_REG7_XL =0x21
     CTRL_REG8    =0x22
+    CTRL_REG9    =0x23
     STATUS_REG_XL=0x27
     OUT_X_L_XL   =0x28
     OUT_X_H_XL   =0x29
@@ -34,9 +43,46 @@ class LSM9DS1_AG(SPI_sensor):
     OUT_Y_H_XL   =0x2B
     OUT_Z_L_XL   =0x2C
     OUT_Z_H_XL   =0x2D
+    FIFO_CTRL    =0x2E
+    FIFO_SRC     =0x2F
+    # Bits in STATUS_REG_G and STATUS_REG_XL
+    XLDA=0x01 # Accelerometer new data available
+    GDA =0x02 # Gyroscope new data available
+    TDA =0x04 # Temperature new data available
+    # Sample registers OUT_TEMP_L..OUT_Z_H_XL. query_burst() reads this as two bursts,
+    # OUT_TEMP_L..OUT_Z_H_G and STATUS_REG_XL..OUT_Z_H_XL, leaving the control registers
+    # between them unread.
+    sample_block=RegBlock('sample',OUT_TEMP_L,OUT_Z_H_XL-OUT_TEMP_L+1,(Field('status_g',STATUS_REG_G-OUT_TEMP_L,'B'),
+                                                                      Field('T'       ,OUT_TEMP_L  -OUT_TEMP_L,'h'),
+                                                                      Field('gx'      ,OUT_X_L_G   -OUT_TEMP_L,'h'),
+                                                                      Field('gy'      ,OUT_Y_L_G   -OUT_TEMP_L,'h'),
+                                                                      Field('gz'      ,OUT_Z_L_G   -OUT_TEMP_L,'h'),
+                                                                      Field('ax'      ,OUT_X_L_XL  -OUT_TEMP_L,'h'),
+                                                                      Field('ay'      ,OUT_Y_L_XL  -OUT_TEMP_L,'h'),
+                                                                      Field('az'      ,OUT_Z_L_XL  -OUT_TEMP_L,'h')))
+    GYRO_BURST_LEN=OUT_Z_H_G-OUT_TEMP_L+1
+    ACC_BURST_LEN=OUT_Z_H_XL-STATUS_REG_XL+1
+    # FIFO_CTRL FMODE values
+    FIFO_BYPASS        =0b000
+    FIFO_FIFO          =0b001 # Stop collecting when full
+    FIFO_CONT_TO_FIFO  =0b011
+    FIFO_BYPASS_TO_CONT=0b100
+    FIFO_CONTINUOUS    =0b110 # Stream, oldest sample is overwritten when full
+    FIFO_DEPTH=32
+    FIFO_SET_LEN=OUT_Z_H_G-OUT_X_L_G+1+OUT_Z_H_XL-OUT_X_L_XL+1 # One gyro+accel set, 12 bytes
+    whoami_value=0x68
+    scratch_reg=REFERENCE_G # Only used by the gyro high-pass filter, which begin() leaves off
+    max_spi_hz=10_000_000
     g=9.80665 # m/s**2 in 1g.
     odr_gs = (0, 14.9, 59.5, 119.0, 238.0, 476.0, 952.0, None)
+    odr_as = (0, 10.0, 50.0, 119.0, 238.0, 476.0, 952.0, None) # Accelerometer alone, with the gyro powered down
     fs_gs=(245.0,500.0,None,2000.0)
+    fs_as=(2.0,16.0,4.0,8.0) # Note the order -- 16g is code 1
+    # Sensitivity at each full-scale code, datasheet table 3
+    gyro_sens=(8.75e-3,17.5e-3,None,70e-3) # deg/s per DN
+    acc_sens=(0.061e-3,0.732e-3,0.122e-3,0.244e-3) # g per DN
+    temp_sens=16.0 # DN per degC
+    temp_offset=25.0 # degC at 0DN
     def select(self,val:[int,float],vals:Sequence[float])->int:
         if type(val)==int and val>=0 and val<len(vals):
             return val
@@ -44,108 +90,274 @@ class LSM9DS1_AG(SPI_sensor):
             return vals.index(val)
     def __init__(self,spi:SpiDev):
         super().__init__(spi)
+        self.burst_buf=bytearray(self.sample_block.length)
+        burst_view=memoryview(self.burst_buf)
+        self.gyro_view=burst_view[:self.GYRO_BURST_LEN]
+        self.acc_view=burst_view[self.STATUS_REG_XL-self.OUT_TEMP_L:]
+        # Optional imu_cal.IMUCal applied by query(cal=True) in place of the nominal sensitivities
+        self.imu_cal=None
     def whoami(self)->int:
         return self.read_reg(self.WHO_AM_I)
-    def begin(self,odr_g:[int,float]=119.0,fs_g:int=0,odr_a:int=3,fs_a:int=0):
+    def begin(self,odr_g:[int,float]=119.0,fs_g:int=0,odr_a:int=3,fs_a:int=0,int_active_low:bool=False):
         """
 
         :param odr_g:
         :param fs_g:
-        :param odr_a:
+        :param odr_a: Accelerometer output data rate, used only while the gyro is powered down (odr_g=0)
         :param fs_a:
+        :param int_active_low: Interrupt pins are active low. Default is active high.
         :return:
         """
         odr_g=self.select(odr_g,self.odr_gs)
         self.odr_g=self.odr_gs[odr_g]
+        odr_a=self.select(odr_a,self.odr_as)
+        self.odr_a=self.odr_as[odr_a]
         fs_g=self.select(fs_g,self.fs_gs)
         self.fs_g=self.fs_gs[fs_g]
-        self.write_reg(self.CTRL_REG1_G, ((odr_g & 0x07) << 5) | # Output data rate
-                                         ((fs_g  & 0x03) << 3) | # Full-scale
-                                         ((0     & 0x03) << 0))  # Bandwidth selection
-
-        self.write_reg(self.CTRL_REG2_G, ((0     & 0x03) << 2) | # Interrupt filter selection (No HPF or LPF2)
-                                         ((0     & 0x03) << 0))  # Output filter selection (No HPF or LPF2)
-
-        self.write_reg(self.CTRL_REG3_G, ((0     & 0x01) << 7) | # Low-power mode (disabled)
-                                         ((0     & 0x01) << 6) | # High-pass filter (disabled)
-                                         ((0     & 0x0f) << 0))  # High-pass cutoff frequency (n/a)
-
-        self.write_reg(self.CTRL_REG5_XL,((0     & 0x03) << 6) | # Decimation (no decimation)
-                                         ((1     & 0x01) << 5) | # az enabled
-                                         ((1     & 0x01) << 4) | # ay enabled
-                                         ((1     & 0x01) << 3) | # ax enabled
-                                         ((0     & 0x07) << 0))  # Reserved, must write 0
-
-        self.write_reg(self.CTRL_REG4   ,((0     & 0x03) << 6) | # Reserved, must write 0
-                                         ((1     & 0x01) << 5) | # gz enabled
-                                         ((1     & 0x01) << 4) | # gy enabled
-                                         ((1     & 0x01) << 3) | # gx enabled
-                                         ((0     & 0x01) << 0))  # Reserved, must write 0
-
-        self.write_reg(self.CTRL_REG6_XL,((odr_a & 0x07) << 5) | # Output data rate
-                                         ((fs_a  & 0x03) << 3) | # Full-scale
-                                         ((0     & 0x07) << 0))  # Bandwidth scale and selection
-
-        self.write_reg(self.CTRL_REG8,   ((0     & 0x01) << 7) |  # Boot request
-                                         ((1     & 0x01) << 6) |  # Block data update
-                                         ((0     & 0x01) << 5) |  # Interrupt active high
-                                         ((0     & 0x01) << 4) |  # Push-pull on INT pins
-                                         ((0     & 0x01) << 3) |  # SPI mode 4 wire
-                                         ((1     & 0x01) << 2) |  # Interface register address increment
-                                         ((0     & 0x01) << 1) |  # Little endian select
-                                         ((0     & 0x01) << 0))   # Software Reset
-
-    def query(self,cal=False):
-        """
-        :param cal: If true, use nominal full-scale values to calibrate into SI units. False returns
+        fs_a=self.select(fs_a,self.fs_as)
+        self.fs_a=self.fs_as[fs_a]
+        # Nominal scale factors for calibrate()
+        self.gyro_scale=self.gyro_sens[fs_g]*math.pi/180 # rad/s per DN
+        self.acc_scale=self.acc_sens[fs_a]*self.g # m/s**2 per DN
+        # Forget the shadow, so that every control register is written whatever the
+        # chip went through since the last begin()
+        self.shadow.clear()
+        self.dirty.clear()
+        self.set_reg(self.CTRL_REG1_G, ((odr_g & 0x07) << 5) | # Output data rate
+                                       ((fs_g  & 0x03) << 3) | # Full-scale
+                                       ((0     & 0x03) << 0))  # Bandwidth selection
+
+        self.set_reg(self.CTRL_REG2_G, ((0     & 0x03) << 2) | # Interrupt filter selection (No HPF or LPF2)
+                                       ((0     & 0x03) << 0))  # Output filter selection (No HPF or LPF2)
+
+        self.set_reg(self.CTRL_REG3_G, ((0     & 0x01) << 7) | # Low-power mode (disabled)
+                                       ((0     & 0x01) << 6) | # High-pass filter (disabled)
+                                       ((0     & 0x0f) << 0))  # High-pass cutoff frequency (n/a)
+
+        self.set_reg(self.CTRL_REG5_XL,((0     & 0x03) << 6) | # Decimation (no decimation)
+                                       ((1     & 0x01) << 5) | # az enabled
+                                       ((1     & 0x01) << 4) | # ay enabled
+                                       ((1     & 0x01) << 3) | # ax enabled
+                                       ((0     & 0x07) << 0))  # Reserved, must write 0
+
+        self.set_reg(self.CTRL_REG4   ,((0     & 0x03) << 6) | # Reserved, must write 0
+                                       ((1     & 0x01) << 5) | # gz enabled
+                                       ((1     & 0x01) << 4) | # gy enabled
+                                       ((1     & 0x01) << 3) | # gx enabled
+                                       ((0     & 0x01) << 0))  # Reserved, must write 0
+
+        self.set_reg(self.CTRL_REG6_XL,((odr_a & 0x07) << 5) | # Output data rate
+                                       ((fs_a  & 0x03) << 3) | # Full-scale
+                                       ((0     & 0x07) << 0))  # Bandwidth scale and selection
+
+        self.set_reg(self.CTRL_REG7_XL,((0     & 0x01) << 7) | # High resolution mode (disabled)
+                                       ((0     & 0x03) << 5) | # Digital filter cutoff (n/a)
+                                       ((0     & 0x01) << 2) | # Filtered data selection (bypass)
+                                       ((0     & 0x01) << 0))  # High-pass filter for interrupt (bypass)
+
+        self.set_reg(self.CTRL_REG8,   ((0     & 0x01) << 7) |  # Boot request
+                                       ((1     & 0x01) << 6) |  # Block data update
+                                       ((int_active_low & 0x01) << 5) |  # Interrupt activation level
+                                       ((0     & 0x01) << 4) |  # Push-pull on INT pins
+                                       ((0     & 0x01) << 3) |  # SPI mode 4 wire
+                                       ((1     & 0x01) << 2) |  # Interface register address increment
+                                       ((0     & 0x01) << 1) |  # Little endian select
+                                       ((0     & 0x01) << 0))   # Software Reset
+        # Two auto-increment bursts, CTRL_REG1_G-CTRL_REG3_G and CTRL_REG4-CTRL_REG8, instead of
+        # a write per register. IF_ADD_INC is set from reset, so this works before CTRL_REG8 is written.
+        self.flush()
+    def set_odr_g(self,odr_g:[int,float]):
+        """
+        Change the gyro (and with it the accelerometer) output data rate on the fly, without
+        a full begin(). Only the ODR bits of CTRL_REG1_G change, in one single-register write.
+
+        :param odr_g: Output data rate, as for begin()
+        """
+        odr_g=self.select(odr_g,self.odr_gs)
+        self.set_field(self.CTRL_REG1_G,5,3,odr_g)
+        self.flush()
+        self.odr_g=self.odr_gs[odr_g]
+
+    def query(self,cal=False,burst=False):
+        """
+        :param cal: If true, use calibrate() to convert into SI units. False returns
                     raw DN values.
-        :return: Tuple of (status, ax, ay, az, gx, gy, gz, T). If c
-        """
-        if cal:
-            raise NotImplementedError("Calibration isn't yet implemented")
-        status  =self.read_reg(self.STATUS_REG_G)
-        out_temp=self.read_int16(self.OUT_TEMP_L)
-        out_x_g =self.read_int16(self.OUT_X_L_G)
-        out_y_g =self.read_int16(self.OUT_Y_L_G)
-        out_z_g =self.read_int16(self.OUT_Z_L_G)
-        out_x_xl=self.read_int16(self.OUT_X_L_XL)
-        out_y_xl=self.read_int16(self.OUT_Y_L_XL)
-        out_z_xl=self.read_int16(self.OUT_Z_L_XL)
-        return status,out_temp,out_x_g,out_y_g,out_z_g,out_x_xl,out_y_xl,out_z_xl
-
-
-def main():
+        :param burst: If true, use query_burst() to read the sample in two transactions instead of eight,
+                      and return None if there is no new sample.
+        :return: Tuple of (status_g, T, gx, gy, gz, ax, ay, az)
+        """
+        if self.inst is not None:
+            t0=time.perf_counter_ns()
+        if burst:
+            result=self.query_burst()
+        else:
+            status  =self.read_reg(self.STATUS_REG_G)
+            out_temp=self.read_int16(self.OUT_TEMP_L)
+            out_x_g =self.read_int16(self.OUT_X_L_G)
+            out_y_g =self.read_int16(self.OUT_Y_L_G)
+            out_z_g =self.read_int16(self.OUT_Z_L_G)
+            out_x_xl=self.read_int16(self.OUT_X_L_XL)
+            out_y_xl=self.read_int16(self.OUT_Y_L_XL)
+            out_z_xl=self.read_int16(self.OUT_Z_L_XL)
+            result=status,out_temp,out_x_g,out_y_g,out_z_g,out_x_xl,out_y_xl,out_z_xl
+        if cal and result is not None:
+            result=self.calibrate(result)
+        if self.inst is not None:
+            self.inst.record_query(self.inst_name,t0,result is not None)
+        return result
+    def calibrate(self,sample:tuple)->tuple:
+        """
+        Convert one raw sample into SI units, using self.imu_cal if set, otherwise the
+        nominal sensitivities for the full scale set in begin(). To convert blocks
+        of samples at once, use imu_cal.IMUCal.apply().
+
+        :param sample: Tuple of raw (status_g, T, gx, gy, gz, ax, ay, az), as from query()
+        :return: Tuple of (status_g, T in degC, gx, gy, gz in rad/s, ax, ay, az in m/s**2)
+        """
+        status_g,T,gx,gy,gz,ax,ay,az=sample
+        T=self.temp_offset+T/self.temp_sens
+        if self.imu_cal is not None:
+            return (status_g,T,*self.imu_cal.apply((gx,gy,gz,ax,ay,az))[0].tolist())
+        gs=self.gyro_scale
+        acs=self.acc_scale
+        return status_g,T,gx*gs,gy*gs,gz*gs,ax*acs,ay*acs,az*acs
+    def query_burst(self):
+        """
+        Read a sample using register auto-increment (IF_ADD_INC, set in begin()).
+        The first transaction reads temperature, STATUS_REG_G and the gyro.
+        STATUS_REG_G carries both data-ready bits. If GDA and XLDA are both clear,
+        neither the gyro nor the accelerometer has produced a sample since the
+        last read, so stop there. Otherwise the second transaction reads
+        STATUS_REG_XL and the accelerometer, so accelerometer-only updates (gyro
+        powered down, odr_a alone) are read too.
+
+        :return: Tuple of (status_g, T, gx, gy, gz, ax, ay, az) in the same
+                 order as query(), or None if there is no new sample
+        """
+        gyro=self.read_into(self.OUT_TEMP_L,self.gyro_view)
+        if not (gyro[2] & (self.GDA | self.XLDA)):
+            return None
+        self.read_into(self.STATUS_REG_XL,self.acc_view)
+        return self.sample_block.decode(self.burst_buf)
+    def enable_int1(self,drdy_g:bool=True,drdy_xl:bool=False,fth:bool=False):
+        """
+        Route interrupt sources to the INT1_A/G pin. The pin polarity is set by
+        int_active_low in begin(). Data-ready stays active until the data is read.
+
+        :param drdy_g: Gyroscope data ready
+        :param drdy_xl: Accelerometer data ready
+        :param fth: FIFO threshold reached, see begin_fifo()
+        """
+        self.write_reg(self.INT1_CTRL,((0       & 0x01) << 7) |  # Gyroscope interrupt generator (disabled)
+                                      ((0       & 0x01) << 6) |  # Accelerometer interrupt generator (disabled)
+                                      ((0       & 0x01) << 5) |  # FIFO full (disabled)
+                                      ((0       & 0x01) << 4) |  # FIFO overrun (disabled)
+                                      ((fth     & 0x01) << 3) |  # FIFO threshold
+                                      ((0       & 0x01) << 2) |  # Boot status (disabled)
+                                      ((drdy_g  & 0x01) << 1) |  # Gyroscope data ready
+                                      ((drdy_xl & 0x01) << 0))   # Accelerometer data ready
+    def begin_fifo(self,mode:int=FIFO_CONTINUOUS,threshold:int=FIFO_DEPTH-1):
+        """
+        Turn on the hardware FIFO. Call after begin(). The FIFO is passed through
+        bypass mode first, which empties it.
+
+        :param mode: One of the FIFO_* FMODE values. FIFO_CONTINUOUS keeps streaming
+                     and overwrites the oldest set when full, FIFO_FIFO stops when full.
+        :param threshold: FIFO threshold level, reported by FIFO_SRC.FTH and usable as an interrupt
+        """
+        self.n_fifo_overrun=0
+        self.write_reg(self.FIFO_CTRL,  ((self.FIFO_BYPASS & 0x07) << 5) | # Reset FIFO contents
+                                        ((threshold & 0x1f)        << 0))
+        self.write_reg(self.CTRL_REG9,  ((0     & 0x01) << 6) | # Gyroscope sleep mode (disabled)
+                                        ((0     & 0x01) << 4) | # Temperature in FIFO (disabled)
+                                        ((0     & 0x01) << 3) | # Data available timer (disabled)
+                                        ((0     & 0x01) << 2) | # I2C interface (enabled)
+                                        ((1     & 0x01) << 1) | # FIFO memory enable
+                                        ((0     & 0x01) << 0))  # Stop on threshold (disabled)
+        self.write_reg(self.FIFO_CTRL,  ((mode & 0x07)      << 5) | # FIFO mode
+                                        ((threshold & 0x1f) << 0))  # FIFO threshold level
+    def end_fifo(self):
+        """
+        Turn off the hardware FIFO and return to reading the output registers directly.
+        """
+        self.write_reg(self.FIFO_CTRL,(self.FIFO_BYPASS & 0x07) << 5)
+        self.write_reg(self.CTRL_REG9,0)
+    def fifo_level(self)->[int,bool]:
+        """
+        :return: Tuple of (number of unread gyro+accel sets in the FIFO, overrun flag)
+        """
+        fifo_src=self.read_reg(self.FIFO_SRC)
+        return fifo_src & 0x3f, bool((fifo_src >> 6) & 0x01)
+    def read_fifo(self,max_sets:int=FIFO_DEPTH)->array:
+        """
+        Drain the FIFO in one auto-increment burst. With the FIFO enabled, reading
+        with IF_ADD_INC from OUT_X_L_G rolls over from OUT_Z_H_XL back to OUT_X_L_G,
+        with each pass popping one set, so N sets come out of a single 12*N byte read.
+
+        :param max_sets: Read at most this many sets, even if more are available
+        :return: array('h') of N*6 raw values, one row of (gx, gy, gz, ax, ay, az) per set,
+                 oldest first. Use numpy.frombuffer(result,dtype=numpy.int16).reshape(-1,6)
+                 for an (N,6) view without copying. May be empty.
+        """
+        n,overrun=self.fifo_level()
+        if overrun:
+            self.n_fifo_overrun+=1
+        n=min(n,max_sets)
+        result=array('h')
+        if n==0:
+            return result
+        result.frombytes(self.read_block(self.OUT_X_L_G,n*self.FIFO_SET_LEN))
+        if sys.byteorder!='little':
+            result.byteswap()
+        return result
+
+
+def main(burst:bool=True,count_xfers:bool=False,fifo:bool=False):
     """
     This code depends on ~CE0 of Pi being connected directly to ~CS of sensor. If not,
     use read_sensors() instead, which drives the CS address decoder.
+
+    :param burst: Use query_burst(), which skips samples already read
+    :param count_xfers: Report the number of SPI transactions used by each query
+    :param fifo: Stream samples through the hardware FIFO, reading a block at a time
     """
     spi = SpiDev()
     spi.open(0, 0)
-    # Allowed SPI from table at https://www.takaitra.com/spi-device-raspberry-pi/
-    allowed_spi_spd = [125_000_000,
-                       62_500_000,
-                       31_200_000,
-                       15_600_000,
-                       7_800_000,
-                       3_900_000,
-                       1_953_000,
-                       976_000,
-                       488_000,
-                       244_000,
-                       122_000,
-                       61_000,
-                       30_500,
-                       15_200,
-                       7_629]
-
     spi.max_speed_hz = 3_900_000
     spi.mode = 0b00
 
     ag = LSM9DS1_AG(spi)
     print(f'Chip ID (should be 0x68): 0x{ag.whoami():02x}')
     ag.begin()
+    if fifo:
+        from timestamp import SampleClock
+        clock=SampleClock(ag.odr_g)
+        ag.begin_fifo()
+        while True:
+            time.sleep(0.5*ag.FIFO_DEPTH/ag.odr_g)
+            n_xfer=ag.n_xfer
+            n_overrun=ag.n_fifo_overrun
+            block=ag.read_fifo()
+            # One clock read per drain, sample times reconstructed from there
+            t_ns=time.monotonic_ns()
+            if count_xfers:
+                print(f'xfers: {ag.n_xfer-n_xfer} sets: {len(block)//6} overruns: {ag.n_fifo_overrun}')
+            if len(block)==0:
+                continue
+            t_first,period=clock.update(t_ns,len(block)//6,overrun=ag.n_fifo_overrun!=n_overrun)
+            for i in range(0,len(block),6):
+                gx,gy,gz,ax,ay,az=block[i:i+6]
+                print(f't: {(t_first+period*(i//6))*1e-9:.6f} gx: 0x{gx&0xffff:04x} gy: 0x{gy&0xffff:04x} gz: 0x{gz&0xffff:04x} ax: 0x{ax&0xffff:04x} ay: 0x{ay&0xffff:04x} az: 0x{az&0xffff:04x}')
+            if count_xfers:
+                print(f'odr: {clock.odr():.3f}Hz drift: {clock.ratio():.6f}')
     while True:
-        status_g,T,gx,gy,gz,ax,ay,az = ag.query()
+        n_xfer=ag.n_xfer
+        sample=ag.query(burst=burst)
+        if count_xfers:
+            print(f'xfers: {ag.n_xfer-n_xfer}')
+        if sample is None:
+            continue
+        status_g,T,gx,gy,gz,ax,ay,az = sample
         print(f'status_g: 0b{status_g:08b} T: 0x{T:04x} gx: 0x{gx:04x} gy: 0x{gy:04x} gz: 0x{gz:04x} ax: 0x{ax:04x} ay: 0x{ay:04x} az: 0x{az:04x}')
 
 
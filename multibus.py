@@ -0,0 +1,250 @@
+"""
+Acquisition from sensors on more than one of the Pi's SPI buses at once.
+
+Each bus has its own SpiDev, its own 74x138 decoder on three GPIO pins, and
+its own list of sensors, and is driven by its own Scheduler in its own
+thread. SpiDev.xfer() releases the GIL for the transfer, so the buses really
+do run concurrently and total throughput scales with the number of buses.
+
+Within one bus, samples come out in time order. The per-bus streams are
+merged into one time-ordered stream with a heap: a sample is only released
+once every bus has reported a time at or past it, so nothing later can
+arrive that should have come first.
+
+SPI1 needs enabling separately, for instance with dtoverlay=spi1-1cs in
+config.txt, which puts its ~CE0 on BOARD pin 12. Its decoder then needs
+three free GPIOs other than the ones used by SPI0's decoder.
+
+Configuration is a dict, or a JSON file of one, like DEFAULT_CONFIG:
+* buses: list of
+  * bus: Pi SPI bus number, IE the first argument of SpiDev.open()
+  * ce: Hardware chip enable the decoder hangs off, the second argument
+  * cs_pins: BOARD pins driving decoder inputs A0, A1, A2
+  * sensors: list of
+    * type: 'bme680' or 'lsm9ds1'
+    * name: Name for the stream, unique across all buses
+    * addr: Decoder address
+    * speed_hz: SPI clock, default 3.9MHz
+    * begin: Optional dict of keyword arguments for the sensor's begin()
+"""
+import heapq
+import json
+import math
+import threading
+import time
+
+from spidev import SpiDev
+from bme680 import BME680
+from chip_select import ChipSelect
+from lsm9ds1 import LSM9DS1_AG
+from scheduler import Scheduler, bme680_task, imu_task
+from spi_bus import SPIBus
+
+# Driver class and scheduler task for each sensor type in the configuration
+sensor_types={'bme680' :(BME680    ,bme680_task),
+              'lsm9ds1':(LSM9DS1_AG,imu_task)}
+
+DEFAULT_CONFIG={'buses':[{'bus':0,'ce':0,'cs_pins':[15,13,11],
+                          'sensors':[{'type':'lsm9ds1','name':'lsm9ds1_0','addr':0},
+                                     {'type':'bme680' ,'name':'bme680_0' ,'addr':2}]},
+                         {'bus':1,'ce':0,'cs_pins':[16,18,22],
+                          'sensors':[{'type':'lsm9ds1','name':'lsm9ds1_1','addr':0},
+                                     {'type':'bme680' ,'name':'bme680_1' ,'addr':2}]}]}
+
+
+def load_config(filename:str)->dict:
+    with open(filename,'r') as inf:
+        return json.load(inf)
+
+
+class MergedStream:
+    def __init__(self,n_sources:int):
+        """
+        Merge time-ordered streams from several threads into one.
+
+        :param n_sources: Number of producing threads
+        """
+        self.cond=threading.Condition()
+        self.heap=[]
+        self.seq=0 # Tie-breaker, so equal times come out in arrival order and samples are never compared
+        self.watermarks=[-math.inf]*n_sources
+        self.n_done=0
+        self.n_sources=n_sources
+    def put(self,source:int,t:float,name:str,sample):
+        """
+        Add a sample. Each source must put its samples in time order.
+        """
+        with self.cond:
+            heapq.heappush(self.heap,(t,self.seq,name,sample))
+            self.seq+=1
+            self.watermarks[source]=t
+            self.cond.notify()
+    def advance(self,source:int,t:float):
+        """
+        Tell the stream that a source won't produce any more samples before t
+        """
+        with self.cond:
+            self.watermarks[source]=t
+            self.cond.notify()
+    def finish(self,source:int):
+        """
+        Tell the stream that a source is done
+        """
+        with self.cond:
+            self.watermarks[source]=math.inf
+            self.n_done+=1
+            self.cond.notify()
+    def pop_ready(self)->list:
+        """
+        Call with the condition held.
+
+        :return: List of (t, name, sample) that no source can now precede, in time order
+        """
+        result=[]
+        watermark=min(self.watermarks)
+        while len(self.heap)>0 and self.heap[0][0]<=watermark:
+            t,_,name,sample=heapq.heappop(self.heap)
+            result.append((t,name,sample))
+        return result
+    def get(self,timeout:float=None)->list:
+        """
+        Wait for samples that are ready to be released
+
+        :param timeout: Longest time to wait in seconds, or None to wait indefinitely
+        :return: List of (t, name, sample), possibly empty on timeout or once all sources are done
+        """
+        with self.cond:
+            result=self.pop_ready()
+            if len(result)==0 and self.n_done<self.n_sources:
+                self.cond.wait(timeout)
+                result=self.pop_ready()
+            return result
+    def __iter__(self):
+        """
+        Yield (t, name, sample) in time order until all sources are finished
+        """
+        while True:
+            batch=self.get()
+            yield from batch
+            if len(batch)==0 and self.n_done==self.n_sources:
+                return
+
+
+class BusRunner:
+    def __init__(self,index:int,config:dict,stream:MergedStream):
+        """
+        Set up one bus and its sensors, and a scheduler to read them
+
+        :param index: Position of this bus in the configuration, its source number in stream
+        :param config: One entry of the configuration's bus list
+        :param stream: Where to put samples
+        """
+        self.index=index
+        self.stream=stream
+        self.cs=ChipSelect(*config['cs_pins'])
+        self.cs.begin()
+        spi=SpiDev()
+        spi.open(config['bus'],config.get('ce',0))
+        self.bus=SPIBus(spi,self.cs)
+        self.sensors={}
+        tasks=[]
+        for sensor_config in config['sensors']:
+            cls,task=sensor_types[sensor_config['type']]
+            addr=sensor_config['addr']
+            sensor=cls(self.bus.device(addr,sensor_config.get('speed_hz',3_900_000),0b00))
+            sensor.begin(**sensor_config.get('begin',{}))
+            self.sensors[sensor_config['name']]=sensor
+            tasks.append(task(sensor,addr,name=sensor_config['name']))
+        self.scheduler=Scheduler(self.bus,tasks,sink=lambda name,t,sample:stream.put(index,t,name,sample))
+        self.stopped=threading.Event()
+        self.thread=None
+        self.error=None
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                self.scheduler.step()
+                self.stream.advance(self.index,self.scheduler.clock())
+        except Exception as e:
+            self.error=e
+        finally:
+            self.stream.finish(self.index)
+    def start(self):
+        self.stopped.clear()
+        self.thread=threading.Thread(target=self.run,name=f'spi{self.index}',daemon=True)
+        self.thread.start()
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread=None
+        if self.error is not None:
+            raise self.error
+
+
+class MultiBus:
+    def __init__(self,config:dict=None):
+        """
+        Set up every bus and sensor in the configuration. The sensors are
+        started here, one at a time, before any bus thread runs.
+
+        :param config: Configuration, see the module docstring. Default is DEFAULT_CONFIG.
+        """
+        if config is None:
+            config=DEFAULT_CONFIG
+        names=[sensor['name'] for bus in config['buses'] for sensor in bus['sensors']]
+        if len(set(names))!=len(names):
+            raise ValueError(f"Sensor names must be unique across buses: {names}")
+        self.stream=MergedStream(len(config['buses']))
+        self.runners=[BusRunner(i,bus,self.stream) for i,bus in enumerate(config['buses'])]
+    def __enter__(self)->"MultiBus":
+        self.start()
+        return self
+    def __exit__(self,exc_type,exc_val,exc_tb):
+        self.stop()
+    def start(self):
+        for runner in self.runners:
+            runner.start()
+    def stop(self):
+        """
+        Stop all bus threads. Samples already taken stay in the stream to be read.
+        Raises the first error any bus thread hit.
+        """
+        for runner in self.runners:
+            runner.stopped.set()
+        for runner in self.runners:
+            runner.stop()
+    def sensors(self)->dict:
+        """
+        :return: Dictionary of every sensor driver by name
+        """
+        return {name:sensor for runner in self.runners for name,sensor in runner.sensors.items()}
+    def report(self)->list:
+        """
+        :return: Scheduler.report() for each bus, in configuration order
+        """
+        return [runner.scheduler.report() for runner in self.runners]
+
+
+def main(config:str=None,duration:float=None):
+    """
+    :param config: JSON configuration file, default is DEFAULT_CONFIG
+    :param duration: Time to run in seconds, or None to run until interrupted
+    """
+    multi=MultiBus(None if config is None else load_config(config))
+    multi.start()
+    t1=None if duration is None else time.monotonic()+duration
+    try:
+        while t1 is None or time.monotonic()<t1:
+            for t,name,sample in multi.stream.get(timeout=0.1):
+                print(f'{t:.6f} {name}: {sample}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        multi.stop()
+    for t,name,sample in multi.stream:
+        print(f'{t:.6f} {name}: {sample}')
+    print(multi.report())
+
+
+if __name__=="__main__":
+    main()
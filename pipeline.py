@@ -0,0 +1,348 @@
+"""
+Producer/consumer acquisition pipeline. One process does nothing but read the
+sensors and push raw records into a ring buffer in shared memory; any number
+of consumer processes read the ring independently and do the slow work --
+compensation, scaling, printing, logging -- without ever holding up the bus.
+
+The ring is single-producer and lock-free. The producer writes a record into
+the next slot, then publishes it by bumping the head counter. It never waits
+for consumers: if one falls more than a ring behind, its oldest records are
+overwritten. Each consumer keeps its own tail, and after copying records out
+checks the head again to throw away any the producer may have overwritten
+mid-copy, counting them as overruns.
+
+Records are the same 32-byte layout as sample_log, so a logging consumer
+writes them straight to a file.
+
+Shared memory layout:
+* ring_header_struct: head (records ever pushed), number of records pushed
+  over ones some consumer hadn't read yet, capacity in records, number of consumers
+* cursor_struct for each consumer: tail (records consumed), overruns
+* Records, RECORD_SIZE bytes each, starting at the next multiple of RECORD_SIZE
+"""
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+
+from sample_log import DEV_BME680, DEV_LSM9DS1, RECORD_SIZE, SampleLogWriter, record_blocks, sensor_meta
+
+ring_header_struct=struct.Struct('<QQII')
+cursor_struct=struct.Struct('<QQ')
+counter_struct=struct.Struct('<Q')
+HEAD_OFFSET=0
+N_OVERWRITTEN_OFFSET=8
+
+
+class ShmRing:
+    def __init__(self,name:str=None,capacity:int=4096,n_consumers:int=1):
+        """
+        Create a ring, or attach to an existing one
+
+        :param name: Name of an existing ring's shared memory, or None to create a new one
+        :param capacity: Number of records. Only used when creating.
+        :param n_consumers: Number of consumer cursors. Only used when creating.
+        """
+        if name is None:
+            data_offset=self.data_offset_for(n_consumers)
+            self.shm=shared_memory.SharedMemory(create=True,size=data_offset+capacity*RECORD_SIZE)
+            ring_header_struct.pack_into(self.shm.buf,0,0,0,capacity,n_consumers)
+            for i in range(n_consumers):
+                cursor_struct.pack_into(self.shm.buf,self.cursor_offset(i),0,0)
+        else:
+            self.shm=shared_memory.SharedMemory(name=name)
+            _,_,capacity,n_consumers=ring_header_struct.unpack_from(self.shm.buf,0)
+        self.buf=self.shm.buf
+        self.capacity=capacity
+        self.n_consumers=n_consumers
+        self.data_offset=self.data_offset_for(n_consumers)
+        self.n_pushed=self.load(HEAD_OFFSET)
+        self.n_overwritten=self.load(N_OVERWRITTEN_OFFSET)
+    @staticmethod
+    def cursor_offset(index:int)->int:
+        return ring_header_struct.size+index*cursor_struct.size
+    @classmethod
+    def data_offset_for(cls,n_consumers:int)->int:
+        return -(-cls.cursor_offset(n_consumers)//RECORD_SIZE)*RECORD_SIZE
+    @property
+    def name(self)->str:
+        return self.shm.name
+    def load(self,offset:int)->int:
+        """
+        Read a counter written by another process. A 64-bit store isn't
+        atomic everywhere (32-bit ARM), so read until two reads agree.
+        """
+        value=counter_struct.unpack_from(self.buf,offset)[0]
+        while True:
+            again=counter_struct.unpack_from(self.buf,offset)[0]
+            if again==value:
+                return value
+            value=again
+    def head(self)->int:
+        return self.load(HEAD_OFFSET)
+    def slot(self,n:int)->int:
+        """
+        :param n: Record sequence number
+        :return: Offset of its slot in the shared memory
+        """
+        return self.data_offset+(n%self.capacity)*RECORD_SIZE
+    def push(self,device:int,t_ns:int,*values):
+        """
+        Producer side: write one record and publish it. Only one process may push.
+
+        :param device: Device tag, DEV_*
+        :param t_ns: Timestamp, time.monotonic_ns()
+        :param values: Fields of the payload for this device, in record_blocks order
+        """
+        head=self.n_pushed
+        if head-self.min_tail()>=self.capacity:
+            self.n_overwritten+=1
+            counter_struct.pack_into(self.buf,N_OVERWRITTEN_OFFSET,self.n_overwritten)
+        record_blocks[device].struct.pack_into(self.buf,self.slot(head),t_ns,device,*values)
+        self.n_pushed=head+1
+        counter_struct.pack_into(self.buf,HEAD_OFFSET,self.n_pushed)
+    def min_tail(self)->int:
+        """
+        :return: Tail of the slowest consumer. With no consumers nothing is waiting to be
+                 read, so the head.
+        """
+        return min((self.load(self.cursor_offset(i)) for i in range(self.n_consumers)),default=self.n_pushed)
+    def consumer(self,index:int)->"RingConsumer":
+        return RingConsumer(self,index)
+    def stats(self)->dict:
+        return {'pushed':self.head(),
+                'overwritten':self.load(N_OVERWRITTEN_OFFSET),
+                'consumers':[dict(zip(('consumed','overruns'),cursor_struct.unpack_from(self.buf,self.cursor_offset(i))))
+                             for i in range(self.n_consumers)]}
+    def close(self):
+        self.buf=None
+        self.shm.close()
+    def unlink(self):
+        """
+        Free the shared memory. Only the creator should call this, after everyone has closed.
+        """
+        self.shm.unlink()
+
+
+class RingConsumer:
+    def __init__(self,ring:ShmRing,index:int):
+        """
+        Read side of a ring. Each consumer process uses its own index.
+
+        :param ring: Ring attached in this process
+        :param index: Which consumer cursor to use, 0..ring.n_consumers-1
+        """
+        self.ring=ring
+        self.offset=ring.cursor_offset(index)
+        self.tail,self.n_overrun=cursor_struct.unpack_from(ring.buf,self.offset)
+    def read(self,max_records:int=None)->bytes:
+        """
+        Copy out records pushed since the last read
+
+        :param max_records: Most records to return, or None for all available
+        :return: Whole records, oldest first, possibly empty
+        """
+        ring=self.ring
+        capacity=ring.capacity
+        tail=self.tail
+        head=ring.head()
+        if head-tail>capacity:
+            # Lapped -- the oldest unread records are already gone
+            self.n_overrun+=head-tail-capacity
+            tail=head-capacity
+        n=head-tail
+        if max_records is not None:
+            n=min(n,max_records)
+        start=tail%capacity
+        first=min(n,capacity-start)
+        records=bytes(ring.buf[ring.slot(tail):ring.slot(tail)+first*RECORD_SIZE])
+        if n>first:
+            records+=bytes(ring.buf[ring.data_offset:ring.data_offset+(n-first)*RECORD_SIZE])
+        # While we copied, the producer may have published up to a new head and be
+        # writing the next record, which reuses the slot of record head-capacity.
+        # Anything at or before that may be torn.
+        lost=min(ring.head()-capacity+1-tail,n)
+        if lost>0:
+            self.n_overrun+=lost
+            records=records[lost*RECORD_SIZE:]
+        self.tail=tail+n
+        cursor_struct.pack_into(ring.buf,self.offset,self.tail,self.n_overrun)
+        return records
+
+
+def produce(ring_name:str,meta_conn,stop,probe:bool=False,fifo:bool=False):
+    """
+    Acquisition process: read both sensors as fast as they produce data, and
+    push raw records. Nothing here formats, calibrates or touches a file.
+
+    :param ring_name: Name of the ring's shared memory
+    :param meta_conn: Pipe connection to send the sensor_meta() to once the sensors are set up
+    :param stop: Event to end acquisition
+    :param probe: Find the fastest reliable SPI clock for each device
+    :param fifo: Read the IMU through its hardware FIFO, with one clock read per drain,
+                 instead of polling it, see read_sensors.FifoStream
+    """
+    from read_sensors import FifoStream, open_sensors
+    bus,bme,ag=open_sensors(probe)
+    meta_conn.send(sensor_meta(bme,ag))
+    meta_conn.close()
+    ring=ShmRing(ring_name)
+    stream=FifoStream(ag) if fifo else None
+    try:
+        while not stop.is_set():
+            if time.monotonic()>=bme.ready_at and bme.poll():
+                rP,_,_,rT,_,_,rh,_,_=bme.query(cal=False)
+                ring.push(DEV_BME680,int(bme.sample_time*1e9),rP,rT,rh)
+            if fifo:
+                for t_ns,sample in stream.poll():
+                    ring.push(DEV_LSM9DS1,t_ns,*sample)
+                time.sleep(max(0.0,min(bme.ready_at,stream.next_drain)-time.monotonic()))
+                continue
+            sample=ag.query(burst=True)
+            if sample is not None:
+                ring.push(DEV_LSM9DS1,time.monotonic_ns(),*sample)
+    finally:
+        ring.close()
+
+
+def consume(ring_name:str,index:int,stop,handle,poll:float=0.01,max_records:int=4096):
+    """
+    Consumer loop: pass each batch of records to handle() until stop is set
+    and the ring is drained.
+
+    :param ring_name: Name of the ring's shared memory
+    :param index: Consumer cursor to use
+    :param stop: Event set once the producer has finished
+    :param handle: Called with each non-empty batch of records, as bytes
+    :param poll: Time to sleep when the ring is empty, in seconds
+    :param max_records: Most records to take per batch
+    """
+    ring=ShmRing(ring_name)
+    reader=ring.consumer(index)
+    try:
+        while True:
+            records=reader.read(max_records)
+            if records:
+                handle(records)
+            elif stop.is_set():
+                break
+            else:
+                time.sleep(poll)
+    finally:
+        ring.close()
+
+
+def log_consumer(ring_name:str,index:int,stop,meta:dict,filename:str):
+    """
+    Consumer process: write raw records to a sample log
+
+    :param meta: Header metadata, from the producer
+    :param filename: Log file to write
+    """
+    with SampleLogWriter(filename,meta) as writer:
+        consume(ring_name,index,stop,writer.write_records)
+
+
+def print_calibrated(device:str,t_ns,values:dict):
+    """
+    Default sink for cal_consumer(): print each sample.
+
+    :param device: 'bme680' or 'lsm9ds1'
+    :param t_ns: Array of timestamps
+    :param values: Dict of arrays of values in physical units
+    """
+    for i in range(len(t_ns)):
+        print(f'{device} {t_ns[i]*1e-9:.6f} '+' '.join(f'{k}: {v[i]:.4f}' for k,v in values.items()))
+
+
+def cal_consumer(ring_name:str,index:int,stop,meta:dict,sink=print_calibrated):
+    """
+    Consumer process: compensate BME680 samples and scale LSM9DS1 samples a
+    batch at a time, and pass them to sink(device,t_ns,values).
+
+    IMU rates are in rad/s and accelerations in m/s**2, from the nominal sensitivities.
+
+    :param meta: Header metadata, from the producer
+    :param sink: Called with the device name, array of timestamps, and dict of value arrays
+    """
+    import numpy as np
+    import bme680_batch
+    from bme680 import BME680Cal
+    from imu_cal import IMUCal, columns, raw_block
+    from lsm9ds1 import LSM9DS1_AG
+    cal=BME680Cal(**meta['bme680']['cal'])
+    imu_cal=IMUCal.from_meta(meta['lsm9ds1'])
+    bme_dtype=record_blocks[DEV_BME680].dtype()
+    ag_dtype=record_blocks[DEV_LSM9DS1].dtype()
+    def handle(records:bytes):
+        bme=np.frombuffer(records,dtype=bme_dtype)
+        bme=bme[bme['device']==DEV_BME680]
+        if len(bme)>0:
+            P,T,h=bme680_batch.calibrate(cal,bme['rP'],bme['rT'],bme['rh'])
+            sink('bme680',bme['t_ns'],{'P':P,'T':T,'h':h})
+        ag=np.frombuffer(records,dtype=ag_dtype)
+        ag=ag[ag['device']==DEV_LSM9DS1]
+        if len(ag)>0:
+            si=imu_cal.apply(raw_block(ag))
+            values={'T':LSM9DS1_AG.temp_offset+ag['T']/LSM9DS1_AG.temp_sens}
+            for i,column in enumerate(columns):
+                values[column]=si[:,i]
+            sink('lsm9ds1',ag['t_ns'],values)
+    consume(ring_name,index,stop,handle)
+
+
+def run(duration:float=None,log:str=None,calibrate:bool=True,capacity:int=65536,probe:bool=False,
+        fifo:bool=False)->dict:
+    """
+    Run the pipeline: one acquisition process, plus a calibrating consumer
+    and/or a logging consumer.
+
+    :param duration: Time to run in seconds, or None to run until interrupted
+    :param log: Sample log file for the logging consumer, or None for no log
+    :param calibrate: Run the calibrating consumer
+    :param capacity: Ring size in records
+    :param probe: Find the fastest reliable SPI clock for each device
+    :param fifo: Read the IMU through its hardware FIFO, see produce()
+    :return: Ring statistics from ShmRing.stats(), with consumers in the order
+             calibrating, logging
+    """
+    consumers=[]
+    if calibrate:
+        consumers.append((cal_consumer,()))
+    if log is not None:
+        consumers.append((log_consumer,(log,)))
+    ring=ShmRing(capacity=capacity,n_consumers=len(consumers))
+    stop_producer=multiprocessing.Event()
+    stop_consumers=multiprocessing.Event()
+    meta_recv,meta_send=multiprocessing.Pipe(duplex=False)
+    producer=multiprocessing.Process(target=produce,args=(ring.name,meta_send,stop_producer,probe,fifo))
+    producer.start()
+    meta_send.close()
+    try:
+        meta=meta_recv.recv()
+        procs=[multiprocessing.Process(target=target,args=(ring.name,i,stop_consumers,meta)+args)
+               for i,(target,args) in enumerate(consumers)]
+        for proc in procs:
+            proc.start()
+        try:
+            if duration is None:
+                producer.join()
+            else:
+                time.sleep(duration)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Producer first, so consumers see everything it pushed before they drain and quit
+            stop_producer.set()
+            producer.join()
+            stop_consumers.set()
+            for proc in procs:
+                proc.join()
+        return ring.stats()
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+if __name__=="__main__":
+    print(run())
@@ -2,53 +2,160 @@
 Use the sensor drivers to read the BME680 and LSM9DS1 sensors
 """
 
+import time
+
 from spidev import SpiDev
 from chip_select import ChipSelect
 from bme680 import BME680
+from instrument import Instrument, SnapshotWriter
 from lsm9ds1 import LSM9DS1_AG
+from sample_log import SampleLogWriter, sensor_meta
+from scheduler import Scheduler, bme680_task, imu_task
+from spi_bus import SPIBus, probe_speed
+from timestamp import SampleClock
+
+
+def print_bme(sample):
+    rP, P, dP, rT, T, dT, rh, h, dh = sample
+    print(
+        f'P: raw {rP:6d}, cal {P:.1f}  Pa, d {dP:.4e}Pa    T: raw {rT:6d}, cal {T:.4f}degC, d {dT:.4e}degC    h: raw {rh:6d}, cal {h:.3f}    %, d {dh:.4e}%')
+
 
+def print_ag(sample):
+    status_g,T,gx,gy,gz,ax,ay,az = sample
+    print(f'status_g: 0b{status_g:08b} T: {T:6d} gx: {gx:6d} gy: {gy:6d} gz: {gz:6d} ax: {ax:6d} ay: {ay:6d} az: {az:6d}')
 
-def main():
+
+def open_sensors(probe:bool=False):
+    """
+    Set up the bus and both sensors, LSM9DS1 at decoder address 0 and BME680 at 2.
+
+    :param probe: Find the fastest reliable SPI clock for each device, instead of
+                  using 3.9MHz for all
+    :return: Tuple of (bus, bme, ag)
+    """
     cs= ChipSelect()
     cs.begin()
     spi = SpiDev()
     spi.open(0, 0)
-    # Allowed SPI from table at https://www.takaitra.com/spi-device-raspberry-pi/
-    allowed_spi_spd = [125_000_000,
-                       62_500_000,
-                       31_200_000,
-                       15_600_000,
-                       7_800_000,
-                       3_900_000,
-                       1_953_000,
-                       976_000,
-                       488_000,
-                       244_000,
-                       122_000,
-                       61_000,
-                       30_500,
-                       15_200,
-                       7_629]
-
-    spi.max_speed_hz = 3_900_000
-    spi.mode = 0b00
-    cs.set_addr(2)
-    bme = BME680(spi)
+    bus = SPIBus(spi, cs)
+    bme = BME680(bus.device(2, 3_900_000, 0b00))
     print(f'Chip ID (should be 0x61): 0x{bme.whoami():02x}')
-    bme.begin()
-    ag = LSM9DS1_AG(spi)
-    cs.set_addr(0)
+    ag = LSM9DS1_AG(bus.device(0, 3_900_000, 0b00))
     print(f'Chip ID (should be 0x68): 0x{ag.whoami():02x}')
+    if probe:
+        # Before begin(), so that garbled writes at a too-fast trial rate can't
+        # corrupt configuration that has already been written
+        print(f'BME680 SPI clock: {probe_speed(bme.spi, bme)} Hz')
+        print(f'LSM9DS1 SPI clock: {probe_speed(ag.spi, ag)} Hz')
+    bme.begin()
     ag.begin()
-    while True:
-        cs.set_addr(2)
-        print(bme.wait_ready())
-        rP, P, dP, rT, T, dT, rh, h, dh = bme.query()
-        print(
-            f'P: raw {rP:6d}, cal {P:.1f}  Pa, d {dP:.4e}Pa    T: raw {rT:6d}, cal {T:.4f}degC, d {dT:.4e}degC    h: raw {rh:6d}, cal {h:.3f}    %, d {dh:.4e}%')
-        cs.set_addr(0)
-        status_g,T,gx,gy,gz,ax,ay,az = ag.query()
-        print(f'status_g: 0b{status_g:08b} T: {T:6d} gx: {gx:6d} gy: {gy:6d} gz: {gz:6d} ax: {ax:6d} ay: {ay:6d} az: {az:6d}')
+    return bus, bme, ag
+
+
+class FifoStream:
+    def __init__(self,ag):
+        """
+        Stream LSM9DS1 samples through its hardware FIFO, draining it every half fill
+        time. Instead of a clock read per sample, there is one per drain, and each
+        sample's time comes from a timestamp.SampleClock at the output data rate.
+        Overruns reported by the FIFO are passed on to the clock as lost samples.
+
+        :param ag: LSM9DS1_AG, after begin(). This calls begin_fifo().
+        """
+        self.ag=ag
+        self.clock=SampleClock(ag.odr_g)
+        self.drain_period=0.5*ag.FIFO_DEPTH/ag.odr_g
+        ag.begin_fifo()
+        self.next_drain=time.monotonic()+self.drain_period
+    def poll(self)->list:
+        """
+        Drain the FIFO if it is time to
+
+        :return: List of (t_ns, sample), empty if no drain was due. sample is laid out as
+                 from LSM9DS1_AG.query(), with status_g of GDA|XLDA. The FIFO doesn't hold
+                 temperature, so T is read once per drain.
+        """
+        now=time.monotonic()
+        if now<self.next_drain:
+            return []
+        self.next_drain=now+self.drain_period
+        ag=self.ag
+        n_overrun=ag.n_fifo_overrun
+        block=ag.read_fifo()
+        t_ns=time.monotonic_ns()
+        n=len(block)//6
+        if n==0:
+            return []
+        T=ag.read_int16(ag.OUT_TEMP_L)
+        t_first,period=self.clock.update(t_ns,n,overrun=ag.n_fifo_overrun!=n_overrun)
+        status=ag.GDA | ag.XLDA
+        return [(int(t_first+period*i),(status,T,*block[6*i:6*i+6])) for i in range(n)]
+
+
+def main(scheduled:bool=False,probe:bool=False,log:str=None,stats:str=None,decimate:dict=None,fifo:bool=False):
+    """
+    :param scheduled: Use the deadline scheduler, which reads the IMU at its output
+                      data rate and the BME680 as each conversion finishes
+    :param probe: Find the fastest reliable SPI clock for each device, instead of
+                  using 3.9MHz for all
+    :param log: Write raw samples to this binary sample log file instead of printing them
+    :param stats: Instrument the sensors and decoder, and append a snapshot of transaction
+                  counts and timings to this file every 10s
+    :param decimate: With log, filter and decimate samples before logging them, by these
+                     factors by device, for instance {'lsm9ds1':8,'bme680':4}
+    :param fifo: Read the IMU through its hardware FIFO, see FifoStream, instead of polling
+                 it. Not with scheduled.
+    """
+    if scheduled and fifo:
+        raise ValueError("The scheduler polls the IMU, so it can't be used with fifo")
+    bus, bme, ag = open_sensors(probe)
+    if stats is not None:
+        snapshots=SnapshotWriter(Instrument().attach(bme,ag,bus.cs),stats).start()
+    if log is None:
+        cal = True
+        out_bme = print_bme
+        out_ag = lambda t_ns, sample: print_ag(sample)
+    else:
+        # Raw counts only -- calibration is in the log header
+        cal = False
+        meta = sensor_meta(bme, ag)
+        if decimate is None:
+            writer = SampleLogWriter(log, meta)
+        else:
+            from decimate import DecimatedLog
+            meta['decimation'] = decimate
+            writer = DecimatedLog(SampleLogWriter(log, meta), decimate)
+        # Date the BME680 from the middle of its conversion, as query() estimated it, not the read
+        out_bme = lambda sample: writer.write_bme680(int(bme.sample_time*1e9), sample[0], sample[3], sample[6])
+        out_ag = writer.write_lsm9ds1
+    try:
+        if scheduled:
+            # The scheduler already read the clock for each IMU sample, and the BME680 dates its own
+            outs={'bme680':lambda t,sample:out_bme(sample),
+                  'lsm9ds1':lambda t,sample:out_ag(int(t*1e9),sample)}
+            sched=Scheduler(bus,[bme680_task(bme,2,cal=cal),imu_task(ag,0)],sink=lambda name,t,sample:outs[name](t,sample))
+            sched.run()
+        stream = FifoStream(ag) if fifo else None
+        while True:
+            # Only visit the BME680 once its measurement is due, and read the IMU in the meantime
+            if time.monotonic()>=bme.ready_at:
+                if bme.poll():
+                    out_bme(bme.query(cal=cal))
+            if fifo:
+                for t_ns, sample in stream.poll():
+                    out_ag(t_ns, sample)
+                time.sleep(max(0.0, min(bme.ready_at, stream.next_drain)-time.monotonic()))
+                continue
+            sample = ag.query(burst=True)
+            if sample is None:
+                continue
+            out_ag(time.monotonic_ns(), sample)
+    finally:
+        if log is not None:
+            writer.close()
+        if stats is not None:
+            snapshots.stop()
 
 if __name__=="__main__":
     main()
\ No newline at end of file
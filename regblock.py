@@ -0,0 +1,173 @@
+"""
+Declarative register blocks. A driver declares a block of registers once --
+start address, length, and the fields in it -- and the block compiles that
+into a single struct.Struct plus, if any field isn't a plain struct type, one
+generated fix-up function that assembles the bit-packed fields from the
+unpacked bytes. The same declaration gives a NumPy structured dtype and
+decode_array() for bulk decoding of logged raw blocks.
+
+Plain fields use the struct format characters b, B, h, H, i, I, and the byte
+order of the block. Bit-packed fields (like the BME680's 20-bit pressure, or
+the nibble-split par_h1 and par_h2) are a list of pieces, each some bits of
+one byte, most significant piece first.
+"""
+import struct
+from typing import NamedTuple, Sequence
+
+
+class Field(NamedTuple):
+    """
+    Field which is a plain struct type
+    """
+    name:str
+    offset:int #: Offset from the start of the block in bytes
+    fmt:str    #: struct format character
+
+
+class BitField(NamedTuple):
+    """
+    Field assembled from bits of one or more bytes
+    """
+    name:str
+    pieces:Sequence[tuple] #: Tuples of (byte offset, lowest bit, number of bits), most significant first
+    signed:bool=False      #: Sign-extend the assembled value
+
+
+class RegBlock:
+    def __init__(self,name:str,start:int,length:int,fields:Sequence,endian:str='<'):
+        """
+
+        :param name: Name of the block, for messages
+        :param start: Address of the first register in the block
+        :param length: Length of the block in bytes
+        :param fields: Sequence of Field and BitField. Decoded values come out in this order.
+        :param endian: struct byte order for plain fields, '<' or '>'
+        """
+        self.name=name
+        self.start=start
+        self.length=length
+        self.fields=tuple(fields)
+        self.endian=endian
+        self.names=tuple(field.name for field in self.fields)
+        # Work out what is at each byte of the block: a plain field, a byte used by
+        # bit fields, or padding.
+        plain={}
+        piece_bytes=set()
+        for field in self.fields:
+            if isinstance(field,Field):
+                plain[field.offset]=field
+            else:
+                for offset,lsb,nbits in field.pieces:
+                    piece_bytes.add(offset)
+        # slots are (name, offset, struct format character) of each item in the unpacked tuple
+        self.slots=[]
+        fmt=endian
+        offset=0
+        while offset<length:
+            if offset in plain:
+                field=plain[offset]
+                size=struct.calcsize(endian+field.fmt)
+                if any(i in piece_bytes or (i in plain and i!=offset) for i in range(offset,offset+size)):
+                    raise ValueError(f"Field {field.name} overlaps another field in block {name}")
+                self.slots.append((field.name,offset,field.fmt))
+                fmt+=field.fmt
+                offset+=size
+            elif offset in piece_bytes:
+                self.slots.append((f"_b{offset:02x}",offset,'B'))
+                fmt+='B'
+                offset+=1
+            else:
+                fmt+='x'
+                offset+=1
+        self.struct=struct.Struct(fmt)
+        if self.struct.size!=length:
+            raise ValueError(f"Fields run past the end of block {name}")
+        slot_index={offset:i for i,(slot_name,offset,slot_fmt) in enumerate(self.slots)}
+        exprs=[]
+        for field in self.fields:
+            if isinstance(field,Field):
+                exprs.append(f"r[{slot_index[field.offset]}]")
+            else:
+                exprs.append(self._bitfield_expr(field,slot_index))
+        if exprs==[f"r[{i}]" for i in range(len(self.slots))]:
+            # Struct output is already the answer
+            self.fixup=None
+        else:
+            self.fixup_src="lambda r:("+",".join(exprs)+",)"
+            self.fixup=eval(self.fixup_src,{})
+    @staticmethod
+    def _bitfield_expr(field:BitField,slot_index:dict)->str:
+        terms=[]
+        shift=sum(nbits for offset,lsb,nbits in field.pieces)
+        total=shift
+        for offset,lsb,nbits in field.pieces:
+            shift-=nbits
+            term=f"r[{slot_index[offset]}]"
+            if lsb>0:
+                term=f"({term}>>{lsb})"
+            if lsb+nbits<8:
+                term=f"({term}&{(1<<nbits)-1:#x})"
+            if shift>0:
+                term=f"({term}<<{shift})"
+            terms.append(term)
+        expr="|".join(terms)
+        if field.signed:
+            expr=f"((({expr})^{1<<(total-1):#x})-{1<<(total-1):#x})"
+        return f"({expr})"
+    def decode(self,buf,offset:int=0)->tuple:
+        """
+        :param buf: Buffer holding the raw block, for instance from SPI_sensor.read_block()
+        :param offset: Offset of the block in buf
+        :return: Tuple of decoded field values, in declaration order
+        """
+        r=self.struct.unpack_from(buf,offset)
+        if self.fixup is None:
+            return r
+        return self.fixup(r)
+    def decode_dict(self,buf,offset:int=0)->dict:
+        return dict(zip(self.names,self.decode(buf,offset)))
+    def read(self,sensor)->tuple:
+        """
+        Read the block from a sensor in one transaction and decode it.
+
+        :param sensor: SPI_sensor to read from
+        """
+        return self.decode(sensor.read_block(self.start,self.length))
+    def dtype(self):
+        """
+        :return: NumPy structured dtype matching the raw block, with a member for each
+                 plain field and each byte used by bit fields, at its offset
+        """
+        import numpy as np
+        order='<' if self.endian=='<' else '>'
+        return np.dtype({'names':[name for name,offset,fmt in self.slots],
+                         'formats':[order+np.dtype(fmt).str[1:] for name,offset,fmt in self.slots],
+                         'offsets':[offset for name,offset,fmt in self.slots],
+                         'itemsize':self.length})
+    def decoded_dtype(self):
+        """
+        :return: NumPy structured dtype of the result of decode_array()
+        """
+        import numpy as np
+        return np.dtype([(field.name,np.dtype(field.fmt) if isinstance(field,Field) else np.int32) for field in self.fields])
+    def decode_array(self,raw):
+        """
+        Decode many raw blocks at once.
+
+        :param raw: NumPy array of raw blocks, either uint8 with shape (N,length), or
+                    any array with dtype()
+        :return: NumPy structured array of shape (N,) with decoded_dtype()
+        """
+        import numpy as np
+        raw=np.ascontiguousarray(raw)
+        if raw.dtype!=self.dtype():
+            raw=raw.view(np.uint8).reshape(-1,self.length).view(self.dtype()).reshape(-1)
+        result=np.empty(raw.shape,dtype=self.decoded_dtype())
+        if self.fixup is None:
+            for name in self.names:
+                result[name]=raw[name]
+            return result
+        r=[raw[name].astype(np.int64) for name,offset,fmt in self.slots]
+        for name,value in zip(self.names,self.fixup(r)):
+            result[name]=value
+        return result
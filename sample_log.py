@@ -0,0 +1,218 @@
+"""
+Compact binary sample log. Samples are written as fixed-size, timestamped
+records of raw decoded fields, tagged by device, into a file that grows in
+preallocated chunks. A header embeds the sensor settings and calibration
+needed to turn the raw fields into physical units later, as JSON.
+
+File layout:
+* Header, HEADER_SIZE bytes: header_struct (magic, version, record size,
+  header size, record count, metadata length), then the metadata JSON,
+  zero-padded
+* Records, RECORD_SIZE bytes each: t_ns (uint64, time.monotonic_ns()),
+  device tag (uint8), then the device payload, as laid out in record_blocks
+
+The reader memory-maps the records and views them as NumPy structured arrays
+without parsing. NumPy is only needed to read.
+"""
+import errno
+import json
+import os
+import struct
+
+from regblock import RegBlock, Field
+
+MAGIC=b'PYSPILOG'
+VERSION=1
+HEADER_SIZE=4096
+RECORD_SIZE=32
+header_struct=struct.Struct('<8sHHIQI')
+# Offset of the record count in the header, so it can be updated in place
+N_RECORDS_OFFSET=8+2+2+4
+
+# Device tags, and the record layout of each: t_ns, device tag, payload fields
+DEV_BME680=1
+DEV_LSM9DS1=2
+record_blocks={DEV_BME680 :RegBlock('bme680_record',0,RECORD_SIZE,(Field('t_ns'    , 0,'Q'),
+                                                                    Field('device'  , 8,'B'),
+                                                                    Field('rP'      ,12,'i'),
+                                                                    Field('rT'      ,16,'i'),
+                                                                    Field('rh'      ,20,'H'))),
+               DEV_LSM9DS1:RegBlock('lsm9ds1_record',0,RECORD_SIZE,(Field('t_ns'    , 0,'Q'),
+                                                                    Field('device'  , 8,'B'),
+                                                                    Field('status_g', 9,'B'),
+                                                                    Field('T'       ,10,'h'),
+                                                                    Field('gx'      ,12,'h'),
+                                                                    Field('gy'      ,14,'h'),
+                                                                    Field('gz'      ,16,'h'),
+                                                                    Field('ax'      ,18,'h'),
+                                                                    Field('ay'      ,20,'h'),
+                                                                    Field('az'      ,22,'h')))}
+
+
+def sensor_meta(bme=None,ag=None)->dict:
+    """
+    :param bme: BME680 after begin(), or None
+    :param ag: LSM9DS1_AG after begin(), or None
+    :return: Metadata for the log header: BME680 calibration and oversampling,
+             and LSM9DS1 full scales and output data rate
+    """
+    result={}
+    if bme is not None:
+        result['bme680']={'cal':bme.cal()._asdict(),
+                          'osrs_t':bme.osrs_t,'osrs_p':bme.osrs_p,'osrs_h':bme.osrs_h}
+    if ag is not None:
+        result['lsm9ds1']={'fs_g':ag.fs_g,'fs_a':ag.fs_a,'odr_g':ag.odr_g}
+    return result
+
+
+class SampleLogWriter:
+    def __init__(self,filename:str,meta:dict=None,chunk_records:int=65536):
+        """
+
+        :param filename: File to write, replaced if it exists
+        :param meta: Metadata to put in the header, for instance from sensor_meta()
+        :param chunk_records: Number of records to preallocate at a time
+        """
+        self.meta={} if meta is None else meta
+        self.chunk_records=chunk_records
+        self.n_records=0
+        self.n_allocated=0
+        self.buf=bytearray(RECORD_SIZE)
+        header=self.header(self.meta)
+        self.file=open(filename,'w+b')
+        self.file.write(header)
+    def __enter__(self)->"SampleLogWriter":
+        return self
+    def __exit__(self,exc_type,exc_val,exc_tb):
+        self.close()
+    def header(self,meta:dict)->bytearray:
+        """
+        :return: Header block for this metadata and the current record count
+        :raise ValueError: If the metadata doesn't fit
+        """
+        meta_json=json.dumps(meta).encode('utf-8')
+        if header_struct.size+len(meta_json)>HEADER_SIZE:
+            raise ValueError(f"Metadata is {len(meta_json)} bytes, too big for the header")
+        header=bytearray(HEADER_SIZE)
+        header_struct.pack_into(header,0,MAGIC,VERSION,RECORD_SIZE,HEADER_SIZE,self.n_records,len(meta_json))
+        header[header_struct.size:header_struct.size+len(meta_json)]=meta_json
+        return header
+    def update_meta(self,meta:dict):
+        """
+        Replace the header metadata, for instance to add results only known at the end.
+        If it doesn't fit, ValueError is raised and the old metadata stays.
+        """
+        header=self.header(meta)
+        pos=self.file.tell()
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.seek(pos)
+        self.meta=meta
+    def write(self,device:int,t_ns:int,*values):
+        """
+        Write one record
+
+        :param device: Device tag, DEV_*
+        :param t_ns: Timestamp, time.monotonic_ns()
+        :param values: Fields of the payload for this device, in record_blocks order
+        """
+        if self.n_records>=self.n_allocated:
+            self.allocate(1)
+        record_blocks[device].struct.pack_into(self.buf,0,t_ns,device,*values)
+        self.file.write(self.buf)
+        self.n_records+=1
+    def write_records(self,records:[bytes,memoryview]):
+        """
+        Write already-packed records, as from a pipeline.ShmRing
+
+        :param records: Whole number of records, each laid out as in record_blocks
+        """
+        n=len(records)//RECORD_SIZE
+        if self.n_records+n>self.n_allocated:
+            self.allocate(n)
+        self.file.write(records[:n*RECORD_SIZE])
+        self.n_records+=n
+    def allocate(self,n:int):
+        """
+        Grow the file by whole chunks until n more records fit. The chunk is
+        reserved with posix_fallocate() where the OS and filesystem have it, so
+        the disk blocks are really allocated now rather than on first write, and
+        a full disk shows up here. Otherwise the file is extended sparse.
+        """
+        old_size=HEADER_SIZE+self.n_allocated*RECORD_SIZE
+        while self.n_records+n>self.n_allocated:
+            self.n_allocated+=self.chunk_records
+        new_size=HEADER_SIZE+self.n_allocated*RECORD_SIZE
+        try:
+            os.posix_fallocate(self.file.fileno(),old_size,new_size-old_size)
+        except AttributeError:
+            self.file.truncate(new_size)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP,errno.EINVAL):
+                raise
+            self.file.truncate(new_size)
+        self.write_count()
+    def write_bme680(self,t_ns:int,rP:int,rT:int,rh:int):
+        self.write(DEV_BME680,t_ns,rP,rT,rh)
+    def write_lsm9ds1(self,t_ns:int,sample:tuple):
+        """
+        :param sample: Tuple from LSM9DS1_AG.query()
+        """
+        self.write(DEV_LSM9DS1,t_ns,*sample)
+    def write_count(self):
+        """
+        Update the record count in the header
+        """
+        pos=self.file.tell()
+        self.file.seek(N_RECORDS_OFFSET)
+        self.file.write(struct.pack('<Q',self.n_records))
+        self.file.seek(pos)
+    def flush(self):
+        self.write_count()
+        self.file.flush()
+    def close(self):
+        if self.file is None:
+            return
+        self.write_count()
+        self.file.truncate(HEADER_SIZE+self.n_records*RECORD_SIZE)
+        self.file.close()
+        self.file=None
+
+
+class SampleLogReader:
+    def __init__(self,filename:str,recover:bool=False):
+        """
+        Memory-map a log file.
+
+        :param filename: Log file written by SampleLogWriter
+        :param recover: If the file wasn't closed cleanly, the record count in the header
+                        may be short. If set, also use any records after that with a
+                        non-zero device tag.
+        """
+        import numpy as np
+        with open(filename,'rb') as inf:
+            head=inf.read(HEADER_SIZE)
+        magic,version,record_size,header_size,n_records,meta_len=header_struct.unpack_from(head)
+        if magic!=MAGIC or version!=VERSION:
+            raise ValueError(f"{filename} isn't a version {VERSION} sample log")
+        self.meta=json.loads(head[header_struct.size:header_struct.size+meta_len].decode('utf-8'))
+        n_space=(os.path.getsize(filename)-header_size)//record_size
+        raw=np.memmap(filename,dtype=np.uint8,mode='r',offset=header_size,shape=(n_space,record_size))
+        if recover:
+            while n_records<n_space and raw[n_records,8]!=0:
+                n_records+=1
+        self.raw=raw[:n_records]
+    def __len__(self)->int:
+        return len(self.raw)
+    def device(self,device:int):
+        """
+        :param device: Device tag, DEV_*
+        :return: Structured array of the records for this device, with record_blocks[device].dtype().
+                 This is a copy of just those records; the view of all records is self.raw.
+        """
+        records=self.raw.reshape(-1).view(record_blocks[device].dtype())
+        return records[records['device']==device]
+    def bme680(self):
+        return self.device(DEV_BME680)
+    def lsm9ds1(self):
+        return self.device(DEV_LSM9DS1)
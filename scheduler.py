@@ -0,0 +1,189 @@
+"""
+Multi-rate acquisition scheduler for devices behind the ChipSelect decoder.
+
+Each device gets one or more tasks, each with a 74x138 address and a target
+period. The scheduler runs tasks on a deadline basis: every time round, it
+collects the tasks that are due, groups them by decoder address so that each
+address is selected once, starts with the address already selected, and
+otherwise visits addresses in order of their earliest deadline. Between
+deadlines it sleeps.
+
+A task that runs more than one period after it was due has missed one deadline
+for each whole period it was late, and its next deadline skips ahead rather
+than trying to catch up. A task whose device knows when its data is due, and
+whose data isn't ready yet at that time, is tried again after a short retry
+interval instead; the device being late isn't a missed deadline.
+"""
+import time
+from typing import Callable
+
+from chip_select import ChipSelect
+
+
+class Task:
+    def __init__(self,name:str,addr:int,period:float,action:Callable,deadline:Callable=None,target_rate:float=None,
+                 retry:float=None):
+        """
+
+        :param name: Name of the task, used in reports and passed to the sink
+        :param addr: Decoder address of the device
+        :param period: Target time between runs in seconds
+        :param action: Function with no arguments, run with the device selected. Returns
+                       a sample, or None if there was nothing new to read.
+        :param deadline: Optional function with no arguments returning the time.monotonic()
+                         of the next deadline, for devices that know when their data is
+                         due (like BME680.ready_at). Otherwise deadlines are every period.
+        :param target_rate: Expected samples per second, for reports. Default is one per period.
+        :param retry: With deadline, time to wait before trying again if the action returns None
+                      once the deadline has passed. Default is a tenth of the period.
+        """
+        self.name=name
+        self.addr=addr
+        self.period=period
+        self.action=action
+        self.deadline=deadline
+        self.target_rate=1.0/period if target_rate is None else target_rate
+        self.retry=0.1*period if retry is None else retry
+        self.next_due=0.0
+        self.n_runs=0
+        self.n_samples=0
+        self.n_missed=0
+        self.t_first=None
+        self.t_last=None
+    def rate(self)->float:
+        """
+        :return: Achieved rate of samples per second
+        """
+        if self.n_samples<2 or self.t_last==self.t_first:
+            return 0.0
+        return (self.n_samples-1)/(self.t_last-self.t_first)
+
+
+def imu_task(ag,addr:int,name:str='lsm9ds1',oversample:float=2.0)->Task:
+    """
+    :param ag: LSM9DS1_AG, after begin()
+    :param oversample: Poll this many times per sample period. The IMU runs on its own
+                       clock, so polling at exactly the output data rate would beat against
+                       it and drop samples. query(burst=True) returns None for polls between
+                       samples, so oversampling doesn't duplicate data.
+    :return: Task reading the IMU at its gyro output data rate
+    """
+    return Task(name,addr,1.0/(ag.odr_g*oversample),lambda:ag.query(burst=True),target_rate=ag.odr_g)
+
+
+def bme680_task(bme,addr:int,name:str='bme680',cal:bool=True,retry:float=0.001)->Task:
+    """
+    :param bme: BME680, after begin()
+    :param cal: Calibrate each sample, see BME680.query()
+    :param retry: Time to wait before polling again if a conversion isn't done at ready_at
+    :return: Task reading the BME680 when each conversion is due, and starting the next
+    """
+    return Task(name,addr,bme.meas_dur,lambda:bme.query(cal=cal) if bme.poll() else None,deadline=lambda:bme.ready_at,
+                retry=retry)
+
+
+class Scheduler:
+    def __init__(self,cs:ChipSelect,tasks=(),sink:Callable=None,clock:Callable=time.monotonic,sleep:Callable=time.sleep):
+        """
+
+        :param cs: Chip select decoder, after begin(), or the spi_bus.SPIBus that owns it.
+                   Pass the bus if the sensors use its devices, so that it knows the
+                   decoder address.
+        :param tasks: Initial tasks
+        :param sink: Function called as sink(name,t,sample) for each sample a task returns
+        :param clock: Time source, in seconds
+        :param sleep: Function to sleep between deadlines
+        """
+        self.cs=cs
+        self.tasks=[]
+        self.sink=sink
+        self.clock=clock
+        self.sleep=sleep
+        self.addr=None
+        self.n_addr_switches=0
+        for task in tasks:
+            self.add(task)
+    def add(self,task:Task)->Task:
+        task.next_due=self.clock()
+        self.tasks.append(task)
+        return task
+    def select(self,addr:int):
+        if addr!=self.addr:
+            self.cs.set_addr(addr)
+            self.addr=addr
+            self.n_addr_switches+=1
+    def plan(self,now:float)->list:
+        """
+        :return: List of (addr, tasks) for the tasks due at now, in the order to visit them
+        """
+        groups={}
+        for task in self.tasks:
+            if task.next_due<=now:
+                groups.setdefault(task.addr,[]).append(task)
+        for tasks in groups.values():
+            tasks.sort(key=lambda task:task.next_due)
+        return sorted(groups.items(),key=lambda item:(item[0]!=self.addr,item[1][0].next_due))
+    def run_task(self,task:Task):
+        sample=task.action()
+        now=self.clock()
+        task.n_runs+=1
+        if sample is not None:
+            task.n_samples+=1
+            if task.t_first is None:
+                task.t_first=now
+            task.t_last=now
+            if self.sink is not None:
+                self.sink(task.name,now,sample)
+        if task.deadline is not None:
+            next_due=task.deadline()
+            if next_due>now:
+                task.next_due=next_due
+                return
+            if sample is None:
+                # Due but not ready yet: look again shortly, rather than a whole period later
+                task.next_due=now+task.retry
+                return
+        late=now-task.next_due
+        missed=int(late//task.period)
+        task.n_missed+=missed
+        task.next_due+=(missed+1)*task.period
+    def step(self)->int:
+        """
+        Run all due tasks once, or sleep until the next one is due.
+
+        :return: Number of tasks run. Always 0, without sleeping, if there are no tasks.
+        """
+        if len(self.tasks)==0:
+            return 0
+        now=self.clock()
+        plan=self.plan(now)
+        if len(plan)==0:
+            self.sleep(max(0.0,min(task.next_due for task in self.tasks)-now))
+            return 0
+        result=0
+        for addr,tasks in plan:
+            self.select(addr)
+            for task in tasks:
+                self.run_task(task)
+                result+=1
+        return result
+    def run(self,duration:float=None):
+        """
+        :param duration: Time to run in seconds, or None to run forever
+        """
+        t1=None if duration is None else self.clock()+duration
+        while t1 is None or self.clock()<t1:
+            self.step()
+    def report(self)->dict:
+        """
+        :return: Dictionary with 'tasks', a dictionary by task name of target rate, achieved
+                 rate, samples, runs, and missed deadlines, and 'addr_switches', the number
+                 of times the decoder address was changed
+        """
+        return {'tasks':{task.name:{'addr':task.addr,
+                                    'target_rate':task.target_rate,
+                                    'achieved_rate':task.rate(),
+                                    'samples':task.n_samples,
+                                    'runs':task.n_runs,
+                                    'missed':task.n_missed} for task in self.tasks},
+                'addr_switches':self.n_addr_switches}
@@ -0,0 +1,363 @@
+"""
+Deterministic checks of promises the drivers make, run against the spisim
+simulated bus so they work without a Pi. Each check raises AssertionError
+with a description of the first thing that doesn't hold, or lets through
+whatever the code under test raised.
+
+    python selfcheck.py            # run every check
+    python selfcheck.py bme680_batch
+
+Exit status is 1 if any check failed.
+"""
+import argparse
+import contextlib
+import io
+import sys
+
+import spisim
+
+
+def sim_device(addr:int):
+    """
+    :param addr: Decoder address
+    :return: spi_bus.SPIDevice at that address on the installed simulated bus
+    """
+    from spidev import SpiDev
+    from chip_select import ChipSelect
+    from spi_bus import SPIBus
+    cs=ChipSelect()
+    cs.begin()
+    spi=SpiDev()
+    spi.open(0,0)
+    return SPIBus(spi,cs).device(addr)
+
+
+def bme680_batch():
+    """
+    bme680_batch.calibrate() must match BME680.calibrate_T(), calibrate_P() and
+    calibrate_h() bit-for-bit. The reference dataset is the simulated chip's
+    calibration and a grid of raw counts spanning each ADC's whole range, so
+    that the humidity clamps at both ends are covered too.
+    """
+    import numpy as np
+    spisim.install()
+    from bme680 import BME680
+    import bme680_batch
+    bme=BME680(sim_device(2))
+    with contextlib.redirect_stdout(io.StringIO()):
+        bme.begin()
+    # 20-bit pressure and temperature, 16-bit humidity
+    grid_20=np.linspace(0,(1<<20)-1,33).astype(np.int64)
+    grid_16=np.linspace(0,(1<<16)-1,33).astype(np.int64)
+    rP,rT,rh=(a.ravel() for a in np.meshgrid(grid_20,grid_20,grid_16,indexing='ij'))
+    P,T,h=bme680_batch.calibrate(bme.cal(),rP,rT,rh)
+    for i in range(len(rP)):
+        T_s,t_fine=bme.calibrate_T(int(rT[i]))
+        P_s=bme.calibrate_P(int(rP[i]),t_fine)
+        h_s=bme.calibrate_h(int(rh[i]),T_s)
+        batch=(float(P[i]),float(T[i]),float(h[i]))
+        assert batch==(P_s,T_s,h_s),f"rP={rP[i]} rT={rT[i]} rh={rh[i]}: batch {batch}, scalar {(P_s,T_s,h_s)}"
+    return f"{len(rP)} samples"
+
+
+def drdy(n:int=50,odr_g:float=119.0,int1_pin:int=7):
+    """
+    drdy.acquire() must read once per data-ready edge from the simulated LSM9DS1,
+    whose INT1 pin is driven on schedule by the bus ticker, and fall back to the
+    timeout when an edge is missed or never comes.
+    """
+    import time
+    bus=spisim.SimBus()
+    bus.attach(0,spisim.LSM9DS1Model(int1_pin=int1_pin))
+    spisim.install(bus)
+    from lsm9ds1 import LSM9DS1_AG
+    from drdy import DataReadyTrigger, acquire
+    ag=LSM9DS1_AG(sim_device(0))
+    ag.begin(odr_g=odr_g)
+    trigger=DataReadyTrigger(int1_pin)
+    trigger.begin()
+    ag.enable_int1(drdy_g=True)
+    reads=[]
+    sink=lambda t_ns,data:reads.append(t_ns)
+    bus.start_ticker()
+    try:
+        # Every read is triggered by an edge, at the output data rate
+        t0=time.monotonic()
+        acquire(ag,trigger,sink,count=n)
+        dt=time.monotonic()-t0
+        n_timeouts=reads.count(None)
+        assert len(reads)==n and n_timeouts==0,f"{len(reads)} samples from {n} reads, {n_timeouts} after a timeout"
+        assert 0.5*n/odr_g<dt<2.0*n/odr_g,f"{n} edge-triggered reads took {dt:.3f}s at {odr_g}Hz"
+        # A missed edge leaves data-ready active, so no more edges come until the
+        # timeout read clears it, and then they do
+        time.sleep(10/odr_g)
+        while trigger.wait(0) is not None:
+            pass
+        reads.clear()
+        acquire(ag,trigger,sink,count=n)
+        n_timeouts=reads.count(None)
+        assert len(reads)==n and n_timeouts==1,f"after a missed edge, {len(reads)} samples from {n} reads, {n_timeouts} after a timeout"
+        # Powered down, nothing arrives, and each read waits out the timeout
+        ag.begin(odr_g=0,odr_a=0)
+        ag.query(burst=True)
+        while trigger.wait(0) is not None:
+            pass
+        reads.clear()
+        timeout=0.01
+        t0=time.monotonic()
+        acquire(ag,trigger,sink,timeout=timeout,count=3)
+        dt=time.monotonic()-t0
+        assert len(reads)==0 and dt>=3*timeout,f"powered down, {len(reads)} samples in {dt:.3f}s"
+        try:
+            acquire(ag,trigger,sink,count=1)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("powered down, acquire() ran without an explicit timeout")
+    finally:
+        bus.stop_ticker()
+        trigger.end()
+    return f"{n} edge-triggered reads, recovery from a missed edge, timeouts"
+
+
+def shadow():
+    """
+    The register shadow must write only what changed, one auto-increment burst per
+    run of consecutive dirty registers, and verify_shadow() must catch a register
+    the chip doesn't agree with.
+    """
+    bus=spisim.install()
+    from lsm9ds1 import LSM9DS1_AG
+    ag=LSM9DS1_AG(sim_device(0))
+    bus.reset_stats()
+    ag.begin()
+    assert bus.n_xfer==2,f"begin() took {bus.n_xfer} transactions, expected 2 bursts"
+    cases=(((),0),
+           ((ag.CTRL_REG1_G,ag.CTRL_REG2_G,ag.CTRL_REG3_G),1),
+           ((ag.CTRL_REG1_G,ag.CTRL_REG3_G),2),
+           ((ag.CTRL_REG1_G,ag.CTRL_REG2_G,ag.CTRL_REG6_XL),2))
+    for regs,expected in cases:
+        for reg in regs:
+            ag.set_reg(reg,ag.read_shadow(reg)^0x01)
+        # Setting a register to what it already holds mustn't dirty it
+        ag.set_reg(ag.CTRL_REG8,ag.read_shadow(ag.CTRL_REG8))
+        bus.reset_stats()
+        n=ag.flush()
+        assert n==expected==bus.n_xfer,f"flush() of {[hex(reg) for reg in regs]} reported {n} and took {bus.n_xfer} transactions, expected {expected}"
+    ag.verify_shadow(ag.CTRL_REG1_G,ag.CTRL_REG3_G-ag.CTRL_REG1_G+1)
+    bus.devices[0].regs[ag.CTRL_REG2_G]^=0x01
+    try:
+        ag.verify_shadow(ag.CTRL_REG1_G,ag.CTRL_REG3_G-ag.CTRL_REG1_G+1)
+    except IOError:
+        pass
+    else:
+        raise AssertionError("verify_shadow() missed a register that differs from the shadow")
+    return f"{len(cases)} flushes grouped into bursts, mismatch detected"
+
+
+def probe():
+    """
+    spi_bus.probe_speed() must find a working rate for a BME680 that a previous run
+    left on either register page, and never clock a part above its max_spi_hz,
+    even when the part itself would go faster.
+    """
+    bus=spisim.default_bus()
+    spisim.install(bus)
+    from bme680 import BME680
+    from lsm9ds1 import LSM9DS1_AG
+    from spi_bus import probe_speed
+    speeds=[]
+    xfer=bus.xfer
+    def spy(tx,ce=0,speed_hz=500_000):
+        speeds.append(speed_hz)
+        return xfer(tx,ce,speed_hz)
+    bus.xfer=spy
+    checked=[]
+    for page in (0,1):
+        # Leave the chip on this page, as a driver from an earlier run would have
+        bme=BME680(sim_device(2))
+        with contextlib.redirect_stdout(io.StringIO()):
+            bme.begin()
+        bme.set_page(page,force=True)
+        bme=BME680(bme.spi)
+        speeds.clear()
+        speed=probe_speed(bme.spi,bme)
+        assert max(speeds)<=BME680.max_spi_hz,f"BME680 left on page {page} was clocked at {max(speeds)} Hz"
+        assert bme.whoami()==bme.whoami_value,f"BME680 left on page {page} doesn't answer at the probed {speed} Hz"
+        checked.append(speed)
+    # The part fails above 4MHz, below its rating, so the margin applies
+    bus.devices[0].max_hz=4_000_000
+    ag=LSM9DS1_AG(sim_device(0))
+    speeds.clear()
+    speed=probe_speed(ag.spi,ag)
+    assert max(speeds)<=LSM9DS1_AG.max_spi_hz,f"LSM9DS1 was clocked at {max(speeds)} Hz"
+    assert speed<=bus.devices[0].max_hz//2,f"LSM9DS1 failing above {bus.devices[0].max_hz} Hz was set to {speed} Hz"
+    assert ag.whoami()==ag.whoami_value,f"LSM9DS1 doesn't answer at the probed {speed} Hz"
+    checked.append(speed)
+    return "rates "+", ".join(f"{speed} Hz" for speed in checked)
+
+
+def ring():
+    """
+    pipeline.ShmRing must account for every record pushed: each consumer either
+    reads it, in order, or counts it as an overrun once the producer has lapped it.
+    """
+    import struct
+    from pipeline import ShmRing
+    from sample_log import DEV_BME680, RECORD_SIZE
+    capacity=8
+    ring=ShmRing(capacity=capacity,n_consumers=2)
+    try:
+        fast,slow=ring.consumer(0),ring.consumer(1)
+        n=0
+        def push(count):
+            nonlocal n
+            for _ in range(count):
+                ring.push(DEV_BME680,n,n,n,n)
+                n+=1
+        def times(records):
+            return [struct.unpack_from('<Q',records,i)[0] for i in range(0,len(records),RECORD_SIZE)]
+        push(5)
+        got=times(fast.read())
+        assert got==list(range(5)),f"read {got} from a ring that never wrapped"
+        push(3*capacity)
+        for name,consumer,t0 in (('fast',fast,5),('slow',slow,0)):
+            got=times(consumer.read())
+            assert len(got)>0 and got==list(range(got[0],n)),f"{name} consumer read {got} after being lapped, expected a run ending at {n-1}"
+            assert consumer.n_overrun==got[0]-t0,f"{name} consumer skipped {got[0]-t0} records but counted {consumer.n_overrun} overruns"
+        stats=ring.stats()
+        assert stats['pushed']==n,f"stats report {stats['pushed']} pushed, expected {n}"
+        assert stats['overwritten']==n-capacity,f"stats report {stats['overwritten']} overwritten with a consumer that never read, expected {n-capacity}"
+        for i,consumer in enumerate((fast,slow)):
+            assert stats['consumers'][i]=={'consumed':n,'overruns':consumer.n_overrun},f"stats for consumer {i} are {stats['consumers'][i]}"
+        assert fast.read()==b'',"read records from a drained ring"
+    finally:
+        ring.close()
+        ring.unlink()
+    return f"{n} records, overruns {fast.n_overrun} and {slow.n_overrun}"
+
+
+def scheduler():
+    """
+    scheduler.Scheduler, on a simulated clock, must group due tasks by decoder
+    address, read a device with a deadline promptly once it is actually ready even
+    when that is after the deadline, and count the periods a stall made it miss.
+    """
+    spisim.install()
+    from scheduler import Scheduler, Task
+    t=0.0
+    def clock():
+        return t
+    def sleep(dt):
+        nonlocal t
+        t+=dt
+    selected=[]
+    class Decoder:
+        def set_addr(self,addr):
+            selected.append(addr)
+    period=0.01
+    stall=0.035
+    stalled=False
+    def periodic():
+        nonlocal t,stalled
+        if not stalled and t>=0.5:
+            stalled=True
+            t+=stall
+        return t
+    # A conversion that is due every 0.1s, but is 3ms late. Polls before then get nothing.
+    conv_period=0.1
+    late=0.003
+    retry=0.001
+    ready_at=0.05
+    delays=[]
+    def conversion():
+        nonlocal ready_at
+        if t<ready_at+late:
+            return None
+        delays.append(t-(ready_at+late))
+        ready_at+=conv_period
+        return t
+    tasks=[Task('a',0,period,periodic),
+           Task('conv',2,conv_period,conversion,deadline=lambda:ready_at,retry=retry),
+           Task('b',0,period,periodic)]
+    sched=Scheduler(Decoder(),tasks,clock=clock,sleep=sleep)
+    assert Scheduler(Decoder(),clock=clock,sleep=sleep).step()==0,"step() with no tasks ran something"
+    while t<1.0:
+        selected.clear()
+        sched.step()
+        assert len(selected)==len(set(selected)),f"at t={t:.3f}s one step selected addresses {selected}"
+    report=sched.report()
+    runs=sum(task['runs'] for task in report['tasks'].values())
+    assert len(delays)==10,f"{len(delays)} conversions read in 1s, expected 10"
+    assert max(delays)<=retry+1e-9,f"a conversion was read {max(delays)*1000:.3f}ms after it was ready"
+    assert report['tasks']['conv']['missed']==0,f"conversion task missed {report['tasks']['conv']['missed']} deadlines"
+    for name in ('a','b'):
+        missed=report['tasks'][name]['missed']
+        assert missed==int(stall//period),f"task {name} counted {missed} missed periods for a {stall}s stall"
+    return f"{runs} runs, {sched.n_addr_switches} decoder switches, conversions read at most {max(delays)*1000:.3f}ms late"
+
+
+def sample_log():
+    """
+    A sample log that was never closed must read back as far as the header's record
+    count, and with recover=True, every record that reached the file. The chunk is big
+    enough that growing the file doesn't update the count behind the check's back.
+    """
+    import os
+    import tempfile
+    from sample_log import SampleLogReader, SampleLogWriter
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename=os.path.join(tmpdir,'crashed.log')
+        writer=SampleLogWriter(filename,chunk_records=64)
+        n_counted,n_written=10,25
+        for i in range(n_written):
+            writer.write_bme680(i,i,i,i)
+            if i==n_counted-1:
+                writer.flush()
+        # The process dies after the OS has the records, but before close() updates the count
+        writer.file.flush()
+        writer.file.close()
+        writer.file=None
+        for recover,expected in ((False,n_counted),(True,n_written)):
+            reader=SampleLogReader(filename,recover=recover)
+            t_ns=list(reader.bme680()['t_ns'])
+            assert t_ns==list(range(expected)),f"recover={recover} read {len(t_ns)} records, expected {expected}"
+        filename=os.path.join(tmpdir,'closed.log')
+        with SampleLogWriter(filename,chunk_records=16) as writer:
+            for i in range(n_written):
+                writer.write_bme680(i,i,i,i)
+        assert len(SampleLogReader(filename))==len(SampleLogReader(filename,recover=True))==n_written,"closed log reads back short"
+    return f"{n_counted} counted, {n_written} recovered"
+
+
+checks={'bme680_batch':bme680_batch,
+        'drdy':drdy,
+        'shadow':shadow,
+        'probe':probe,
+        'ring':ring,
+        'scheduler':scheduler,
+        'sample_log':sample_log}
+
+
+def main(argv=None)->int:
+    parser=argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('names',nargs='*',help=f"Checks to run, from {', '.join(checks)}. Default all.")
+    args=parser.parse_args(argv)
+    for name in args.names:
+        if name not in checks:
+            parser.error(f"unknown check {name}")
+    result=0
+    for name in args.names or checks:
+        try:
+            print(f"{name:16s} ok, {checks[name]()}")
+        except AssertionError as e:
+            print(f"{name:16s} FAILED: {e}")
+            result=1
+        except Exception as e:
+            print(f"{name:16s} FAILED: {type(e).__name__}: {e}")
+            result=1
+    return result
+
+
+if __name__=="__main__":
+    sys.exit(main())
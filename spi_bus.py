@@ -0,0 +1,155 @@
+"""
+SPI bus arbiter. An SPIBus owns the SpiDev and the ChipSelect decoder for one
+Pi SPI bus, and hands out an SPIDevice for each device on the decoder. Each
+SPIDevice has the xfer() of a SpiDev, so it can be passed to any SPI_sensor
+in place of the raw SpiDev. On every transaction the bus:
+
+* takes its lock, so transactions from several threads don't interleave
+  with another thread's decoder change,
+* writes the decoder address only if it differs from the last one written,
+* sets max_speed_hz and mode only if they differ from the last device's.
+
+Use the SPIDevice as a context manager to hold the bus across several
+transactions. A sensor object (and its transfer buffers) should still only
+be used from one thread at a time.
+"""
+import threading
+from typing import Sequence
+
+from spidev import SpiDev
+
+from chip_select import ChipSelect
+from spi_sensor import SPI_sensor
+
+# Allowed SPI from table at https://www.takaitra.com/spi-device-raspberry-pi/
+ALLOWED_SPI_SPD = (125_000_000,
+                   62_500_000,
+                   31_200_000,
+                   15_600_000,
+                   7_800_000,
+                   3_900_000,
+                   1_953_000,
+                   976_000,
+                   488_000,
+                   244_000,
+                   122_000,
+                   61_000,
+                   30_500,
+                   15_200,
+                   7_629)
+
+
+class SPIDevice:
+    def __init__(self,bus:"SPIBus",addr:int,max_speed_hz:int,mode:int):
+        """
+        Don't construct directly, use SPIBus.device()
+        """
+        self.bus=bus
+        self.addr=addr
+        self.max_speed_hz=max_speed_hz
+        self.mode=mode
+    def xfer(self,buf)->list:
+        with self.bus.lock:
+            self.bus.select(self)
+            return self.bus.spi.xfer(buf)
+    def __enter__(self)->"SPIDevice":
+        self.bus.lock.acquire()
+        self.bus.select(self)
+        return self
+    def __exit__(self,exc_type,exc_val,exc_tb):
+        self.bus.lock.release()
+
+
+class SPIBus:
+    def __init__(self,spi:SpiDev,cs:ChipSelect=None):
+        """
+
+        :param spi: Opened SpiDev
+        :param cs: Chip select decoder, after begin(). None if there is only one device,
+                   on ~CE directly.
+        """
+        self.spi=spi
+        self.cs=cs
+        self.lock=threading.RLock()
+        self.addr=None
+        self.max_speed_hz=None
+        self.mode=None
+        self.n_addr_switches=0
+        self.n_speed_switches=0
+        self.n_mode_switches=0
+    def device(self,addr:int=0,max_speed_hz:int=3_900_000,mode:int=0b00)->SPIDevice:
+        """
+        :param addr: Decoder address of the device
+        :param max_speed_hz: SPI clock to use for this device
+        :param mode: SPI mode to use for this device
+        :return: Transaction context for the device
+        """
+        return SPIDevice(self,addr,max_speed_hz,mode)
+    def set_addr(self,addr:int):
+        """
+        Put an address on the decoder, if it isn't there already. Has the same
+        signature as ChipSelect.set_addr(), so the bus can be used in its place,
+        for instance by the scheduler.
+        """
+        with self.lock:
+            if self.cs is not None and addr!=self.addr:
+                self.cs.set_addr(addr)
+                self.n_addr_switches+=1
+            self.addr=addr
+    def select(self,device:SPIDevice):
+        """
+        Set up the bus for a device. Call with the lock held.
+        """
+        self.set_addr(device.addr)
+        if device.max_speed_hz!=self.max_speed_hz:
+            self.spi.max_speed_hz=device.max_speed_hz
+            self.max_speed_hz=device.max_speed_hz
+            self.n_speed_switches+=1
+        if device.mode!=self.mode:
+            self.spi.mode=device.mode
+            self.mode=device.mode
+            self.n_mode_switches+=1
+
+
+def probe_speed(device:SPIDevice,sensor:SPI_sensor,speeds:Sequence[int]=ALLOWED_SPI_SPD,
+                trials:int=20,margin:int=1,verbose:bool=False)->int:
+    """
+    Find the fastest SPI clock a device works reliably at, and set the device to use it.
+
+    Steps up through the allowed rates from the slowest, checking each with
+    SPI_sensor.check_link(), and stops at the first that fails. Rates above the
+    sensor's max_spi_hz are never tried, so the part isn't driven past its rating.
+    The whoami() checks come first, so the write/readback of the scratch register
+    only happens at rates where reads already work. If a rate failed, the chosen
+    rate is margin steps below the fastest that passed, otherwise it is the fastest.
+    Afterwards, SPI_sensor.resync() repairs any driver state that a garbled
+    transaction at a too-fast rate might have desynchronized.
+
+    :param device: Device on the bus, as used by sensor
+    :param sensor: Sensor to check with
+    :param speeds: Candidate SPI clock rates
+    :param trials: Number of whoami() checks at each rate
+    :param margin: Number of steps to back off from the fastest reliable rate
+    :param verbose: Print the result at each rate
+    :return: The chosen rate, which is also set as device.max_speed_hz
+    """
+    speeds=sorted(speed for speed in speeds if sensor.max_spi_hz is None or speed<=sensor.max_spi_hz)
+    if len(speeds)==0:
+        raise ValueError(f"No candidate SPI clock rate is within {type(sensor).__name__}.max_spi_hz")
+    best=None
+    failed=False
+    for i,speed in enumerate(speeds):
+        device.max_speed_hz=speed
+        ok=sensor.check_link(trials)
+        if verbose:
+            print(f"{type(sensor).__name__} at {speed} Hz: {'ok' if ok else 'failed'}")
+        if not ok:
+            failed=True
+            break
+        best=i
+    if best is None:
+        device.max_speed_hz=speeds[0]
+        raise IOError(f"{type(sensor).__name__} doesn't respond at any SPI clock rate")
+    device.max_speed_hz=speeds[max(0,best-margin) if failed else best]
+    sensor.resync()
+    return device.max_speed_hz
@@ -1,5 +1,7 @@
 #!/usr/bin/python
 
+import time
+
 import spidev
 
 from bits import extract_uint16_le, extract_int16_le
@@ -22,32 +24,229 @@ class SPI_sensor:
       the transaction is over and ~CS can be raised.
 
     Register auto-increment is a property of the sensor, not this protocol.
+
+    Control registers can go through a write-through shadow: set_reg() and
+    set_field() change the shadow and mark registers dirty, flush() writes the
+    dirty ones in as few transactions as the sensor allows, and read_shadow()
+    answers from the shadow without touching the bus unless forced. Every
+    write_reg() also updates the shadow, so it stays in step.
     """
+    # Value whoami() should return, for link checks
+    whoami_value=None
+    # Register which can be written and read back without affecting the sensor, for link checks
+    scratch_reg=None
+    # Fastest SPI clock in the sensor datasheet
+    max_spi_hz=None
     def __init__(self,spi:spidev.SpiDev):
         """
 
-        :param spi: Reference to SPI device to use. Set the speed
-                    etc outside of this module.
+        :param spi: Reference to SPI device to use. Either a SpiDev, with the speed
+                    etc set outside of this module, or an spi_bus.SPIDevice, which
+                    selects the device and sets its speed and mode on each transaction.
 
         """
         self.spi=spi
+        # Running count of SPI transactions (~CS assertions) made by this sensor.
+        # Compare before and after a query() to get transactions per sample.
+        self.n_xfer=0
+        # Preallocated transfer buffers for each read size, see read_block()
+        self.bufs={}
+        self.write_buf=bytearray(2)
+        # instrument.Instrument recording this sensor's transactions, or None. See Instrument.attach().
+        self.inst=None
+        self.inst_name=type(self).__name__
+        # Register shadow: last value written or read back for each register, and
+        # registers set in the shadow but not yet written
+        self.shadow={}
+        self.dirty=set()
+    def xfer(self,buf)->list:
+        """
+        Do one SPI transaction. All register access goes through here
+        so that it can be counted, and timed if instrumented.
+        :param buf: Bytes to send, including the command/address byte
+        :return: Bytes received, same length as buf
+        """
+        self.n_xfer+=1
+        if self.inst is None:
+            return self.spi.xfer(buf)
+        t0=time.perf_counter_ns()
+        result=self.spi.xfer(buf)
+        self.inst.record_xfer(self.inst_name,buf,time.perf_counter_ns()-t0)
+        return result
+    def buffers(self,count:int)->tuple:
+        """
+        :param count: Number of data bytes in the transaction
+        :return: Tuple of (transmit bytearray, receive bytearray, memoryview of receive data bytes),
+                 each count+1 bytes long except the view, created on first use and reused after.
+        """
+        try:
+            return self.bufs[count]
+        except KeyError:
+            rx=bytearray(count+1)
+            self.bufs[count]=(bytearray(count+1),rx,memoryview(rx)[1:])
+            return self.bufs[count]
+    def read_block(self,reg_addr:int,count:int)->memoryview:
+        """
+        Read a block of registers into this sensor's preallocated buffer for that size.
+
+        :param reg_addr: First register to read
+        :param count: Number of bytes to read
+        :return: memoryview of the data. This view is reused, and will be overwritten by
+                 the next read_block() of the same size. Copy it with bytes() if you need to keep it.
+        """
+        tx,rx,view=self.buffers(count)
+        tx[0]=reg_addr | 0x80
+        rx[:]=self.xfer(tx)
+        return view
+    def read_into(self,reg_addr:int,buf:memoryview)->memoryview:
+        """
+        Read a block of registers into a caller-supplied buffer.
+
+        :param reg_addr: First register to read
+        :param buf: Writable buffer, for instance a memoryview slice of a bytearray.
+                    The read is as long as the buffer.
+        :return: buf
+        """
+        buf[:]=self.read_block(reg_addr,len(buf))
+        return buf
     def read_reg(self,reg_addr:int,count:int=1)->[bytes,int]:
-        result = self.spi.xfer([reg_addr | 0x80] + [0] * (count))[1:]
+        result = self.read_block(reg_addr,count)
         if count == 1:
             return result[0]
         else:
-            return result
+            return bytes(result)
     def write_reg(self,reg_addr:int,values:[bytes,int])->None:
         if type(values)==int:
-            values=bytes([values])
-        self.spi.xfer(bytes([reg_addr & 0x7f])+values)
+            self.write_buf[0]=reg_addr & 0x7f
+            self.write_buf[1]=values
+            self.xfer(self.write_buf)
+            self.written(reg_addr,(values,))
+            return
+        self.xfer(bytes([reg_addr & 0x7f])+values)
+        self.written(reg_addr,values)
+    def written(self,reg_addr:int,values)->None:
+        """
+        Update the shadow after a write. Multi-byte writes are assumed to auto-increment;
+        sensors that do something else override this.
+
+        :param reg_addr: Register the write started at
+        :param values: Data bytes written
+        """
+        for i,value in enumerate(values):
+            self.shadow[reg_addr+i]=value
+            self.dirty.discard(reg_addr+i)
+    def set_reg(self,reg_addr:int,value:int)->None:
+        """
+        Set a register in the shadow. It is written by the next flush(), if it changed.
+        """
+        if self.shadow.get(reg_addr)!=value:
+            self.shadow[reg_addr]=value
+            self.dirty.add(reg_addr)
+    def set_field(self,reg_addr:int,lsb:int,nbits:int,value:int)->None:
+        """
+        Set some bits of a register in the shadow, leaving the others alone. If the
+        register isn't in the shadow yet, it is read from the sensor first.
+
+        :param lsb: Lowest bit of the field
+        :param nbits: Width of the field in bits
+        :param value: New value of the field
+        """
+        mask=((1 << nbits)-1) << lsb
+        self.set_reg(reg_addr,(self.read_shadow(reg_addr) & ~mask) | ((value << lsb) & mask))
+    def read_shadow(self,reg_addr:int,force:bool=False)->int:
+        """
+        :param force: Read the register from the sensor even if it is in the shadow
+        :return: Register value, from the shadow if possible. A forced read of a dirty
+                 register returns what the sensor has, without losing the pending value.
+        """
+        if not force and reg_addr in self.shadow:
+            return self.shadow[reg_addr]
+        value=self.read_reg(reg_addr)
+        if reg_addr not in self.dirty:
+            self.shadow[reg_addr]=value
+        return value
+    def flush(self)->int:
+        """
+        Write all dirty registers from the shadow
+
+        :return: Number of transactions used
+        """
+        if len(self.dirty)==0:
+            return 0
+        result=self.write_shadow(sorted(self.dirty))
+        self.dirty.clear()
+        return result
+    def write_shadow(self,regs)->int:
+        """
+        Write registers from the shadow, one auto-increment burst per run of consecutive registers
+
+        :param regs: Registers to write, in ascending order
+        :return: Number of transactions used
+        """
+        result=0
+        i=0
+        while i<len(regs):
+            j=i+1
+            while j<len(regs) and regs[j]==regs[j-1]+1:
+                j+=1
+            self.write_reg(regs[i],bytes(self.shadow[reg] for reg in regs[i:j]))
+            result+=1
+            i=j
+        return result
+    def verify_shadow(self,reg_addr:int,count:int)->bytes:
+        """
+        Read back a block of registers in one burst, and check it against the shadow
+
+        :param reg_addr: First register to read
+        :param count: Number of registers
+        :return: Bytes read back
+        :raise IOError: If any register in the shadow doesn't match
+        """
+        readback=bytes(self.read_block(reg_addr,count))
+        bad=[f"0x{reg_addr+i:02x} was 0b{value:08b}, wrote 0b{self.shadow[reg_addr+i]:08b}"
+             for i,value in enumerate(readback)
+             if reg_addr+i in self.shadow and self.shadow[reg_addr+i]!=value]
+        if bad:
+            raise IOError("readback of "+", ".join(bad))
+        return readback
+    def check_link(self,trials:int=20)->bool:
+        """
+        Check that the sensor is talking reliably at the current SPI settings: whoami()
+        gives whoami_value every time, then test patterns written to scratch_reg read
+        back correctly. The original value of scratch_reg is written back afterwards.
+
+        :param trials: Number of whoami() checks
+        :return: True if all checks pass
+        """
+        if self.whoami_value is not None:
+            for _ in range(trials):
+                if self.whoami()!=self.whoami_value:
+                    return False
+        if self.scratch_reg is None:
+            return True
+        original=self.read_reg(self.scratch_reg)
+        try:
+            for pattern in (0x55,0xaa,0x00,0xff):
+                self.write_reg(self.scratch_reg,pattern)
+                if self.read_reg(self.scratch_reg)!=pattern:
+                    return False
+        finally:
+            self.write_reg(self.scratch_reg,original)
+        return True
+    def resync(self)->None:
+        """
+        Bring any state this driver caches about the sensor back in line with the sensor,
+        after transactions that may not have arrived intact (for instance during probing).
+        The shadow forgets everything but pending writes, so registers are read afresh.
+        """
+        self.shadow={reg_addr:value for reg_addr,value in self.shadow.items() if reg_addr in self.dirty}
     def read_uint16(self,reg_addr:int)->int:
-        result=self.read_reg(reg_addr,2)
+        result=self.read_block(reg_addr,2)
         return extract_uint16_le(result)
     def read_int16(self,reg_addr:int)->int:
-        return extract_int16_le(self.read_reg(reg_addr,2))
+        return extract_int16_le(self.read_block(reg_addr,2))
     def read_int8(self,reg_addr:int)->int:
-        result=self.read_reg(reg_addr)
+        result=self.read_block(reg_addr,1)[0]
         if result>0x80:
             result-=0x1_00
         return result
@@ -0,0 +1,135 @@
+"""
+Fake RPi.GPIO. Implements the part of the RPi.GPIO surface this package uses,
+and keeps the level of every pin so that SimBus can read the ChipSelect address
+back. Input pins can be driven from the simulation side with drive(), which
+fires any edge callbacks registered with add_event_detect() on the calling thread.
+"""
+import threading
+
+BOARD=10
+BCM=11
+OUT=0
+IN=1
+LOW=0
+HIGH=1
+RISING=31
+FALLING=32
+BOTH=33
+PUD_OFF=20
+PUD_DOWN=21
+PUD_UP=22
+
+_lock=threading.RLock()
+_mode=None
+_levels={}
+_directions={}
+_callbacks={}
+_detected={}
+# Number of output() calls and of individual pin writes, for measuring decoder traffic
+n_output=0
+n_pin_writes=0
+
+
+def _channels(channel)->tuple:
+    if isinstance(channel,(list,tuple)):
+        return tuple(channel)
+    return (channel,)
+
+
+def setwarnings(flag:bool)->None:
+    pass
+
+
+def setmode(mode:int)->None:
+    global _mode
+    _mode=mode
+
+
+def getmode()->int:
+    return _mode
+
+
+def setup(channel,direction:int,pull_up_down:int=PUD_OFF,initial:int=None)->None:
+    with _lock:
+        for pin in _channels(channel):
+            _directions[pin]=direction
+            if direction==OUT:
+                _levels[pin]=LOW if initial is None else initial
+            else:
+                _levels.setdefault(pin,HIGH if pull_up_down==PUD_UP else LOW)
+
+
+def output(channel,value)->None:
+    global n_output,n_pin_writes
+    pins=_channels(channel)
+    values=_channels(value)
+    if len(values)==1:
+        values=values*len(pins)
+    with _lock:
+        n_output+=1
+        for pin,level in zip(pins,values):
+            if _directions.get(pin)!=OUT:
+                raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+            n_pin_writes+=1
+            _levels[pin]=HIGH if level else LOW
+
+
+def input(channel:int)->int:
+    return _levels.get(channel,LOW)
+
+
+def cleanup(channel=None)->None:
+    with _lock:
+        pins=list(_levels) if channel is None else _channels(channel)
+        for pin in pins:
+            _levels.pop(pin,None)
+            _directions.pop(pin,None)
+            _callbacks.pop(pin,None)
+            _detected.pop(pin,None)
+
+
+def add_event_detect(channel:int,edge:int,callback=None,bouncetime:int=None)->None:
+    with _lock:
+        if channel in _callbacks:
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        _callbacks[channel]=(edge,[] if callback is None else [callback])
+        _detected[channel]=False
+
+
+def add_event_callback(channel:int,callback)->None:
+    with _lock:
+        _callbacks[channel][1].append(callback)
+
+
+def remove_event_detect(channel:int)->None:
+    with _lock:
+        _callbacks.pop(channel,None)
+        _detected.pop(channel,None)
+
+
+def event_detected(channel:int)->bool:
+    with _lock:
+        result=_detected.get(channel,False)
+        if result:
+            _detected[channel]=False
+        return result
+
+
+def drive(channel:int,level:int)->None:
+    """
+    Simulation side: set the level of an input pin, as an external device would.
+    Fires edge callbacks if the level changes.
+    """
+    with _lock:
+        old=_levels.get(channel,LOW)
+        level=HIGH if level else LOW
+        _levels[channel]=level
+        if old==level or channel not in _callbacks:
+            return
+        edge,callbacks=_callbacks[channel]
+        if edge!=BOTH and edge!=(RISING if level==HIGH else FALLING):
+            return
+        _detected[channel]=True
+        callbacks=list(callbacks)
+    for callback in callbacks:
+        callback(channel)
@@ -0,0 +1,3 @@
+"""
+Stand-in for the RPi package. Only GPIO is provided.
+"""
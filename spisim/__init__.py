@@ -0,0 +1,52 @@
+"""
+Offline SPI bus emulator. Stands in for spidev and RPi.GPIO so that the drivers
+in this package can be exercised and benchmarked without a Raspberry Pi.
+
+Typical use, before importing any driver module:
+
+    import spisim
+    bus=spisim.install()          # BME680 at decoder address 2, LSM9DS1 at 0, on SPI0
+    from read_sensors import main
+
+After that, bus.n_xfer, bus.n_bytes, bus.xfer_time, and bus.stats give the bus
+traffic, and the device models are in bus.devices.
+"""
+import sys
+
+# Simulated bus for each Pi SPI bus number, used by spisim.spidev.SpiDev.open()
+buses={}
+
+from spisim.bus import SimBus, SimDevice
+from spisim.bme680_model import BME680Model
+from spisim.lsm9ds1_model import LSM9DS1Model
+
+
+def default_bus(**kwargs)->SimBus:
+    """
+    :return: A bus wired as read_sensors.main() expects -- LSM9DS1 at decoder
+             address 0 and BME680 at decoder address 2
+    """
+    bus=SimBus(**kwargs)
+    bus.attach(0,LSM9DS1Model())
+    bus.attach(2,BME680Model())
+    return bus
+
+
+def install(bus:SimBus=None,bus_num:int=0)->SimBus:
+    """
+    Register the fake spidev and RPi.GPIO modules in sys.modules, so that
+    "import spidev" and "import RPi.GPIO" in the drivers get them.
+
+    :param bus: Simulated bus to connect. Default is default_bus().
+    :param bus_num: Pi SPI bus number to register it as, IE the first argument of SpiDev.open()
+    :return: The bus
+    """
+    from spisim import spidev, RPi
+    from spisim.RPi import GPIO
+    if bus is None:
+        bus=default_bus()
+    buses[bus_num]=bus
+    sys.modules['spidev']=spidev
+    sys.modules['RPi']=RPi
+    sys.modules['RPi.GPIO']=GPIO
+    return bus
@@ -0,0 +1,152 @@
+"""
+Register-level model of a BME680 on SPI: register paging through spi_mem_page
+in 0x73, soft reset, forced-mode measurements that take the datasheet
+conversion time and then set new_data_0, calibration blocks, and the gas
+heater set-point and result registers.
+"""
+import random
+
+from spisim.bus import SimDevice
+
+
+class BME680Model(SimDevice):
+    max_hz=16_000_000
+    chip_id=0x61
+    # Calibration of a real part, used unless overridden
+    default_cal=dict(par_t1=26203,par_t2=26370,par_t3=3,
+                     par_p1=36185,par_p2=-10373,par_p3=88,par_p4=6931,par_p5=-58,par_p6=30,
+                     par_p7=42,par_p8=-1390,par_p9=-2528,par_p10=30,
+                     par_h1=733,par_h2=1024,par_h3=0,par_h4=45,par_h5=20,par_h6=120,par_h7=-100,
+                     par_g1=-23,par_g2=-5541,par_g3=18,res_heat_val=42,res_heat_range=1,range_sw_err=0)
+    os_to_meas_cycles=(0,1,2,4,8,16,16,16)
+    def __init__(self,cal:dict=None,rP:int=366_000,rT:int=498_700,rh:int=22_000,
+                 gas_adc:int=600,gas_range:int=5,noise:int=0):
+        """
+
+        :param cal: Calibration coefficients to put in the calibration blocks, overriding default_cal
+        :param rP: Raw pressure count reported by each measurement
+        :param rT: Raw temperature count
+        :param rh: Raw humidity count
+        :param gas_adc: Raw gas resistance ADC count
+        :param gas_range: Gas resistance range
+        :param noise: Uniform noise in counts added to rP, rT, and rh on each measurement
+        """
+        super().__init__()
+        self.cal=dict(self.default_cal)
+        if cal is not None:
+            self.cal.update(cal)
+        self.rP=rP
+        self.rT=rT
+        self.rh=rh
+        self.gas_adc=gas_adc
+        self.gas_range=gas_range
+        self.noise=noise
+        self.n_meas=0
+        self.reset()
+    def _put8(self,addr:int,value:int):
+        self.regs[addr]=value & 0xff
+    def _put16(self,addr:int,value:int):
+        self.regs[addr]=value & 0xff
+        self.regs[addr+1]=(value >> 8) & 0xff
+    def reset(self):
+        self.regs=bytearray(256)
+        self.page=0
+        self.done_at=None
+        c=self.cal
+        self._put16(0x8a,c['par_t2'])
+        self._put8 (0x8c,c['par_t3'])
+        self._put16(0x8e,c['par_p1'])
+        self._put16(0x90,c['par_p2'])
+        self._put8 (0x92,c['par_p3'])
+        self._put16(0x94,c['par_p4'])
+        self._put16(0x96,c['par_p5'])
+        self._put8 (0x98,c['par_p7'])
+        self._put8 (0x99,c['par_p6'])
+        self._put16(0x9c,c['par_p8'])
+        self._put16(0x9e,c['par_p9'])
+        self._put8 (0xa0,c['par_p10'])
+        self._put8 (0xe1,c['par_h2'] >> 4)
+        self._put8 (0xe2,(c['par_h2'] & 0x0f) << 4 | (c['par_h1'] & 0x0f))
+        self._put8 (0xe3,c['par_h1'] >> 4)
+        self._put8 (0xe4,c['par_h3'])
+        self._put8 (0xe5,c['par_h4'])
+        self._put8 (0xe6,c['par_h5'])
+        self._put8 (0xe7,c['par_h6'])
+        self._put8 (0xe8,c['par_h7'])
+        self._put16(0xe9,c['par_t1'])
+        self._put16(0xeb,c['par_g2'])
+        self._put8 (0xed,c['par_g1'])
+        self._put8 (0xee,c['par_g3'])
+        self._put8 (0x00,c['res_heat_val'])
+        self._put8 (0x02,(c['res_heat_range'] & 0x03) << 4)
+        self._put8 (0x04,(c['range_sw_err'] & 0x0f) << 4)
+        self._put8 (0xd0,self.chip_id)
+    def meas_duration(self)->float:
+        """
+        :return: Duration in seconds of a forced-mode measurement with the current settings
+        """
+        osrs_t=(self.regs[0x74] >> 5) & 0x07
+        osrs_p=(self.regs[0x74] >> 2) & 0x07
+        osrs_h=(self.regs[0x72] >> 0) & 0x07
+        cycles=self.os_to_meas_cycles[osrs_t]+self.os_to_meas_cycles[osrs_p]+self.os_to_meas_cycles[osrs_h]
+        result=cycles*1963+477*4+477*5+1000
+        if self.regs[0x71] & 0x10:
+            result+=self.gas_wait_ms(self.regs[0x64+(self.regs[0x71] & 0x0f)])*1000
+        return result/1e6
+    @staticmethod
+    def gas_wait_ms(code:int)->int:
+        return (code & 0x3f)*(1 << (2*(code >> 6)))
+    def update(self,now:float)->None:
+        if self.done_at is None or now<self.done_at:
+            return
+        self.done_at=None
+        self.n_meas+=1
+        def noisy(value:int)->int:
+            return value+random.randint(-self.noise,self.noise) if self.noise else value
+        rP=noisy(self.rP)
+        rT=noisy(self.rT)
+        rh=noisy(self.rh)
+        self.regs[0x1f:0x22]=bytes((rP >> 12 & 0xff,rP >> 4 & 0xff,(rP & 0x0f) << 4))
+        self.regs[0x22:0x25]=bytes((rT >> 12 & 0xff,rT >> 4 & 0xff,(rT & 0x0f) << 4))
+        self.regs[0x25:0x27]=bytes((rh >> 8 & 0xff,rh & 0xff))
+        gas_index=self.regs[0x71] & 0x0f
+        if self.regs[0x71] & 0x10:
+            self.regs[0x2a]=(self.gas_adc >> 2) & 0xff
+            self.regs[0x2b]=(self.gas_adc & 0x03) << 6 | 1 << 5 | 1 << 4 | (self.gas_range & 0x0f)
+        else:
+            self.regs[0x2b]&=0xcf # gas_valid_r and heat_stab_r clear
+        self.regs[0x1d]=0x80 | gas_index # new_data_0
+        self.regs[0x74]&=0xfc # Back to sleep mode
+    def full_addr(self,addr:int)->int:
+        """
+        :param addr: 7-bit SPI register address
+        :return: 8-bit register address, using the current page
+        """
+        return addr if self.page==1 else addr | 0x80
+    def read_byte(self,addr:int)->int:
+        if addr==0x73:
+            return self.page << 4
+        return self.regs[self.full_addr(addr)]
+    def write_byte(self,addr:int,value:int)->None:
+        if addr==0x73:
+            self.page=(value >> 4) & 0x01
+            return
+        full=self.full_addr(addr)
+        if full==0xe0:
+            if value==0xb6:
+                self.reset()
+            return
+        if full==0xd0 or 0x80<=full<0xd0 or full>=0xe1 or full<0x50:
+            return # Read-only
+        self.regs[full]=value
+        if full==0x74 and (value & 0x03)==0x01:
+            # Forced mode, start a measurement
+            self.done_at=self.now()+self.meas_duration()
+            self.regs[0x1d]=(self.regs[0x1d] & 0x7f) | 0x20 # Clear new_data_0, set measuring
+    def write_burst(self,addr:int,values:bytes)->None:
+        # Multi-byte writes on the BME680 are address/data pairs after the first byte
+        if len(values)==0:
+            return
+        self.write_byte(addr,values[0])
+        for i in range(1,len(values)-1,2):
+            self.write_byte(values[i] & 0x7f,values[i+1])
@@ -0,0 +1,160 @@
+"""
+Simulated SPI bus. A SimBus stands in for one of the Pi's SPI controllers
+together with the 74x138 decoder on its ~CE0 line. Devices are attached at
+decoder addresses, and each transaction is routed to the device whose address
+is currently on the ChipSelect pins, as read back from the fake GPIO.
+
+Time on the bus is the host monotonic clock plus the accumulated modeled
+transfer time, so device models (conversion times, output data rates) see
+time pass at least as fast as a real bus would make it.
+"""
+import random
+import threading
+import time
+
+from spisim.RPi import GPIO
+
+
+class SimDevice:
+    """
+    Superclass for register-level device models using the same de-facto protocol
+    as SPI_sensor: first byte is read/~write (bit 7) and register address, the rest
+    is data. Subclasses implement read_byte(), write_byte() and optionally next_addr()
+    and update().
+    """
+    # Fastest SPI clock the part actually works at, which is usually above its datasheet
+    # rating. Transactions faster than this return garbage and don't reach the model.
+    max_hz=None
+    def __init__(self):
+        self.bus=None
+    def now(self)->float:
+        return self.bus.now() if self.bus is not None else time.monotonic()
+    def update(self,now:float)->None:
+        """
+        Advance the model to time now. Called before every transaction.
+        """
+        pass
+    def read_byte(self,addr:int)->int:
+        raise NotImplementedError
+    def write_byte(self,addr:int,value:int)->None:
+        raise NotImplementedError
+    def next_addr(self,addr:int,read:bool)->int:
+        """
+        :return: Address to use for the next byte of a multi-byte transaction
+        """
+        return (addr+1) & 0x7f
+    def write_burst(self,addr:int,values:bytes)->None:
+        """
+        Handle the data bytes of a write transaction. The default is auto-increment.
+        """
+        for value in values:
+            self.write_byte(addr,value)
+            addr=self.next_addr(addr,read=False)
+    def xfer(self,tx:bytes)->list:
+        self.update(self.now())
+        addr=tx[0] & 0x7f
+        if tx[0] & 0x80:
+            rx=[0]
+            for _ in tx[1:]:
+                rx.append(self.read_byte(addr))
+                addr=self.next_addr(addr,read=True)
+            return rx
+        self.write_burst(addr,bytes(tx[1:]))
+        return [0]*len(tx)
+
+
+class SimBus:
+    def __init__(self,cs_pins:tuple=(15,13,11),realtime:bool=False,xfer_overhead:float=0.0):
+        """
+
+        :param cs_pins: GPIO pins (BOARD numbering) driving the 74x138 A0, A1, A2 inputs,
+                        as in ChipSelect. None means devices are on ~CE0/~CE1 directly,
+                        and are addressed by the spidev device number.
+        :param realtime: If true, sleep for the modeled duration of each transfer. If false,
+                         the transfer time is added to the bus clock instead.
+        :param xfer_overhead: Fixed time in seconds added to each transaction, on top of the
+                              bit time, to model driver and ~CS overhead
+        """
+        self.cs_pins=cs_pins
+        self.realtime=realtime
+        self.xfer_overhead=xfer_overhead
+        self.devices={}
+        self.offset=0.0
+        # Serializes transactions and background ticks, see start_ticker()
+        self.lock=threading.RLock()
+        self.ticker=None
+        self.reset_stats()
+    def now(self)->float:
+        return time.monotonic()+self.offset
+    def attach(self,addr:int,device:SimDevice)->SimDevice:
+        device.bus=self
+        self.devices[addr]=device
+        return device
+    def start_ticker(self,period:float=0.0005):
+        """
+        Advance every device model from a background thread, so that device outputs
+        like interrupt pins change on schedule even when nothing is talking to the bus.
+
+        :param period: Time between updates in seconds
+        """
+        if self.ticker is not None:
+            return
+        self.ticker_stop=threading.Event()
+        def tick():
+            while not self.ticker_stop.wait(period):
+                with self.lock:
+                    now=self.now()
+                    for device in self.devices.values():
+                        device.update(now)
+        self.ticker=threading.Thread(target=tick,name='spisim ticker',daemon=True)
+        self.ticker.start()
+    def stop_ticker(self):
+        if self.ticker is not None:
+            self.ticker_stop.set()
+            self.ticker.join()
+            self.ticker=None
+    def reset_stats(self):
+        self.n_xfer=0
+        self.n_bytes=0
+        self.xfer_time=0.0
+        self.stats={}
+    def selected(self,ce:int)->int:
+        """
+        :param ce: spidev device number (~CE line) used for the transaction
+        :return: Address of the device selected by the decoder
+        """
+        if self.cs_pins is None:
+            return ce
+        addr=0
+        for i,pin in enumerate(self.cs_pins):
+            if GPIO.input(pin):
+                addr|=1<<i
+        return addr
+    def xfer(self,tx,ce:int=0,speed_hz:int=500_000)->list:
+        """
+        Do one transaction on the bus.
+
+        :param tx: Bytes to send
+        :param ce: spidev device number
+        :param speed_hz: SPI clock rate
+        :return: Bytes received. If no device is selected, all 0xFF, as
+                 the line floats high with the Pi's pull-up.
+        """
+        dt=len(tx)*8/speed_hz+self.xfer_overhead
+        if self.realtime:
+            time.sleep(dt)
+        else:
+            self.offset+=dt
+        with self.lock:
+            addr=self.selected(ce)
+            self.n_xfer+=1
+            self.n_bytes+=len(tx)
+            self.xfer_time+=dt
+            n_xfer,n_bytes,xfer_time=self.stats.get(addr,(0,0,0.0))
+            self.stats[addr]=(n_xfer+1,n_bytes+len(tx),xfer_time+dt)
+            device=self.devices.get(addr)
+            if device is None:
+                return [0xff]*len(tx)
+            if device.max_hz is not None and speed_hz>device.max_hz:
+                return [random.randrange(256) for _ in tx]
+            return device.xfer(tx)
@@ -0,0 +1,184 @@
+"""
+Register-level model of the accelerometer/gyroscope half of an LSM9DS1 on SPI:
+register auto-increment (CTRL_REG8 IF_ADD_INC), sample generation at the
+configured output data rate with GDA/XLDA/TDA status bits, and the 32-set
+FIFO with FIFO_CTRL, FIFO_SRC, and the OUT_Z_H_XL to OUT_X_L_G read rollover.
+If int1_pin is set, the INT1_A/G output drives that fake GPIO input according
+to INT1_CTRL and the CTRL_REG8 polarity bit. Use SimBus.start_ticker() to have
+the pin change on schedule without bus traffic.
+"""
+import collections
+import math
+import random
+
+from spisim.bus import SimDevice
+from spisim.RPi import GPIO
+
+
+class LSM9DS1Model(SimDevice):
+    max_hz=20_000_000
+    INT1_CTRL    =0x0C
+    WHO_AM_I     =0x0F
+    CTRL_REG1_G  =0x10
+    OUT_TEMP_L   =0x15
+    STATUS_REG_G =0x17
+    OUT_X_L_G    =0x18
+    OUT_Z_H_G    =0x1D
+    CTRL_REG6_XL =0x20
+    CTRL_REG8    =0x22
+    CTRL_REG9    =0x23
+    STATUS_REG_XL=0x27
+    OUT_X_L_XL   =0x28
+    OUT_Z_H_XL   =0x2D
+    FIFO_CTRL    =0x2E
+    FIFO_SRC     =0x2F
+    odr_gs=(0,14.9,59.5,119.0,238.0,476.0,952.0,0)
+    odr_as=(0,10.0,50.0,119.0,238.0,476.0,952.0,0)
+    # Sensitivity in DN per SI unit, by full-scale code
+    dn_per_dps=(1/8.75e-3,1/17.5e-3,0,1/70e-3)
+    dn_per_g=(1/0.061e-3,1/0.732e-3,1/0.122e-3,1/0.244e-3)
+    def __init__(self,gyro:tuple=(0.0,0.0,0.0),acc:tuple=(0.0,0.0,1.0),temp:int=0,noise:int=0,int1_pin:int=None):
+        """
+
+        :param gyro: Rotation rate in deg/s reported by each sample
+        :param acc: Acceleration in g reported by each sample
+        :param temp: Raw temperature count
+        :param noise: Uniform noise in DN added to each axis of each sample
+        :param int1_pin: Fake GPIO pin (BOARD numbering) connected to INT1_A/G, or None
+        """
+        super().__init__()
+        self.gyro=gyro
+        self.acc=acc
+        self.temp=temp
+        self.noise=noise
+        self.int1_pin=int1_pin
+        self.reset()
+    def reset(self):
+        self.regs=bytearray(0x80)
+        self.regs[self.WHO_AM_I]=0x68
+        self.regs[self.CTRL_REG8]=0x04
+        self.fifo=collections.deque()
+        self.fifo_ovrn=False
+        self.t0=None
+        self.n_samples=0
+        self.on_sample=None
+    def odr(self)->float:
+        odr_g=self.odr_gs[(self.regs[self.CTRL_REG1_G] >> 5) & 0x07]
+        if odr_g>0:
+            return odr_g
+        return self.odr_as[(self.regs[self.CTRL_REG6_XL] >> 5) & 0x07]
+    def fifo_mode(self)->int:
+        if not (self.regs[self.CTRL_REG9] & 0x02):
+            return 0
+        return (self.regs[self.FIFO_CTRL] >> 5) & 0x07
+    def sample(self)->bytes:
+        """
+        :return: One gyro+accel set as it appears in OUT_X_L_G..OUT_Z_H_G, OUT_X_L_XL..OUT_Z_H_XL
+        """
+        fs_g=(self.regs[self.CTRL_REG1_G] >> 3) & 0x03
+        fs_a=(self.regs[self.CTRL_REG6_XL] >> 3) & 0x03
+        values=[v*self.dn_per_dps[fs_g] for v in self.gyro]+[v*self.dn_per_g[fs_a] for v in self.acc]
+        result=bytearray()
+        for value in values:
+            value=int(round(value))
+            if self.noise:
+                value+=random.randint(-self.noise,self.noise)
+            value=max(-0x8000,min(0x7fff,value))
+            result+=(value & 0xffff).to_bytes(2,'little')
+        return bytes(result)
+    def update(self,now:float)->None:
+        odr=self.odr()
+        if odr==0:
+            self.t0=None
+            return
+        if self.t0 is None:
+            self.t0=now
+            self.n_samples=0
+            return
+        n=math.floor((now-self.t0)*odr)-self.n_samples
+        if n<=0:
+            return
+        mode=self.fifo_mode()
+        for _ in range(n):
+            data=self.sample()
+            self.n_samples+=1
+            if mode==0:
+                continue
+            if len(self.fifo)<32:
+                self.fifo.append(data)
+            elif mode==0b001:
+                pass # FIFO mode stops when full
+            else:
+                self.fifo.popleft()
+                self.fifo.append(data)
+                self.fifo_ovrn=True
+        if mode==0:
+            self.load(data)
+        self.regs[self.OUT_TEMP_L:self.OUT_TEMP_L+2]=(self.temp & 0xffff).to_bytes(2,'little')
+        self.regs[self.STATUS_REG_G]|=0x07
+        self.regs[self.STATUS_REG_XL]|=0x07
+        if self.on_sample is not None:
+            self.on_sample(now)
+        self.drive_int1()
+    def drive_int1(self)->None:
+        if self.int1_pin is None:
+            return
+        ctrl=self.regs[self.INT1_CTRL]
+        status=self.regs[self.STATUS_REG_G]
+        active=(bool(ctrl & 0x02 and status & 0x02) or
+                bool(ctrl & 0x01 and status & 0x01) or
+                bool(ctrl & 0x08 and self.fifo_src() & 0x80))
+        if self.regs[self.CTRL_REG8] & 0x20:
+            active=not active
+        GPIO.drive(self.int1_pin,GPIO.HIGH if active else GPIO.LOW)
+    def xfer(self,tx:bytes)->list:
+        result=super().xfer(tx)
+        self.drive_int1()
+        return result
+    def load(self,data:bytes)->None:
+        self.regs[self.OUT_X_L_G:self.OUT_Z_H_G+1]=data[0:6]
+        self.regs[self.OUT_X_L_XL:self.OUT_Z_H_XL+1]=data[6:12]
+    def fifo_src(self)->int:
+        fth=self.regs[self.FIFO_CTRL] & 0x1f
+        n=len(self.fifo)
+        return (1 << 7 if n>fth else 0) | (1 << 6 if self.fifo_ovrn else 0) | (n & 0x3f)
+    def read_byte(self,addr:int)->int:
+        if addr==self.FIFO_SRC:
+            return self.fifo_src()
+        if addr==self.OUT_X_L_G and self.fifo_mode()!=0 and len(self.fifo)>0:
+            # Reading the start of a set pops it out of the FIFO
+            self.load(self.fifo.popleft())
+            self.fifo_ovrn=False
+        result=self.regs[addr]
+        if addr==self.OUT_TEMP_L+1:
+            self.regs[self.STATUS_REG_G]&=~0x04
+            self.regs[self.STATUS_REG_XL]&=~0x04
+        elif addr==self.OUT_Z_H_G:
+            self.regs[self.STATUS_REG_G]&=~0x02
+            self.regs[self.STATUS_REG_XL]&=~0x02
+        elif addr==self.OUT_Z_H_XL:
+            self.regs[self.STATUS_REG_G]&=~0x01
+            self.regs[self.STATUS_REG_XL]&=~0x01
+        return result
+    def write_byte(self,addr:int,value:int)->None:
+        if addr<0x04 or 0x15<=addr<=0x1d or 0x26<=addr<=0x2d or addr in (self.WHO_AM_I,self.FIFO_SRC):
+            return # Reserved or read-only
+        if addr==self.CTRL_REG8 and (value & 0x01):
+            self.reset()
+            return
+        self.regs[addr]=value
+        if addr==self.FIFO_CTRL and (value >> 5)==0:
+            self.fifo.clear()
+            self.fifo_ovrn=False
+        if addr in (self.CTRL_REG1_G,self.CTRL_REG6_XL):
+            self.t0=None
+            self.update(self.now())
+    def next_addr(self,addr:int,read:bool)->int:
+        if not (self.regs[self.CTRL_REG8] & 0x04):
+            return addr
+        if read and self.fifo_mode()!=0:
+            if addr==self.OUT_Z_H_G:
+                return self.OUT_X_L_XL
+            if addr==self.OUT_Z_H_XL:
+                return self.OUT_X_L_G
+        return (addr+1) & 0x7f
@@ -0,0 +1,30 @@
+"""
+Fake spidev. SpiDev.open(bus,device) connects to the SimBus registered for
+that bus number in spisim.buses.
+"""
+import spisim
+
+
+class SpiDev:
+    def __init__(self,bus:int=None,device:int=None):
+        self.max_speed_hz=500_000
+        self.mode=0
+        self.bits_per_word=8
+        self.sim=None
+        self.device=None
+        if bus is not None:
+            self.open(bus,device)
+    def open(self,bus:int,device:int)->None:
+        self.sim=spisim.buses[bus]
+        self.device=device
+    def close(self)->None:
+        self.sim=None
+    def xfer(self,values,speed_hz:int=0,delay_usec:int=0,bits_per_word:int=0)->list:
+        if self.sim is None:
+            raise OSError(9,"Bad file descriptor")
+        return self.sim.xfer(list(values),ce=self.device,speed_hz=speed_hz or self.max_speed_hz)
+    xfer2=xfer
+    def writebytes(self,values)->None:
+        self.xfer(values)
+    def readbytes(self,n:int)->list:
+        return self.xfer([0]*n)
@@ -0,0 +1,117 @@
+"""
+Sample timestamps without a clock read per sample.
+
+A sensor running at a fixed output data rate produces samples on its own
+clock, so once reads are batched (a FIFO drain, or a buffer of polled
+samples) the host time of the read says little about when each sample was
+taken. Instead, take one time.monotonic_ns() anchor per batch, count
+samples, and fit a line through (sample number, anchor time):
+
+* The slope is the sensor's actual sample period in host nanoseconds. Its
+  ratio to the nominal period 1/ODR is the sensor-vs-host clock drift,
+  which for these parts is percent-level, far too much to ignore.
+* Read latency only ever makes an anchor late, never early, so the line is
+  put through the earliest anchor in the window (the lower envelope)
+  rather than the average.
+
+The fit is over a sliding window of recent batches, so it follows the drift
+as the sensor's clock wanders with temperature.
+
+The sample count has to be right for the slope to be, so lost samples are
+only counted when the sensor says there were some, as the LSM9DS1 does with
+FIFO_SRC OVRN. Host latency can make an anchor late by more than a sample
+period at high rates, so lateness alone is never taken as loss. It is only
+used to work out how many samples an overrun cost.
+"""
+from array import array
+from collections import deque
+
+
+class SampleClock:
+    def __init__(self,odr:float,window:int=64):
+        """
+
+        :param odr: Nominal output data rate in Hz, for instance LSM9DS1_AG.odr_g
+        :param window: Number of recent batches to fit over
+        """
+        self.nominal_period=1e9/odr
+        self.anchors=deque(maxlen=window)
+        self.reset()
+    def reset(self):
+        """
+        Forget the fit, for instance after reconfiguring the sensor
+        """
+        self.anchors.clear()
+        # Number of samples counted so far, including any inferred lost ones
+        self.n_samples=0
+        self.n_lost=0
+        self.period=self.nominal_period
+        # Fitted time of sample 0, in ns
+        self.t_zero=None
+    def time_of(self,k:int)->float:
+        """
+        :param k: Sample number, counting from the first sample seen
+        :return: Fitted time of that sample, in time.monotonic_ns() units
+        """
+        return self.t_zero+self.period*k
+    def fit(self):
+        """
+        Refit the period and offset over the window of anchors
+        """
+        anchors=self.anchors
+        k0,t0=anchors[0]
+        if len(anchors)>=2 and anchors[-1][0]>k0:
+            # Least-squares slope, relative to the oldest anchor for precision
+            n=len(anchors)
+            mk=sum(k-k0 for k,_ in anchors)/n
+            mt=sum(t-t0 for _,t in anchors)/n
+            skk=sum((k-k0-mk)**2 for k,_ in anchors)
+            skt=sum((k-k0-mk)*(t-t0-mt) for k,t in anchors)
+            self.period=skt/skk
+        # Lower envelope: the line through the earliest anchor, relative to the slope
+        self.t_zero=t0+min((t-t0)-self.period*(k-k0) for k,t in anchors)-self.period*k0
+    def update(self,t_anchor_ns:int,n:int,overrun:bool=False)->tuple:
+        """
+        Record a batch
+
+        :param t_anchor_ns: time.monotonic_ns() taken just after reading the batch
+        :param n: Number of samples in the batch, the last of which is the newest the sensor had
+        :param overrun: The sensor reported losing samples since the previous batch, for
+                        instance LSM9DS1_AG.n_fifo_overrun went up during read_fifo()
+        :return: Tuple of (time of the first sample of the batch in ns, sample period in ns).
+                 Sample i of the batch was taken at first+i*period. For an empty batch,
+                 nothing is recorded and the time is None.
+        """
+        if n<=0:
+            return None,self.period
+        k_last=self.n_samples+n-1
+        if overrun and self.t_zero is not None:
+            # At least one sample was lost, and the lateness says how many
+            lost=max(1,round((t_anchor_ns-self.time_of(k_last))/self.period))
+            self.n_lost+=lost
+            k_last+=lost
+        self.anchors.append((k_last,t_anchor_ns))
+        self.fit()
+        self.n_samples=k_last+1
+        k_first=k_last-n+1
+        return self.time_of(k_first),self.period
+    def times(self,t_anchor_ns:int,n:int,overrun:bool=False)->array:
+        """
+        Record a batch, and expand the result of update() into one time per sample
+
+        :return: array('q') of n sample times in ns, empty if n is 0
+        """
+        if n<=0:
+            return array('q')
+        first,period=self.update(t_anchor_ns,n,overrun)
+        return array('q',(int(first+i*period) for i in range(n)))
+    def ratio(self)->float:
+        """
+        :return: Actual sample period over nominal. Above 1, the sensor's clock is slow compared to the host's.
+        """
+        return self.period/self.nominal_period
+    def odr(self)->float:
+        """
+        :return: Actual output data rate in Hz, as measured by the host clock
+        """
+        return 1e9/self.period